@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -
+
+""" Compare throughput of per value field conversion (to_db() and from_db()
+calls) and batch one (to_db_many() and from_db_many()) for each built-in
+field type. Database is not used: python benchmarks/fields.py [count]. """
+
+from datetime import (
+	datetime,
+)
+
+from sys import (
+	argv,
+)
+
+from time import (
+	time,
+)
+
+from redisca2 import (
+	Bool,
+	DateTime,
+	Email,
+	Integer,
+	MD5Pass,
+	String,
+)
+
+
+def samples (count):
+	""" Return list of (field, values) tuples to convert. """
+
+	now = int(time())
+
+	return [
+		(Bool(name='bool'), [i % 2 for i in range(count)]),
+		(Integer(name='int', minval=0, maxval=count), list(range(count))),
+		(DateTime(name='dt'), [datetime.fromtimestamp(now - i) for i in range(count)]),
+		(String(name='str', minlen=1, maxlen=20), ['user%d' % i for i in range(count)]),
+		(Email(name='email'), ['User%d@Example.com' % i for i in range(count)]),
+		(MD5Pass(name='pass'), ['secret%d' % i for i in range(count)]),
+	]
+
+
+def rate (count, func, *args):
+	""" Return values per second of given conversion. """
+
+	started = time()
+	func(*args)
+
+	return count / max(time() - started, 1e-9)
+
+
+def main ():
+	count = int(argv[1]) if len(argv) > 1 else 100000
+
+	print('%d values, values/s' % count)
+	print('%-8s %12s %12s %12s %12s' % ('field', 'to_db', 'to_db_many', 'from_db', 'from_db_many'))
+
+	for field, vals in samples(count):
+		raw = [str(val) for val in field.to_db_many(vals)]
+
+		print('%-8s %12d %12d %12d %12d' % (
+			field.__class__.__name__,
+			rate(count, lambda: [field.to_db(val) for val in vals]),
+			rate(count, field.to_db_many, vals),
+			rate(count, lambda: [field.from_db(val) for val in raw]),
+			rate(count, field.from_db_many, raw),
+		))
+
+
+if __name__ == '__main__':
+	main()
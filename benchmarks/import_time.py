@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -
+
+""" Compare import time of redisca2 core (backends are loaded lazily) with
+import time of redisca2 plus its redis backend (old eager behaviour).
+Each statement is timed in fresh interpreter, best of N runs is shown. """
+
+from subprocess import (
+	check_output,
+)
+
+from sys import (
+	argv,
+	executable,
+)
+
+
+STATEMENTS = (
+	('import redisca2', 'import redisca2'),
+	('import redisca2 + backends', 'import redisca2, redisca2.contrib.redis, redisca2.contrib.flask'),
+)
+
+TIMER = 'from time import time; t = time(); %s; print(time() - t)'
+
+
+def measure (statement, runs):
+	""" Return best import time of given statement in milliseconds. """
+
+	results = list()
+
+	for _ in range(runs):
+		output = check_output([executable, '-c', TIMER % statement])
+		results.append(float(output) * 1000)
+
+	return min(results)
+
+
+def main ():
+	runs = int(argv[1]) if len(argv) > 1 else 20
+
+	for title, statement in STATEMENTS:
+		print('%-30s %8.2f ms' % (title, measure(statement, runs)))
+
+
+if __name__ == '__main__':
+	main()
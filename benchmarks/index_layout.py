@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -
+
+""" Compare memory usage and keys count of exact indexes stored using
+default ('sets') and 'compact' layouts. Uses (and flushes!) given redis
+database: python benchmarks/index_layout.py [models count] [db]. """
+
+from sys import (
+	argv,
+)
+
+from redisca2 import (
+	Model,
+	RedisConnector,
+	Email,
+	String,
+	conf,
+)
+
+
+class SetsUser (Model):
+	email = Email(
+		name='eml',
+		unique=True,
+	)
+
+	city = String(
+		name='city',
+		index=True,
+	)
+
+
+@conf(layout='compact')
+class CompactUser (SetsUser):
+	pass
+
+
+def fill (model_cls, count):
+	""" Save *count* models of given class, return (memory, keys) delta. """
+
+	handler = model_cls.getdb().handler
+	memory = handler.info('memory')['used_memory']
+	keys = handler.dbsize()
+
+	model_cls.bulk_load(({
+		'id': i,
+		'email': 'user%d@example.com' % i,
+		'city': 'city%d' % (i % 1000),
+	} for i in range(count)), validate=False)
+
+	return handler.info('memory')['used_memory'] - memory, handler.dbsize() - keys
+
+
+def main ():
+	count = int(argv[1]) if len(argv) > 1 else 100000
+	conf.db = RedisConnector(db=int(argv[2]) if len(argv) > 2 else 15)
+	conf.db.handler.flushdb()
+
+	print('%d models, %d distinct cities' % (count, min(count, 1000)))
+
+	for model_cls in (SetsUser, CompactUser):
+		memory, keys = fill(model_cls, count)
+
+		print('%-8s %10.2f MiB %10d keys' % (
+			model_cls.getlayout(),
+			memory / 1048576.0,
+			keys,
+		))
+
+	conf.db.handler.flushdb()
+
+
+if __name__ == '__main__':
+	main()
@@ -1,6 +1,80 @@
 # -*- coding: utf-8 -
 
+from importlib import (
+	import_module,
+)
+
+from sys import (
+	version_info,
+)
+
 from .base import *
 from .fields import *
-from .contrib import *
 from .utils import *
+
+from .contrib import (
+	BACKENDS,
+)
+
+__all__ = [
+	'AndExpr',
+	'BExpr',
+	'Backref',
+	'Bool',
+	'BoundBackref',
+	'BoundCollection',
+	'BoundList',
+	'BoundSet',
+	'BoundZSet',
+	'Collection',
+	'Connector',
+	'DateTime',
+	'Email',
+	'Expr',
+	'Field',
+	'IdGenerator',
+	'Index',
+	'IndexField',
+	'Integer',
+	'Json',
+	'ListField',
+	'MD5Pass',
+	'Model',
+	'MsgPack',
+	'PY3K',
+	'RangeIndexField',
+	'Reference',
+	'SetField',
+	'String',
+	'Version',
+	'ZSetField',
+	'batch',
+	'compress',
+	'conf',
+	'decompress',
+	'gather',
+	'hexid',
+	'intid',
+	'scope',
+]
+
+# Star import loads backends too.
+__all__.extend(sorted(BACKENDS))
+
+
+if version_info >= (3, 7):
+	def __getattr__ (name):
+		if name not in BACKENDS:
+			raise AttributeError("module 'redisca2' has no attribute '%s'" % name)
+
+		val = getattr(import_module(BACKENDS[name]), name)
+		globals()[name] = val
+
+		return val
+
+	def __dir__ ():
+		return sorted(set(globals()) | set(BACKENDS))
+
+else:
+	# No module level __getattr__ support.
+	from .contrib import *
@@ -1,14 +1,34 @@
 # -*- coding: utf-8 -
 
-from inspect import (
-	isbuiltin,
-	isfunction,
-	ismethod,
+from abc import (
+	abstractmethod,
+)
+
+from types import (
+	BuiltinFunctionType,
+	FunctionType,
+	MethodType,
+)
+
+from json import (
+	dumps,
+)
+
+from time import (
+	time,
 )
 
 from .utils import (
+	Abstract,
+	CODECS,
+	ContextStack,
 	PY3K,
+	compress,
+	decode_raw,
+	decompress,
+	encode_raw,
 	hexid,
+	optional,
 )
 
 
@@ -21,40 +41,197 @@ class conf (object):
 
 	db = None # Default connection.
 
-	def __init__ (self, prefix=None, db=None):
+	def __init__ (self, prefix=None, db=None, ttl=None, layout=None,
+		stream=None, stream_maxlen=None, buckets=None):
+
 		if db is not None:
 			assert isinstance(db, Connector)
 
+		if ttl is not None:
+			assert ttl > 0
+
+		if layout is not None:
+			assert layout in ('sets', 'compact')
+
+		if buckets is not None:
+			assert buckets > 0
+
+		if stream_maxlen is not None:
+			assert stream is not None and stream_maxlen > 0
+
 		self._prefix = prefix
 		self._db = db
+		self._ttl = ttl
+		self._layout = layout
+		self._buckets = buckets
+		self._stream = stream
+		self._stream_maxlen = stream_maxlen
 
 	def __call__ (self, cls):
 		if self._db is not None:
 			cls._db = self._db
 
+		if self._ttl is not None:
+			cls._ttl = self._ttl
+
+		if self._layout is not None:
+			cls._layout = self._layout
+
+		if self._buckets is not None:
+			cls._buckets = self._buckets
+
+		if self._stream is not None:
+			cls._stream = self._stream, self._stream_maxlen
+
 		if self._prefix is not None:
 			Model._cls2prefix[cls] = self._prefix
 
 		return cls
 
 
-class BExpr (object):
-	EQ = '='
-	GT = '>'
-	LT = '<'
-	GE = '>='
-	LE = '<='
+class batch (object):
+	""" Context manager which captures saves and deletes of all models in
+	its scope and writes them at exit using pipes (transactional if flag
+	set) per connector, *chunk* models per pipe. Unique constraints are
+	checked before writing using single pipe per connector. Models local
+	state is updated after successful pipe execution only. """
 
-	def __init__ (self, operator, field, val):
-		assert isinstance(field, Field)
+	_stack = ContextStack('redisca2_batch') # Active batches.
+
+	def __init__ (self, transaction=False, chunk=1000):
+		assert chunk > 0
+
+		self.transaction = transaction
+		self.chunk = chunk
+		self.ops = list()  # [model, operation, ttl] lists.
+		self.index = dict() # Model -> ops list item.
+		self.tokens = list()
+
+	def __enter__ (self):
+		self.tokens.append(self._stack.push(self))
+		return self
+
+	def __exit__ (self, exc_type, exc_value, traceback):
+		self._stack.pop(self.tokens.pop())
+
+		if exc_type is None:
+			self.flush()
+
+	def __len__ (self):
+		return len(self.ops)
+
+	@classmethod
+	def current (cls):
+		""" Return innermost active batch or None. """
+		return cls._stack.top()
+
+	def add (self, model, operation, ttl=None):
+		""" Capture model save or delete. The last one wins except save after
+		delete which is written as 'replace' (delete, then save of local
+		changes as of new model). """
+
+		assert operation in ('save', 'delete')
+
+		if model in self.index:
+			op = self.index[model]
+
+			if operation == 'save' and op[1] in ('delete', 'replace'):
+				operation = 'replace'
+
+			op[1:] = [operation, ttl]
+
+		else:
+			self.index[model] = [model, operation, ttl]
+			self.ops.append(self.index[model])
+
+	def flush (self):
+		""" Write captured operations. """
+
+		ops, self.ops, self.index = self.ops, list(), dict()
+		groups = dict()
+
+		for op in ops:
+			groups.setdefault(op[0].getdb(), list()).append(op)
+
+		for db, group in groups.items():
+			db.check_unique([model for model, operation, ttl in group \
+				if operation != 'delete'])
+
+		for db, group in groups.items():
+			for i in range(0, len(group), self.chunk):
+				db.write_batch(group[i:i + self.chunk], self.transaction)
+
+
+class scope (object):
+	""" Models registry (identity map) scope. Models initialized within
+	scope context are registered in the scope so concurrent requests (with
+	own scopes) do not share model instances. Default scope is used outside
+	of scope contexts. Scope with *shared* flag falls back to process-wide
+	layer (scope.shared_layer) for models not found in it: they are copied
+	into the scope on first access so changes never leak between scopes. """
+
+	_stack = ContextStack('redisca2_scope') # Active scopes.
 
+	def __init__ (self, shared=False):
+		self.shared = shared
+		self.registries = dict() # Model class -> {id -> model}.
+		self.tokens = list()
+
+	def __enter__ (self):
+		self.tokens.append(self._stack.push(self))
+		return self
+
+	def __exit__ (self, exc_type, exc_value, traceback):
+		self._stack.pop(self.tokens.pop())
+
+	@classmethod
+	def current (cls):
+		""" Return innermost active scope or default one. """
+
+		current = cls._stack.top()
+		return cls.default if current is None else current
+
+	def registry (self, model_cls):
+		""" Return id -> model dict of given class. """
+
+		try:
+			return self.registries[model_cls]
+
+		except KeyError:
+			return self.registries.setdefault(model_cls, dict())
+
+	def lookup (self, model_cls, model_id):
+		""" Return registered model or None. """
+
+		registry = self.registry(model_cls)
+
+		if model_id in registry:
+			return registry[model_id]
+
+		if self.shared:
+			model = scope.shared_layer.registry(model_cls).get(model_id)
+
+			if model is not None:
+				model = registry[model_id] = model._copy()
+
+			return model
+
+		return None
+
+
+scope.default = scope()
+scope.shared_layer = scope()
+
+
+class Expr (object):
+	""" Base class of query expressions. Acts like list of result models. """
+
+	def __init__ (self, model_cls):
 		self.limit = None
 		self.offset = 0
 		self.models = None
-		self.operator = operator
-		self.model_cls = field.owner
-		self.field = field
-		self.val = val
+		self.paths = list()
+		self.model_cls = model_cls
 
 	def __len__ (self):
 		self.load()
@@ -75,12 +252,39 @@ class BExpr (object):
 		self.load()
 		return item in self.models
 
+	def __and__ (self, other):
+		return AndExpr(self, other)
+
 	def loaded (self):
 		return self.models is not None
 
 	def unload (self):
 		self.models = None
 
+	def prefetch (self, *paths):
+		""" Tell that result models and references by given paths should be
+		loaded with the result. See Model.prefetch(). Return self. """
+
+		self.paths.extend(paths)
+		return self
+
+	def iter (self, chunk=1000):
+		""" Iterate over result loading it page by page (*chunk* models per
+		request). Models are not stored in expression. """
+		return self.model_cls.getdb().iter(self, chunk)
+
+	def sample (self, count=1, hydrate=False):
+		""" Return list of up to *count* distinct random result models without
+		loading whole result. Models (and prefetch paths) are loaded using
+		single pipe per connector and nesting level if hydrate flag is set. """
+
+		models = self.model_cls.getdb().sample(self, count)
+
+		if hydrate:
+			self.model_cls.prefetch(models, *self.paths)
+
+		return models
+
 	def load (self):
 		""" Load result into expression. """
 
@@ -89,14 +293,126 @@ class BExpr (object):
 
 		self.models = self.model_cls.getdb().find(self)
 
+		if len(self.paths):
+			self.model_cls.prefetch(self.models, *self.paths)
+
+
+class BExpr (Expr):
+	""" Binary expression: field, operator and value. """
+
+	EQ = '='
+	GT = '>'
+	LT = '<'
+	GE = '>='
+	LE = '<='
+	SW = 'startswith'
+
+	def __init__ (self, operator, field, val):
+		assert isinstance(field, Field)
+
+		super(BExpr, self).__init__(field.owner)
+
+		self.operator = operator
+		self.field = field
+		self.val = val
+
+
+class AndExpr (Expr):
+	""" Conjunction of binary expressions of the same model class. Composite
+	index is used if model has a matching one. """
+
+	def __init__ (self, *exprs):
+		self.exprs = list()
+
+		for expr in exprs:
+			if isinstance(expr, AndExpr):
+				self.exprs.extend(expr.exprs)
+
+			else:
+				assert isinstance(expr, BExpr)
+				self.exprs.append(expr)
+
+		super(AndExpr, self).__init__(self.exprs[0].model_cls)
+
+		for expr in self.exprs:
+			assert expr.model_cls is self.model_cls
+
+
+class Index (object):
+	""" Composite index declaration. Leading fields are matched exactly, the
+	last one must be range indexed and is used as score (and sort order).
+	Use it in model *indexes* list: indexes = [Index('status', 'created')]. """
+
+	def __init__ (self, *names):
+		assert len(names) > 1
+
+		self.names = names
+
+	def getfields (self, model_cls):
+		""" Return list of index fields of given model class. """
+
+		fields = model_cls.getfields()
+
+		for name in self.names:
+			if name not in fields:
+				raise Exception('%s has no field %s' % (model_cls.__name__, name))
+
+		return [fields[name] for name in self.names]
+
+	def match (self, expr):
+		""" Return (exact values, score expression or None) of given AndExpr
+		if it can be served by this index or None otherwise. """
+
+		exact = dict()
+		score = list()
+
+		for sub in expr.exprs:
+			if sub.field is expr.model_cls.getfields().get(self.names[-1]):
+				score.append(sub)
+
+			elif sub.operator == BExpr.EQ and sub.field.name not in exact:
+				exact[sub.field.name] = sub
+
+			else:
+				return None
+
+		fields = self.getfields(expr.model_cls)
+
+		if len(score) > 1 or len(exact) != len(fields) - 1:
+			return None
+
+		vals = list()
+
+		for field in fields[:-1]:
+			if field.name not in exact:
+				return None
+
+			vals.append(field.to_db(exact[field.name].val))
+
+		return vals, score[0] if len(score) else None
+
 
 class Field (object):
-	def __init__ (self, name, index=False, unique=False, new=None, none=None):
+	version = False # Model version field.
+
+	def __init__ (self, name, index=False, unique=False, new=None, none=None,
+		deferred=False, compress=None, codec='zlib'):
+
+		if deferred or compress is not None:
+			assert not index and not unique
+
+		if compress is not None:
+			assert codec in CODECS
+
 		self.new = new
 		self.index = bool(index)
+		self.lex = index == 'lex'
 		self.unique = bool(unique)
 		self.name = name
 		self.none = none
+		self.deferred = bool(deferred)
+		self.compress = compress
+		self.codec = codec
 
 	def __get__ (self, model, owner):
 		self.owner = owner
@@ -104,12 +420,12 @@ class Field (object):
 		if model is None:
 			return self
 
-		return self.from_db(model[self.name]) \
+		return self.from_db(self.unpack(model[self.name])) \
 			if self.name in model else self.none
 
 	def __set__ (self, model, value):
 		""" Warning: do not overwrite it in custom fields! """
-		model[self.name] = None if value is None else self.to_db(value)
+		model[self.name] = None if value is None else self.pack(self.to_db(value))
 
 	def __lt__ (self, other):
 		return BExpr(operator=BExpr.LT, field=self, val=other)
@@ -132,6 +448,86 @@ class Field (object):
 	def to_db (self, val):
 		return str(val) if PY3K else unicode(val)
 
+	def overrides (self, cls, name):
+		""" Check if field class overrides method *name* of built-in field
+		class *cls* (so batch fast paths of cls do not apply). """
+		return getattr(type(self), name) != getattr(cls, name)
+
+	def to_db_many (self, vals):
+		""" Return list of database values of given ones (None is kept).
+		Built-in fields override it with batch fast paths (used only if
+		to_db() is not overridden, see overrides()). """
+		return [None if val is None else self.to_db(val) for val in vals]
+
+	def from_db_many (self, vals):
+		""" Return list of values of given database ones (*none* value if
+		missing). """
+		return [self.none if val is None else self.from_db(val) for val in vals]
+
+	def column (self, vals):
+		""" Return numpy array of given database values (None if missing)
+		converted at once. Object array of from_db_many() result by default. """
+
+		numpy = optional('numpy', 'to_columns()')
+
+		if self.compress is not None:
+			vals = [None if val is None else self.unpack(val) for val in vals]
+
+		# Filled item by item so nested values (e.g. lists) stay objects.
+		column = numpy.empty(len(vals), dtype=object)
+
+		for i, val in enumerate(self.from_db_many(vals)):
+			column[i] = val
+
+		return column
+
+	def pack (self, val):
+		""" Compress database value if its size reaches *compress* bytes. """
+
+		if self.compress is None:
+			return val
+
+		if type(val) is (str if PY3K else unicode):
+			data = val.encode('utf-8')
+
+		elif type(val) is bytes:
+			data = val
+
+		else:
+			return val
+
+		return compress(data, self.codec) if len(data) >= self.compress else val
+
+	def unpack (self, val):
+		""" Decompress value packed by pack(). """
+		return val if self.compress is None else decompress(val)
+
+
+class Collection (Abstract):
+	""" Base class of fields stored in their own keys (e.g. lists or sets).
+	Reads are done on access, changes are collected as pending commands and
+	written by model save(). Item field converts collection items. """
+
+	def __init__ (self, name, item=None):
+		self.name = name
+		self.item = Field(name) if item is None else item
+
+	def __get__ (self, model, owner):
+		self.owner = owner
+
+		if model is None:
+			return self
+
+		return self.bind(model)
+
+	def __set__ (self, model, value):
+		""" Replace collection contents on save. """
+		self.bind(model).replace(value)
+
+	@abstractmethod
+	def bind (self, model):
+		""" Return collection accessor bound to given model. """
+
 
 known_classes = dict()
 
@@ -141,8 +537,10 @@ class MetaModel (type):
 		cls = super(MetaModel, mcs).__new__(mcs, name, bases, dct)
 		known_classes[name] = cls # Known classes registry.
 
-		cls._objects = dict() # id -> model objects registry.
 		cls._fields = dict()
+		cls._collections = dict()
+		cls._deferred = set() # Deferred fields hash names.
+		cls._version = None # Version field attribute name.
 
 		for name in dir(cls):
 			member = getattr(cls, name)
@@ -150,12 +548,39 @@ class MetaModel (type):
 			if isinstance(member, Field):
 				cls._fields[name] = member
 
+				if member.deferred:
+					cls._deferred.add(member.name)
+
+				if member.version:
+					cls._version = name
+
+			elif isinstance(member, Collection):
+				cls._collections[name] = member
+
 		return cls
 
+	@property
+	def _objects (cls):
+		""" Return id -> model objects registry of current scope. """
+		return scope.current().registry(cls)
+
+	@_objects.setter
+	def _objects (cls, val):
+		scope.current().registries[cls] = val
+
 	def __setattr__ (cls, name, val):
 		if isinstance(val, Field):
 			cls._fields[name] = val
 
+			if val.deferred:
+				cls._deferred.add(val.name)
+
+			if val.version:
+				cls._version = name
+
+		elif isinstance(val, Collection):
+			cls._collections[name] = val
+
 		super(MetaModel, cls).__setattr__(name, val)
 
 	def __call__ (cls, model_id, *args, **kw):
@@ -168,11 +593,15 @@ class MetaModel (type):
 		else:
 			model_id = str(model_id)
 
-		if model_id not in cls._objects:
-			cls._objects[model_id] = object.__new__(cls)
-			cls._objects[model_id].__init__(model_id, *args, **kw)
+		current = scope.current()
+		model = current.lookup(cls, model_id)
 
-		return cls._objects[model_id]
+		if model is None:
+			model = object.__new__(cls)
+			current.registry(cls)[model_id] = model
+			model.__init__(model_id, *args, **kw)
+
+		return model
 
 
 if PY3K:
@@ -188,9 +617,13 @@ class Model (BaseModel):
 	def __init__ (self, model_id, must_exist=False, force_load=False):
 		self._id = model_id
 		self._exists = None
+		self._create = False # Save only if not exists.
 		self._diff = dict() # Local changes.
 		self._dels = set()  # Removed field names.
+		self._ops = list()  # Pending collections commands.
 		self._data = None   # Data from database.
+		self._lazy = dict() # Loaded deferred values.
+		self._parsed = dict() # Hash name -> (field, raw, value) parsed values.
 
 		if force_load:
 			self.load()
@@ -211,6 +644,9 @@ class Model (BaseModel):
 		if name in self._diff:
 			return True
 
+		if name in self.getdeferred():
+			return self._getlazy(name) is not None
+
 		self.load()
 		return name in self._data
 
@@ -221,6 +657,14 @@ class Model (BaseModel):
 		if name in self._diff:
 			return self._diff[name]
 
+		if name in self.getdeferred():
+			val = self._getlazy(name)
+
+			if val is None:
+				raise KeyError(name)
+
+			return val
+
 		self.load()
 		return self._data[name]
 
@@ -256,6 +700,227 @@ class Model (BaseModel):
 
 		return instances
 
+	@classmethod
+	def bulk_load (cls, rows, chunk=5000, ttl=None, validate=True, callback=None):
+		""" Save rows (dicts of field name -> value with optional 'id' key)
+		using chunked non-transactional pipes. Values are converted with
+		field.to_db() unless validate is False. Rows with existing ids update
+		stored models (loaded by single pipe per chunk so their old index
+		entries are removed), new models get field.new values (unless
+		validate is False so rows are saved as is). Models are not put into
+		registry and unique constraints are not checked.
+		Callback is called after each chunk with (saved count, seconds).
+		Return saved models count. """
+
+		db = cls.getdb()
+		started = time()
+		group = list()
+		count = 0
+
+		for row in rows:
+			group.append(row)
+
+			if len(group) >= chunk:
+				db.save_many(cls._bulk_models(group, validate), ttl)
+				count += len(group)
+				group = list()
+
+				if callback is not None:
+					callback(count, time() - started)
+
+		if len(group):
+			db.save_many(cls._bulk_models(group, validate), ttl)
+			count += len(group)
+
+			if callback is not None:
+				callback(count, time() - started)
+
+		return count
+
+	@classmethod
+	def _bulk_models (cls, rows, validate=True):
+		""" Return detached models of given bulk_load() rows. Values are
+		converted column by column using field.to_db_many(). """
+
+		fields = cls.getfields()
+		models = list()
+		columns = dict() # Field name -> (models, values).
+
+		stored = list() # Models which may exist.
+
+		for row in rows:
+			if 'id' in row:
+				model = cls._detached(row['id'])
+				model._exists = None
+				model._data = None
+				stored.append(model)
+
+			else:
+				model = cls._detached(hexid())
+
+			models.append(model)
+
+			for name, val in row.items():
+				if name == 'id':
+					continue
+
+				if name not in fields:
+					raise Exception('%s has no field %s' % (cls.__name__, name))
+
+				column = columns.setdefault(name, (list(), list()))
+				column[0].append(model)
+				column[1].append(val)
+
+		if len(stored):
+			cls.getdb().load_many(stored)
+
+		for model in models:
+			if validate and not model._exists:
+				model.fill_new()
+
+		for name, (group, vals) in columns.items():
+			field = fields[name]
+
+			if not validate and getattr(field, 'flat', False):
+				# Raw flat Json value is dict of its hash keys values.
+				for model, val in zip(group, vals):
+					val = val or dict()
+
+					for key in field.getraw(model) or dict():
+						if key not in val:
+							del model[field.subkey(key)]
+
+					for key, sub in val.items():
+						model[field.subkey(key)] = decode_raw(sub)
+
+			elif not validate:
+				for model, val in zip(group, vals):
+					val = decode_raw(val)
+					model[field.name] = None if val is None else field.pack(val)
+
+			elif getattr(field, 'flat', False):
+				# Flat Json is split into several hash keys by its __set__.
+				for model, val in zip(group, vals):
+					setattr(model, name, val)
+
+			else:
+				for model, val in zip(group, field.to_db_many(vals)):
+					model[field.name] = None if val is None else field.pack(val)
+
+		return models
+
+	@classmethod
+	def dump (cls, fields=None, chunk=1000):
+		""" Yield all models data as newline terminated JSON lines. Each line
+		is an object with 'id' key and raw (database) values of given fields
+		(all by default). Deferred values are read from their side keys and
+		flat Json ones are dicts of their hash keys values. Compressed values
+		are decompressed, binary ones are base64 encoded (see encode_raw()).
+		Models are not put into registry. """
+
+		allfields = cls.getfields()
+
+		if fields is None:
+			fields = list(allfields)
+
+		for name in fields:
+			if name not in allfields:
+				raise Exception('%s has no field %s' % (cls.__name__, name))
+
+		flat = any(getattr(allfields[name], 'flat', False) for name in fields)
+		deferred = [allfields[name].name for name in fields if allfields[name].deferred]
+		names = [allfields[name].name for name in fields if not allfields[name].deferred]
+		db = cls.getdb()
+
+		for ids in db.scan(cls, chunk):
+			# Flat Json keys are not known in advance so whole hashes are read.
+			rows = db.getmany(cls, ids, None if flat else names)
+			pairs = [(cls._detached(model_id), name) for model_id in ids for name in deferred]
+			lazy = iter(db.get_deferred(pairs) if len(pairs) else list())
+
+			for model_id, data in zip(ids, rows):
+				row = {'id': model_id}
+
+				for name in fields:
+					field = allfields[name]
+
+					if field.deferred:
+						val = next(lazy)
+
+					elif getattr(field, 'flat', False):
+						prefix = field.name + '.'
+						val = dict((key[len(prefix):], encode_raw(sub)) \
+							for key, sub in data.items() if key.startswith(prefix)) or None
+
+					else:
+						val = data.get(field.name)
+
+					if val is not None and not isinstance(val, dict):
+						val = encode_raw(field.unpack(val))
+
+					if val is not None:
+						row[name] = val
+
+				yield dumps(row) + '\n'
+
+	@classmethod
+	def sample (cls, count=1, hydrate=False):
+		""" Return list of up to *count* distinct random model instances.
+		Models are loaded using single pipe if hydrate flag is set. """
+
+		models = cls.getdb().sample_all(cls, count)
+
+		if hydrate:
+			cls.load_many(models)
+
+		return models
+
+	@classmethod
+	def to_columns (cls, source=None, fields=None, chunk=1000, dataframe=False):
+		""" Return dict of field name -> numpy array (plus 'id' array) of
+		models given by ids or expression (all models by default). Values
+		are fetched by pipelined HMGET (*chunk* models per pipe) and each
+		column is converted at once (see Field.column()). Return pandas
+		DataFrame indexed by id if dataframe flag is set. Models are not put
+		into registry (unless expression is given). """
+
+		numpy = optional('numpy', 'to_columns()')
+		pandas = optional('pandas', 'to_columns(dataframe=True)') if dataframe else None
+
+		allfields = cls.getfields()
+
+		if fields is None:
+			fields = sorted(name for name, field in allfields.items() \
+				if not field.deferred)
+
+		for name in fields:
+			if name not in allfields or allfields[name].deferred:
+				raise Exception('%s has no (not deferred) field %s' % (cls.__name__, name))
+
+		db = cls.getdb()
+
+		if source is None:
+			ids = [model_id for ids in db.scan(cls, chunk) for model_id in ids]
+
+		elif isinstance(source, Expr):
+			ids = [model.getid() for model in source.iter(chunk)]
+
+		else:
+			ids = [str(model_id) for model_id in source]
+
+		names = [allfields[name].name for name in fields]
+		columns = dict()
+
+		for name, vals in zip(fields, db.getcolumns(cls, ids, names, chunk)):
+			columns[name] = allfields[name].column(vals)
+
+		if dataframe:
+			return pandas.DataFrame(columns, columns=fields, \
+				index=pandas.Index(ids, name='id'))
+
+		columns['id'] = numpy.array(ids, dtype=object)
+		return columns
+
 	@classmethod
 	def count_all (cls):
 		""" Return all model instances count. """
@@ -275,6 +940,10 @@ class Model (BaseModel):
 			if name in self._diff:
 				return self._diff[name]
 
+		if name in self.getdeferred():
+			val = self._getlazy(name)
+			return default if val is None else val
+
 		if lite and not self.loaded():
 			return self.getdb().get(
 				model=self,
@@ -323,6 +992,8 @@ class Model (BaseModel):
 		""" Revert local changes. """
 		self._diff = dict()
 		self._dels = set()
+		self._ops = list()
+		self._parsed = dict()
 
 	def getdiff (self):
 		return self._diff.copy()
@@ -335,11 +1006,74 @@ class Model (BaseModel):
 		except:
 			return conf.db
 
+	@classmethod
+	def getindexes (cls):
+		""" Return list of composite indexes. """
+		return list(getattr(cls, 'indexes', ()))
+
+	@classmethod
+	def getlayout (cls):
+		""" Return exact indexes storage layout: 'sets' (set per value) or
+		'compact' (value -> id hashes, see getbuckets(), per unique field and
+		set per value of non-unique field). """
+
+		try:
+			return cls._layout
+
+		except AttributeError:
+			return 'sets'
+
+	@classmethod
+	def getbuckets (cls):
+		""" Return count of hashes per unique field of compact layout. """
+
+		try:
+			return cls._buckets
+
+		except AttributeError:
+			return 1024
+
+	@classmethod
+	def getstream (cls):
+		""" Return (changes stream key, approximate max length or None) tuple
+		or None if changes are not streamed. """
+
+		try:
+			return cls._stream
+
+		except AttributeError:
+			return None
+
+	@classmethod
+	def getttl (cls):
+		""" Return default time to live (in seconds) or None. """
+
+		try:
+			return cls._ttl
+
+		except AttributeError:
+			return None
+
 	@classmethod
 	def getfields (cls):
 		""" Return name -> field dict of registered fields. """
 		return cls._fields.copy()
 
+	@classmethod
+	def getdeferred (cls):
+		""" Return set of deferred fields hash names. """
+		return cls._deferred
+
+	@classmethod
+	def getversion (cls):
+		""" Return version field or None. """
+		return None if cls._version is None else cls._fields[cls._version]
+
+	@classmethod
+	def getcollections (cls):
+		""" Return name -> collection dict of registered collections. """
+		return cls._collections.copy()
+
 	def getid (self):
 		return self._id
 
@@ -351,21 +1085,30 @@ class Model (BaseModel):
 		return Model._cls2prefix[cls]
 
 	@classmethod
-	def new (cls, model_id=None):
+	def new (cls, model_id=None, optimistic=False):
 		""" Return new model with given id and field.new values.
-		If model id is None hexid() will be used instead.
-		Exception raised if model already exists.
+		If model id is None hexid() will be used instead (existence check is
+		skipped in this case unless optimistic flag is set, see IdGenerator
+		about worker id collisions). Exception raised if model already exists.
+
+		Optimistic flag tells that existence check should be done by the first
+		save() atomically (Exception raised there on conflict) instead of
+		separate request here.
 
 		Notice: if model with such id was initialized previously (already in
 		registry) this method will overwrite it with field.new values. """
 
-		if model_id is None:
-			model_id = hexid()
+		if model_id is None or optimistic:
+			model = cls(hexid() if model_id is None else model_id)
+			model._create = model_id is not None or optimistic
+			model._exists = False
+			model._data = dict()
 
-		model = cls(model_id)
+		else:
+			model = cls(model_id)
 
-		if model.exists():
-			raise Exception('%s(%s) already exists' % (cls.__name__, model_id))
+			if model.exists():
+				raise Exception('%s(%s) already exists' % (cls.__name__, model_id))
 
 		return model.fill_new()
 
@@ -376,8 +1119,11 @@ class Model (BaseModel):
 			if field.new is None:
 				continue
 
-			val = field.new() if isfunction(field.new) or \
-				ismethod(field.new) or isbuiltin(field.new) else field.new
+			val = field.new() if isinstance(field.new, (
+				BuiltinFunctionType,
+				FunctionType,
+				MethodType,
+			)) else field.new
 
 			setattr(self, name, val)
 
@@ -396,6 +1142,105 @@ class Model (BaseModel):
 
 		return data
 
+	@classmethod
+	def load_many (cls, models):
+		""" Load given models using single pipe per connector. Each model
+		is requested once even if it is given several times. """
+
+		groups = dict()
+		seen = set()
+
+		for model in models:
+			if not model.loaded() and id(model) not in seen:
+				seen.add(id(model))
+				groups.setdefault(model.getdb(), list()).append(model)
+
+		for db, group in groups.items():
+			db.load_many(group)
+
+	@classmethod
+	def prefetch (cls, models, *paths):
+		""" Load given models and models referenced by given paths of
+		reference fields names (e.g. 'author', 'author.lang'). Each nesting
+		level is loaded using single pipe per connector. Return models. """
+
+		tree = dict()
+
+		for path in paths:
+			node = tree
+
+			for name in path.split('.'):
+				node = node.setdefault(name, dict())
+
+		level = [(list(models), tree)]
+		lazy = list()
+
+		while len(level):
+			cls.load_many([model for group, _ in level for model in group])
+			nextlevel = list()
+
+			for group, node in level:
+				for name, subnode in node.items():
+					refs = list()
+					seen = set()
+
+					for model in group:
+						field = model.getfields().get(name)
+
+						if not isinstance(field, Field):
+							raise Exception('%s has no field %s' % (
+								model.__class__.__name__,
+								name,
+							))
+
+						if field.deferred:
+							lazy.append((model, field.name))
+							continue
+
+						ref = getattr(model, name)
+
+						if ref is None:
+							continue
+
+						if not isinstance(ref, Model):
+							raise Exception('%s.%s is not a reference' % (
+								model.__class__.__name__,
+								name,
+							))
+
+						if id(ref) not in seen:
+							seen.add(id(ref))
+							refs.append(ref)
+
+					nextlevel.append((refs, subnode))
+
+			level = nextlevel
+
+		cls._load_lazy(lazy)
+		return models
+
+	@classmethod
+	def load_deferred (cls, models, *names):
+		""" Load given deferred fields (attribute names) of given models using
+		single request per connector. Use prefetch() to load deferred fields
+		of referenced models too. """
+
+		pairs = list()
+
+		for model in models:
+			fields = model.getfields()
+
+			for name in names:
+				if name not in fields or not fields[name].deferred:
+					raise Exception('%s.%s is not deferred field' % (
+						model.__class__.__name__,
+						name,
+					))
+
+				pairs.append((model, fields[name].name))
+
+		cls._load_lazy(pairs)
+
 	def load (self):
 		""" Load data into hash if needed. """
 
@@ -416,40 +1261,172 @@ class Model (BaseModel):
 	def unload (self):
 		""" Unload model data. """
 		self._data = None
+		self._lazy = dict()
 
 	def delete (self, pipe=None):
+		""" Delete model within optionally given pipe (or current batch). """
+
+		if pipe is None and batch.current() is not None:
+			batch.current().add(self, 'delete')
+			return
+
 		if self._exists is not False:
 			self.getdb().delete(self, pipe)
-			self._exists = False
 
-		self._data = dict()
-		self.revert()
+		self._deleted()
+
+	def save (self, pipe=None, ttl=None, cas=False, merge=None, retries=3):
+		""" Save local changes within optionally given pipe (or current
+		batch). Model expires in *ttl* seconds (class ttl is used by
+		default), given ttl is applied even if there are no changes.
+		Optimistically created model (see new()) can not be saved within
+		external pipe since its conflict is known after execution only.
+
+		CAS flag tells that changes should be saved (immediately) only if
+		model version field is not changed since model was loaded. On
+		conflict model is reloaded (local changes are reverted) and merge
+		callback is called with model and dict of reverted changes (hash
+		name -> value, None if deleted) to reapply them. Exception raised
+		if there is no merge callback or retries limit is reached. """
+
+		# Detect in-place changes of parsed values.
+		for field, raw, val in list(self._parsed.values()):
+			field.sync(self)
+
+		if not len(self._diff) and not len(self._dels) and not len(self._ops):
+			# Nothing to save but expiration may be refreshed.
+			if ttl is not None and pipe is None and batch.current() is not None:
+				batch.current().add(self, 'save', ttl)
+
+			elif ttl is not None:
+				self.expire(ttl, pipe)
 
-	def save (self, pipe=None):
-		if not len(self._diff) and not len(self._dels):
 			return
 
-		self.getdb().save(self, pipe)
+		if ttl is None:
+			ttl = self.getttl()
 
-		if self.loaded():
-			self._data.update(self._diff)
+		if cas:
+			assert pipe is None
+			return self._save_cas(ttl, merge, retries)
 
-			for name in self._dels:
-				if name in self._data:
-					del self._data[name]
+		if pipe is None and batch.current() is not None:
+			batch.current().add(self, 'save', ttl)
+			return
+
+		if self._create and pipe is not None:
+			raise Exception('%s(%s) is created optimistically, save it without pipe' % (
+				self.__class__.__name__,
+				self._id,
+			))
+
+		self.getdb().save(self, pipe, ttl)
+		self._saved()
+
+	def _save_cas (self, ttl, merge, retries):
+		""" Compare-and-set save loop. See save(). """
+
+		field = self.getversion()
+
+		if field is None:
+			raise Exception('%s has no version field' % self.__class__.__name__)
+
+		attempt = 0
+
+		while True:
+			# Expected version is the one data was loaded with.
+			self.load()
+			expected = self._data.get(field.name)
+
+			self[field.name] = field.to_db(int(expected or 0) + 1)
+
+			if self.getdb().save_cas(self, field, expected, ttl):
+				self._saved()
+				return
+
+			changes = self.getdiff()
+			changes.pop(field.name)
+			changes.update((name, None) for name in self._dels)
+
+			ops = self._ops
+			self.revert()
+			self.unload()
+			self._ops = ops
+
+			if merge is None or attempt >= retries:
+				raise Exception('%s(%s) version conflict' % (
+					self.__class__.__name__,
+					self._id,
+				))
+
+			attempt += 1
+			merge(self, changes)
+
+	def _saved (self):
+		""" Apply saved local changes to model state. """
+
+		version = self.getversion()
+
+		# Version is incremented by database. Keep the expected one locally
+		# so stale data can not be saved by CAS later.
+		if version is not None and version.name not in self._diff and self.loaded():
+			self._data[version.name] = str(int(self._data.get(version.name) or 0) + 1)
+
+		deferred = self.getdeferred()
+
+		for name, val in self._diff.items():
+			if name in deferred:
+				self._lazy[name] = val
+
+			elif self.loaded():
+				self._data[name] = val
 
+		for name in self._dels:
+			if name in deferred:
+				self._lazy[name] = None
+
+			elif self.loaded() and name in self._data:
+				del self._data[name]
+
+		# Parsed values are still actual.
 		self._exists = True
+		self._create = False
+		self._diff = dict()
+		self._dels = set()
+		self._ops = list()
+
+	def _deleted (self):
+		""" Reset model state after deletion. """
+
+		self._exists = False
+		self._data = dict()
+		self._lazy = dict()
 		self.revert()
 
 	@classmethod
 	def save_all (cls, pipe=None):
-		""" Save all known models. Deleted models ignored by empty diff. """
+		""" Save all known models. Deleted models ignored by empty diff.
+		Exception raised (before anything is put into pipe) if external pipe
+		is given and there are optimistically created models, see save(). """
+
+		if cls is not Model and pipe is None and batch.current() is not None:
+			for model in cls._objects.values():
+				model.save()
+
+		elif cls is not Model:
+			if pipe is not None:
+				for model in cls._objects.values():
+					if model._create:
+						raise Exception('%s(%s) is created optimistically, save it without pipe' % (
+							cls.__name__,
+							model._id,
+						))
 
-		if cls is not Model:
 			_pipe = cls.getdb().getpipe(pipe)
 
+			# Optimistic creates are checked (and saved) immediately.
 			for model in cls._objects.values():
-				model.save(_pipe)
+				model.save(None if model._create else _pipe)
 
 			if pipe is None and len(_pipe):
 				_pipe.execute()
@@ -457,8 +1434,57 @@ class Model (BaseModel):
 		for child in cls.__subclasses__():
 			child.save_all()
 
+	@classmethod
+	def reindex (cls, name, workers=1, chunk=1000, delay=0, restart=False,
+		callback=None):
+		""" Rebuild index of given field for all existing models (e.g. after
+		index enabled). See connector's reindex() for details. """
+
+		return cls.getdb().reindex(
+			model_cls=cls,
+			name=name,
+			workers=workers,
+			chunk=chunk,
+			delay=delay,
+			restart=restart,
+			callback=callback,
+		)
+
+	@classmethod
+	def check_indexes (cls, repair=False, chunk=1000, callback=None):
+		""" Find (and optionally fix) missing and orphan index entries.
+		See connector's check_indexes() for details. """
+
+		return cls.getdb().check_indexes(
+			model_cls=cls,
+			repair=repair,
+			chunk=chunk,
+			callback=callback,
+		)
+
+	def expire (self, ttl, pipe=None):
+		""" Set model to expire in *ttl* seconds without saving local
+		changes. Done immediately or within given pipe (current batch is
+		not used, call save(ttl=...) within batch instead). """
+		self.getdb().expire(self, ttl, pipe)
+
+	def persist (self, pipe=None):
+		""" Remove model expiration. See expire(). """
+		self.getdb().expire(self, None, pipe)
+
+	@classmethod
+	def sweep (cls, batch=1000):
+		""" Remove expired models and their index entries.
+		Return number of removed models. """
+		return cls.getdb().sweep(cls, batch)
+
 	def free (self):
-		del self.__class__._objects[self._id]
+		""" Unregister model instance (if registered in current scope). """
+
+		registry = self.__class__._objects
+
+		if registry.get(self._id) is self:
+			del registry[self._id]
 
 	@classmethod
 	def free_all (cls):
@@ -495,6 +1521,61 @@ class Model (BaseModel):
 
 		return subclasses
 
+	@classmethod
+	def _detached (cls, model_id):
+		""" Return new model which is not put into registry. """
+
+		model = object.__new__(cls)
+		model.__init__(str(model_id))
+		model._exists = False
+		model._data = dict()
+
+		return model
+
+	def _copy (self):
+		""" Return not registered model with copy of loaded state (local
+		changes are not copied). """
+
+		model = object.__new__(self.__class__)
+		model.__init__(self._id)
+		model._exists = self._exists
+		model._data = None if self._data is None else dict(self._data)
+		model._lazy = dict(self._lazy)
+
+		return model
+
+	@classmethod
+	def _load_lazy (cls, pairs):
+		""" Load deferred values of given (model, hash name) pairs if not
+		loaded yet using single request per connector. """
+
+		groups = dict()
+		seen = set()
+
+		for model, name in pairs:
+			if name in model._lazy or (id(model), name) in seen:
+				continue
+
+			seen.add((id(model), name))
+
+			if model._exists is False:
+				model._lazy[name] = None
+
+			else:
+				groups.setdefault(model.getdb(), list()).append((model, name))
+
+		for db, group in groups.items():
+			for (model, name), val in zip(group, db.get_deferred(group)):
+				model._lazy[name] = val
+
+	def _getlazy (self, name):
+		""" Return deferred value (None if missing). """
+
+		if name not in self._lazy:
+			self._load_lazy([(self, name)])
+
+		return self._lazy[name]
+
 	def _load (self, data):
 		""" Load given data into model. """
 		assert type(data) is dict
@@ -505,3 +1586,30 @@ class Model (BaseModel):
 		for k in self._data:
 			if k in self._diff and self._data[k] == self._diff[k]:
 				del self._diff[k]
+
+
+def gather (*exprs, **kwargs):
+	""" Load results of given expressions using single pipe per connector.
+	Result models are loaded too (in the second pipe) if *hydrate* flag is
+	set. Return list of expressions. """
+
+	hydrate = kwargs.pop('hydrate', False)
+	assert not kwargs
+
+	groups = dict()
+
+	for expr in exprs:
+		if not expr.loaded():
+			groups.setdefault(expr.model_cls.getdb(), list()).append(expr)
+
+	for db, group in groups.items():
+		db.gather(group)
+
+	if hydrate:
+		Model.load_many([model for expr in exprs for model in expr.models])
+
+	for expr in exprs:
+		if len(expr.paths):
+			expr.model_cls.prefetch(expr.models, *expr.paths)
+
+	return list(exprs)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -
+
+""" Command line tools. Run *redisca2 --help* for details. """
+
+from argparse import (
+	ArgumentParser,
+)
+
+from importlib import (
+	import_module,
+)
+
+from sys import (
+	exit,
+	stderr,
+)
+
+from .base import (
+	conf,
+)
+
+
+def getcls (path):
+	""" Return model class by 'package.module:Class' path. """
+
+	module, _, name = path.partition(':')
+
+	if not name:
+		raise Exception('Model path must look like package.module:Class')
+
+	return getattr(import_module(module), name)
+
+
+def progress (count, cursor):
+	stderr.write('%d models processed (cursor %d)\n' % (count, cursor))
+
+
+def reindex (args):
+	count = getcls(args.model).reindex(
+		name=args.field,
+		workers=args.workers,
+		chunk=args.chunk,
+		delay=args.delay,
+		restart=args.restart,
+		callback=None if args.quiet else progress,
+	)
+
+	print('%d models reindexed' % count)
+
+
+def getparser ():
+	parser = ArgumentParser(prog='redisca2')
+
+	parser.add_argument('--host', help='redis host (overrides conf.db)')
+	parser.add_argument('--port', type=int, help='redis port (overrides conf.db)')
+	parser.add_argument('--db', type=int, help='redis database (overrides conf.db)')
+
+	commands = parser.add_subparsers(dest='command')
+
+	parser_reindex = commands.add_parser(
+		'reindex',
+		help='rebuild field index for all existing models',
+	)
+
+	parser_reindex.add_argument('model', help='package.module:Class')
+	parser_reindex.add_argument('field', help='model field name')
+	parser_reindex.add_argument('--workers', type=int, default=1)
+	parser_reindex.add_argument('--chunk', type=int, default=1000)
+	parser_reindex.add_argument('--delay', type=float, default=0, help='seconds to sleep after each chunk')
+	parser_reindex.add_argument('--restart', action='store_true', help='ignore stored checkpoint')
+	parser_reindex.add_argument('--quiet', action='store_true')
+	parser_reindex.set_defaults(handler=reindex)
+
+	return parser
+
+
+def main (argv=None):
+	parser = getparser()
+	args = parser.parse_args(argv)
+
+	if args.command is None:
+		parser.print_help()
+		return 1
+
+	kw = dict()
+
+	for name in ('host', 'port', 'db'):
+		if getattr(args, name) is not None:
+			kw[name] = getattr(args, name)
+
+	if len(kw):
+		from .contrib.redis import RedisConnector
+		conf.db = RedisConnector(**kw)
+
+	args.handler(args)
+	return 0
+
+
+if __name__ == '__main__':
+	exit(main())
@@ -1,9 +1,43 @@
 # -*- coding: utf-8 -
 
-from .redis import (
-	RedisConnector,
+from importlib import (
+	import_module,
 )
 
-from .flask import (
-	FlaskRedisca,
+from sys import (
+	version_info,
 )
+
+
+# Backend name -> module. Backends are imported on first access.
+BACKENDS = {
+	'RedisConnector': 'redisca2.contrib.redis',
+	'StreamConsumer': 'redisca2.contrib.redis',
+	'FlaskRedisca': 'redisca2.contrib.flask',
+}
+
+__all__ = sorted(BACKENDS)
+
+
+if version_info >= (3, 7):
+	def __getattr__ (name):
+		if name not in BACKENDS:
+			raise AttributeError("module 'redisca2.contrib' has no attribute '%s'" % name)
+
+		val = getattr(import_module(BACKENDS[name]), name)
+		globals()[name] = val
+
+		return val
+
+	def __dir__ ():
+		return sorted(set(globals()) | set(BACKENDS))
+
+else:
+	from .redis import (
+		RedisConnector,
+		StreamConsumer,
+	)
+
+	from .flask import (
+		FlaskRedisca,
+	)
@@ -2,7 +2,9 @@
 
 from redisca2.base import (
 	Model,
+	batch,
 	conf,
+	scope,
 )
 
 from .redis import (
@@ -11,8 +13,13 @@ from .redis import (
 
 
 class FlaskRedisca (object):
-	def __init__ (self, app=None, autosave=False):
+	""" Each request gets own models registry scope. Use *shared* flag to
+	fall back to process-wide layer (see scope.shared_layer). Autosave
+	writes changed models of the request by single batch. """
+
+	def __init__ (self, app=None, autosave=False, shared=False):
 		self.autosave = autosave
+		self.shared = shared
 
 		if app is not None:
 			self.init_app(app)
@@ -21,10 +28,19 @@ class FlaskRedisca (object):
 		self.app = app
 
 		conf.db = RedisConnector(**self.app.config['REDISCA'])
+		self.app.before_request(self.before_request)
 		self.app.teardown_request(self.after_request)
 
+	def before_request (self):
+		scope(shared=self.shared).__enter__()
+
 	def after_request (self, exc):
 		if exc is None and self.autosave:
-			Model.save_all()
+			with batch():
+				Model.save_all()
 
 		Model.free_all()
+		current = scope.current()
+
+		if current is not scope.default:
+			current.__exit__(None, None, None)
@@ -4,13 +4,43 @@ from __future__ import (
 	absolute_import,
 )
 
+from contextlib import (
+	contextmanager,
+)
+
+from copy import (
+	copy,
+)
+
+from math import (
+	ceil,
+)
+
+from random import (
+	sample,
+)
+
+from time import (
+	sleep,
+	time,
+)
+
+from zlib import (
+	crc32,
+)
+
 from redis import (
+	ResponseError,
 	StrictRedis,
 )
 
 from redisca2.base import (
+	AndExpr,
 	BExpr,
 	Connector,
+	Expr,
+	Model,
+	conf,
 )
 
 from redisca2.fields import (
@@ -19,22 +49,271 @@ from redisca2.fields import (
 )
 
 from redisca2.utils import (
+	LRUCache,
 	PY3K,
+	hexid,
 )
 
 
 class RedisConnector (Connector):
+	# Run commands packed into ARGV (starting from index *start*) as
+	# (argc, command, args...) sequences.
+	REPLAY = """
+		local i = start
+
+		while i <= #ARGV do
+			local argc = tonumber(ARGV[i])
+			redis.call(unpack(ARGV, i + 1, i + argc))
+			i = i + argc + 1
+		end
+
+		return 1
+	"""
+
+	# Replay commands if KEYS[1] does not exist. Return 0 if it does.
+	CREATE_SCRIPT = """
+		if redis.call('EXISTS', KEYS[1]) == 1 then
+			return 0
+		end
+
+		local start = 1
+	""" + REPLAY
+
+	# Replay commands if KEYS[1] hash key ARGV[1] value (empty string if
+	# missing) is ARGV[2]. Return 0 otherwise.
+	CAS_SCRIPT = """
+		if (redis.call('HGET', KEYS[1], ARGV[1]) or '') ~= ARGV[2] then
+			return 0
+		end
+
+		local start = 3
+	""" + REPLAY
+
 	def __init__ (self, *args, **kw):
+		cache = kw.pop('cache', None)
+
 		self.handler = StrictRedis(*args, **kw)
+		self.cache = LRUCache(cache) if cache else None
+		self._create_script = self.handler.register_script(self.CREATE_SCRIPT)
+		self._cas_script = self.handler.register_script(self.CAS_SCRIPT)
 
 	def getkey (self, model):
 		return ':'.join((model.getprefix(), model.getid()))
 
+	def coll_key (self, model, name):
+		""" Return side key of model collection or deferred field. """
+		return ':'.join((model.getprefix(), model.getid(), name))
+
+	def get_deferred (self, pairs):
+		""" Return list of deferred values of given (model, hash name)
+		pairs using single MGET. """
+
+		keys = [self.coll_key(model, name) for model, name in pairs]
+		return [self.decode_val(val) for val in self.handler.mget(keys)]
+
+	def collection (self, model, name, command, *args):
+		""" Run read command on model collection key. """
+		return getattr(self.handler, command)(self.coll_key(model, name), *args)
+
 	def getpipe (self, pipe=None):
 		return self.handler.pipeline(transaction=True) if pipe is None else pipe
 
-	def save (self, model, pipe=None):
+	def save (self, model, pipe=None, ttl=None, check=True):
+		if model._create:
+			return self.create(model, pipe, ttl, check)
+
 		_pipe = self.getpipe(pipe)
+		self._save(model, _pipe, ttl, check)
+
+		if pipe is None and len(_pipe):
+			_pipe.execute()
+
+	def create (self, model, pipe=None, ttl=None, check=True):
+		""" Save model only if its key does not exist yet. Whole save is done
+		by single script call so there is no race with concurrent creators.
+		Exception raised on conflict. If pipe is given conflict is reported
+		as 0 in its execution result instead. """
+
+		args = self._replay_args(model, ttl, check)
+
+		if pipe is not None:
+			self._create_script(keys=[self.getkey(model)], args=args, client=pipe)
+
+		elif not self._create_script(keys=[self.getkey(model)], args=args):
+			raise Exception('%s(%s) already exists' % (
+				model.__class__.__name__,
+				model.getid(),
+			))
+
+	def save_cas (self, model, field, expected, ttl=None):
+		""" Save model only if its version (field) is expected one (None if
+		missing). Return False on conflict. """
+
+		expected = '' if expected is None else str(expected)
+		args = [field.name, expected] + self._replay_args(model, ttl)
+
+		return bool(self._cas_script(keys=[self.getkey(model)], args=args))
+
+	def _replay_args (self, model, ttl=None, check=True):
+		""" Return model saving commands packed for REPLAY script part. """
+
+		commands = self.handler.pipeline(transaction=False)
+		self._save(model, commands, ttl, check)
+
+		args = list()
+
+		for command, options in commands.command_stack:
+			args.append(len(command))
+			args.extend(command)
+
+		return args
+
+	def save_many (self, models, ttl=None):
+		""" Save given models using single non-transactional pipe.
+		Unique constraints are not checked. """
+
+		pipe = self.handler.pipeline(transaction=False)
+
+		for model in models:
+			self._save(model, pipe, ttl, check=False)
+
+		if len(pipe):
+			pipe.execute()
+
+	def _stream (self, model, op, pipe):
+		""" Put change record (class name, id, operation and comma separated
+		changed hash keys and collections names) into model changes stream
+		(if any). """
+
+		stream = model.getstream()
+
+		if stream is None:
+			return
+
+		key, maxlen = stream
+		args = ['XADD', key]
+
+		if maxlen is not None:
+			args.extend(('MAXLEN', '~', maxlen))
+
+		if op == 'save':
+			names = set(model._diff) | model._dels
+			names.update(name for name, command, cmd_args in model._ops)
+
+		else:
+			names = ()
+
+		args.extend((
+			'*',
+			'cls', model.__class__.__name__,
+			'id', model.getid(),
+			'op', op,
+			'fields', ','.join(sorted(names)),
+		))
+
+		pipe.execute_command(*args)
+
+	def check_unique (self, models):
+		""" Raise Exception if changes of given models violate unique
+		constraints (incl. duplicates among given models). Existing values
+		are requested using single pipe. """
+
+		pipe = self.handler.pipeline(transaction=False)
+		checks = list()
+		seen = dict()
+
+		for model in models:
+			for field in model.getfields().values():
+				if not field.unique or field.name not in model._diff:
+					continue
+
+				val = model._diff[field.name]
+				key = (model.getprefix(), field.name, val)
+
+				if seen.setdefault(key, model) is not model:
+					raise Exception('Duplicate key error')
+
+				parse = self._idx_ids_pipe(field, model.__class__, val, pipe)
+				checks.append((model, parse))
+
+		if not len(checks):
+			return
+
+		for (model, parse), reply in zip(checks, pipe.execute()):
+			ids = parse(reply)
+			ids.discard(bytes(model._id, 'utf-8') if PY3K else model._id)
+
+			if len(ids):
+				raise Exception('Duplicate key error')
+
+	def write_batch (self, ops, transaction=False):
+		""" Write batch operations ([model, 'save', 'delete' or 'replace',
+		ttl] lists) using single pipe and update models state after its
+		execution. Replace is delete followed by save of local changes as of
+		new model. Unique constraints are not checked here (see
+		check_unique()). """
+
+		pipe = self.handler.pipeline(transaction=transaction)
+		creates = list()
+
+		for model, operation, ttl in ops:
+			if operation == 'delete':
+				if model._exists is not False:
+					self.delete(model, pipe)
+
+			elif operation == 'replace':
+				if model._exists is not False:
+					self.delete(model, pipe)
+
+				exists, data = model._exists, model._data
+				model._exists, model._data = False, dict()
+
+				try:
+					self._save(model, pipe, ttl, check=False)
+
+				finally:
+					model._exists, model._data = exists, data
+
+			elif not len(model._diff) and not len(model._dels) and not len(model._ops):
+				# Expiration refresh only, see Model.save().
+				if ttl:
+					self.expire(model, ttl, pipe)
+
+			elif model._create:
+				creates.append((len(pipe), model))
+				self.create(model, pipe, ttl, check=False)
+
+			else:
+				self._save(model, pipe, ttl, check=False)
+
+		results = pipe.execute() if len(pipe) else list()
+		conflicts = [model for i, model in creates if not results[i]]
+
+		for model, operation, ttl in ops:
+			if model in conflicts:
+				continue
+
+			elif operation == 'delete':
+				model._deleted()
+
+			elif operation == 'replace':
+				model._exists = False
+				model._data = dict()
+				model._lazy = dict()
+				model._saved()
+
+			elif len(model._diff) or len(model._dels) or len(model._ops):
+				model._saved()
+
+		if len(conflicts):
+			raise Exception('%s(%s) already exists' % (
+				conflicts[0].__class__.__name__,
+				conflicts[0].getid(),
+			))
+
+	def _save (self, model, pipe, ttl=None, check=True):
+		""" Put model saving commands into given pipe.
+		Check flag tells that unique constraints should be verified. """
 
 		for field in model.getfields().values():
 			if not field.index and not field.unique:
@@ -44,23 +323,61 @@ class RedisConnector (Connector):
 				self._del_idx(
 					model=model,
 					field=field,
-					pipe=_pipe,
+					pipe=pipe,
 				)
 
 			elif field.name in model._diff:
-				self._save_idx(field, model, _pipe)
+				self._save_idx(field, model, pipe, check)
+
+			else:
+				continue
+
+			self._bump(model.__class__, field.name, pipe)
+
+		deferred = model.getdeferred()
+		dels = [name for name in model._dels if name not in deferred]
+		diff = dict((k, v) for k, v in model._diff.items() if k not in deferred)
+
+		if model._exists is not False and len(dels):
+			pipe.hdel(self.getkey(model), *dels)
+
+		if len(diff):
+			pipe.hmset(self.getkey(model), diff)
+
+		# Plain save invalidates version of optimistic (CAS) writers.
+		version = model.getversion()
+
+		if version is not None and version.name not in model._diff:
+			pipe.hincrby(self.getkey(model), version.name, 1)
 
-		if model._exists is not False and len(model._dels):
-			_pipe.hdel(self.getkey(model), *list(model._dels))
+		# Deferred values are stored in side keys.
+		for name in deferred:
+			if name in model._diff:
+				pipe.set(self.coll_key(model, name), model._diff[name])
 
-		if len(model._diff):
-			_pipe.hmset(self.getkey(model), model._diff)
+			elif name in model._dels and model._exists is not False:
+				pipe.delete(self.coll_key(model, name))
+
+		for name, command, args in model._ops:
+			getattr(pipe, command)(self.coll_key(model, name), *args)
 
 		if model._exists is not True:
-			_pipe.sadd(model.getprefix(), model.getid())
+			pipe.sadd(model.getprefix(), model.getid())
 
-		if pipe is None and len(_pipe):
-			_pipe.execute()
+		indexes = model.getindexes()
+
+		if len(indexes):
+			origin = self._origin(model, indexes, changed=True)
+
+			for index in indexes:
+				self._save_cidx(index, model, pipe, origin)
+
+		if ttl:
+			pipe.zadd(self.ttl_key(model.getprefix()), **{
+				model.getid(): int(time()) + ttl,
+			})
+
+		self._stream(model, 'save', pipe)
 
 	def delete (self, model, pipe=None):
 		""" Delete model within optionally given pipe. """
@@ -71,16 +388,104 @@ class RedisConnector (Connector):
 			if field.index or field.unique:
 				self._del_idx(field, model, _pipe)
 
-		_pipe.delete(self.getkey(model))
+				if model._exists is not False:
+					self._bump(model.__class__, field.name, _pipe)
+
+		indexes = model.getindexes()
+		origin = self._origin(model, indexes) if len(indexes) else None
+
+		for index in indexes:
+			self._del_cidx(index, model, _pipe, origin)
+
+			for field in index.getfields(model.__class__):
+				if not field.index and not field.unique and model._exists is not False:
+					self._bump(model.__class__, field.name, _pipe)
+
+		names = [collection.name for collection in model.getcollections().values()]
+		names.extend(model.getdeferred())
+
+		_pipe.delete(self.getkey(model), *[self.coll_key(model, name) for name in names])
 
 		if model._exists is not False:
 			_pipe.srem(model.getprefix(), model.getid())
+			_pipe.zrem(self.ttl_key(model.getprefix()), model.getid())
+
+		self._stream(model, 'delete', _pipe)
 
 		if pipe is None and len(_pipe):
 			_pipe.execute()
 
+	def expire (self, model, ttl=None, pipe=None):
+		""" Set model expiration time in *ttl* seconds (remove it if ttl is
+		None) within optionally given pipe. """
+
+		_pipe = self.getpipe(pipe)
+		key = self.ttl_key(model.getprefix())
+
+		if ttl is None:
+			_pipe.zrem(key, model.getid())
+
+		else:
+			_pipe.zadd(key, **{model.getid(): int(time()) + ttl})
+
+		if pipe is None:
+			_pipe.execute()
+
+	def _expired (self, model, data, expires):
+		""" Check if model is expired by given expiration time (ttl sorted
+		set score). Expired model is deleted right away (as sweep() does)
+		using given stored data, so it is never read. """
+
+		if expires is None or expires > time():
+			return False
+
+		stale = model._detached(model.getid())
+		stale._data = data
+		stale._exists = True # Ids are removed even if hash is missing.
+
+		self.delete(stale)
+		return True
+
+	def sweep (self, model_cls, batch=1000):
+		""" Delete expired models of given class in batches.
+		Return number of deleted models. """
+
+		key = self.ttl_key(model_cls.getprefix())
+		count = 0
+
+		while True:
+			ids = self.handler.zrangebyscore(
+				key,
+				'-inf',
+				int(time()),
+				start=0,
+				num=batch,
+			)
+
+			if not len(ids):
+				return count
+
+			models = [model_cls(model_id) for model_id in ids]
+
+			# Reloaded so models which expiration is refreshed meanwhile
+			# are kept. Expired ones are deleted by load_many().
+			for model in models:
+				model.unload()
+				model._exists = None
+
+			self.load_many(models)
+			count += len([model for model in models if not model._exists])
+
 	def exists (self, model):
-		return self.handler.exists(self.getkey(model))
+		pipe = self.handler.pipeline(transaction=False)
+		pipe.exists(self.getkey(model))
+		pipe.zscore(self.ttl_key(model.getprefix()), model.getid())
+		exists, expires = pipe.execute()
+
+		if exists and expires is not None and expires <= time():
+			return len(self.getall(model)) > 0
+
+		return bool(exists)
 
 	def all (self, model_cls):
 		""" Return all model instances id's. """
@@ -94,145 +499,1476 @@ class RedisConnector (Connector):
 		""" Return value of model hash key. """
 
 		val = self.handler.hget(self.getkey(model), name)
-		return val.decode('utf-8') if PY3K and val is not None else val
+		return self.decode_val(val) if PY3K else val
 
 	def getall (self, model):
-		""" Return model data (all hash keys). """
+		""" Return model data (all hash keys, empty if model is expired). """
 
-		data = dict()
-
-		for k, v in self.handler.hgetall(self.getkey(model)).items():
-			k = k.decode(encoding='UTF-8')
-			v = v.decode(encoding='UTF-8')
-			data[k] = v
+		pipe = self.handler.pipeline(transaction=False)
+		pipe.hgetall(self.getkey(model))
+		pipe.zscore(self.ttl_key(model.getprefix()), model.getid())
+		data, expires = pipe.execute()
+		data = self.decode(data)
 
-		return data
+		return dict() if self._expired(model, data, expires) else data
 
-	@staticmethod
-	def idx_key (prefix, field_name, val):
-		val = str(val) if PY3K else unicode(val)
-		return ':'.join((prefix, field_name, val))
+	def load_many (self, models):
+		""" Load data of given models (not loaded yet) using single pipe.
+		Duplicates are requested once. Expired models are deleted. """
 
-	@staticmethod
-	def ridx_key (prefix, field_name):
-		return ':'.join((prefix, field_name))
+		models = list(dict((id(model), model) for model in models
+			if not model.loaded()).values())
 
-	def find (self, expr):
-		assert isinstance(expr, BExpr)
+		if not len(models):
+			return
 
-		if isinstance(expr.field, IndexField):
-			val = expr.field.to_db(expr.val)
-			key = self.idx_key(expr.model_cls.getprefix(), expr.field.name, val)
+		pipe = self.handler.pipeline(transaction=False)
 
-			# IndexField supports EQ only. Ignore operator here.
-			return [expr.model_cls(model_id) for model_id in self.handler.smembers(key)]
+		for model in models:
+			pipe.hgetall(self.getkey(model))
+			pipe.zscore(self.ttl_key(model.getprefix()), model.getid())
 
-		elif isinstance(expr.field, RangeIndexField):
-			key = self.ridx_key(expr.model_cls.getprefix(), expr.field.name)
-			val = expr.field.to_db(expr.val)
+		replies = iter(pipe.execute())
 
-			if expr.operator == expr.EQ:
-				minval = val
-				maxval = val
+		for model in models:
+			data = self.decode(next(replies))
+			model._load(dict() if self._expired(model, data, next(replies)) else data)
 
-			elif expr.operator == expr.GT:
-				minval = '(%d' % val
-				maxval = '+inf'
+	def getmany (self, model_cls, ids, names=None):
+		""" Return list of data dicts of given model ids using single pipe.
+		Only given hash keys are fetched if names list is not None. """
 
-			elif expr.operator == expr.GE:
-				minval = val
-				maxval = '+inf'
+		pipe = self.handler.pipeline(transaction=False)
+		prefix = model_cls.getprefix()
 
-			elif expr.operator == expr.LT:
-				minval = '-inf'
-				maxval = '(%d' % val
+		for model_id in ids:
+			key = ':'.join((prefix, model_id))
 
-			elif expr.operator == expr.LE:
-				minval = '-inf'
-				maxval = val
+			if names is None:
+				pipe.hgetall(key)
 
 			else:
-				raise Exception('Unsupported operator type given')
+				pipe.hmget(key, names)
 
-			start = expr.offset
-			num = expr.limit
+		if names is None:
+			return [self.decode(data) for data in pipe.execute()]
 
-			if num is None and start == 0:
-				start = None
+		result = list()
 
-			ids = self.handler.zrangebyscore(
-				key,
-				minval,
-				maxval,
-				start=start,
-				num=num,
+		for vals in pipe.execute():
+			data = dict()
+
+			for name, val in zip(names, vals):
+				if val is not None:
+					data[name] = self.decode_val(val)
+
+			result.append(data)
+
+		return result
+
+	def getcolumns (self, model_cls, ids, names, chunk=1000):
+		""" Return list of values lists (one per given hash key, None if
+		missing) of given model ids. HMGET requests are pipelined by *chunk*
+		ids. """
+
+		columns = [list() for name in names]
+		prefix = model_cls.getprefix()
+
+		if not len(names):
+			return columns
+
+		for i in range(0, len(ids), chunk):
+			pipe = self.handler.pipeline(transaction=False)
+
+			for model_id in ids[i:i + chunk]:
+				pipe.hmget(':'.join((prefix, model_id)), names)
+
+			for vals in pipe.execute():
+				for column, val in zip(columns, vals):
+					column.append(self.decode_val(val))
+
+		return columns
+
+	def scan (self, model_cls, chunk=1000):
+		""" Yield lists of model ids (about *chunk* ids each) using SSCAN. """
+
+		for cursor, ids in self.scan_steps(model_cls, chunk):
+			yield ids
+
+	def scan_steps (self, model_cls, chunk=1000, cursor=0):
+		""" Yield (next cursor, model ids list) tuples of SSCAN steps
+		starting from given cursor. """
+
+		while True:
+			cursor, ids = self.handler.sscan(
+				model_cls.getprefix(),
+				cursor,
+				count=chunk,
 			)
 
-			return [expr.model_cls(model_id) for model_id in ids]
+			cursor = int(cursor)
 
-	def choice (self, field, model_cls, val, count=1):
-		key = self.idx_key(model_cls.getprefix(), field.name, val)
-		ids = self.handler.srandmember(key, count)
+			if len(ids):
+				yield cursor, [model_id.decode('utf-8') if PY3K else model_id \
+					for model_id in ids]
 
-		return None if not len(ids) else \
-			[model_cls(model_id) for model_id in ids]
+			if not cursor:
+				return
 
-	def _save_idx (self, field, model, pipe=None):
-		""" Save given model.field index. """
+	def reindex (self, model_cls, name, workers=1, chunk=1000, delay=0,
+		restart=False, callback=None):
+		""" Write index entries of given field for all models. Ids are scanned
+		in chunks which are processed by pool of *workers* processes. Each
+		worker sleeps *delay* seconds after each chunk. Last processed SSCAN
+		cursor is stored in database so interrupted rebuild continues from
+		it unless restart flag is set. Callback is called after each chunk
+		with (processed models count, cursor). Return processed count. """
 
-		if isinstance(field, IndexField):
-			idx_key = self.idx_key(model.getprefix(), field.name, model[field.name])
+		field = model_cls.getfields()[name]
+		key = self.reindex_key(model_cls.getprefix(), field.name)
+		cursor = 0 if restart else int(self.handler.get(key) or 0)
+		count = 0
 
-			if field.unique:
-				ids = self.handler.smembers(idx_key)
+		tasks = ((model_cls.__name__, name, ids, delay, step) \
+			for step, ids in self.scan_steps(model_cls, chunk, cursor))
 
-				if len(ids):
-					ids.discard(bytes(model._id, 'utf-8') if PY3K else model._id)
+		if workers > 1:
+			pool = fork_pool(workers)
+			results = pool.imap(reindex_chunk, tasks)
 
-					if len(ids):
-						raise Exception('Duplicate key error')
+		else:
+			pool = None
+			results = (reindex_chunk(task) for task in tasks)
 
-			self._del_idx(field, model, pipe)
-			pipe.sadd(idx_key, model._id)
+		try:
+			for processed, cursor in results:
+				count += processed
 
-		elif isinstance(field, RangeIndexField):
-			val = model[field.name]
+				if cursor:
+					self.handler.set(key, cursor)
 
-			if field.unique:
-				models = field == val
+				if callback is not None:
+					callback(count, cursor)
 
-				if len(models) > 1 or len(models) == 1 and models[0] is not model:
-					raise Exception('Duplicate key error')
+		finally:
+			if pool is not None:
+				pool.terminate()
 
-			key = self.ridx_key(model.getprefix(), field.name)
+		self.handler.delete(key)
+		return count
 
-			pipe.zadd(key, **{
-				model._id: field.to_db(val)
-			})
+	def check_indexes (self, model_cls, repair=False, chunk=1000, callback=None):
+		""" Verify indexes of given model class against models data. Models
+		are streamed using SSCAN to find missing (or outdated) index entries,
+		index entries are streamed using SCAN/SSCAN/ZSCAN/HSCAN to find
+		orphans. Both are verified in pipelined batches of *chunk* items.
+		Callback is called with (field, 'missing' or 'orphan', model id,
+		value) for each problem found. Problems are fixed if repair flag set.
+		Return dict of field name -> {'missing': count, 'orphans': count}. """
+
+		fields = [field for field in model_cls.getfields().values() \
+			if field.index or field.unique]
+
+		report = dict((field.name, {'missing': 0, 'orphans': 0}) for field in fields)
+		names = [field.name for field in fields]
+		prefix = model_cls.getprefix()
+
+		if not len(fields):
+			return report
+
+		for ids in self.scan(model_cls, chunk):
+			pipe = self.handler.pipeline(transaction=False)
+			checks = list()
+
+			for model_id, data in zip(ids, self.getmany(model_cls, ids, names)):
+				for field in fields:
+					if field.name in data:
+						val = data[field.name]
+						self._get_idx(field, model_cls, model_id, val, pipe)
+						checks.append((field, model_id, val))
+
+			fixes = self.handler.pipeline(transaction=False)
+
+			for (field, model_id, val), found in zip(checks, pipe.execute()):
+				if self._idx_match(field, model_cls, model_id, val, found):
+					continue
+
+				report[field.name]['missing'] += 1
+
+				if callback is not None:
+					callback(field, 'missing', model_id, val)
+
+				if repair:
+					self._add_idx(field, model_cls, model_id, val, fixes)
+					self._bump(model_cls, field.name, fixes)
+
+			if len(fixes):
+				fixes.execute()
+
+		for field in fields:
+			for entries in self._scan_idx_entries(field, model_cls, chunk):
+				pipe = self.handler.pipeline(transaction=False)
+
+				for model_id, val in entries:
+					pipe.hget(':'.join((prefix, model_id)), field.name)
+
+				fixes = self.handler.pipeline(transaction=False)
+
+				for (model_id, val), current in zip(entries, pipe.execute()):
+					if current is not None:
+						current = current.decode('utf-8')
+
+						if self.idx_type(field, model_cls) == 'range':
+							if float(field.to_db(current)) == val:
+								continue
+
+						elif current == val:
+							continue
+
+					report[field.name]['orphans'] += 1
+
+					if callback is not None:
+						callback(field, 'orphan', model_id, val)
+
+					if repair:
+						self._rem_idx(field, model_cls, model_id, val, fixes)
+						self._bump(model_cls, field.name, fixes)
+
+				if len(fixes):
+					fixes.execute()
+
+		return report
+
+	def _get_idx (self, field, model_cls, model_id, val, pipe):
+		""" Put request of index entry of given model id and value into pipe.
+		See _idx_match() for result check. """
+
+		idx_type = self.idx_type(field, model_cls)
+		prefix = model_cls.getprefix()
+
+		if idx_type == 'lex':
+			pipe.zscore(self.ridx_key(prefix, field.name), self.lex_member(val, model_id))
+
+		elif idx_type == 'hash':
+			pipe.hget(self.hidx_key(model_cls, field.name, val), val)
+
+		elif idx_type == 'set':
+			pipe.sismember(self.idx_key(prefix, field.name, val), model_id)
 
 		else:
-			raise Exception('Bad field type given')
+			pipe.zscore(self.ridx_key(prefix, field.name), model_id)
 
-	def _del_idx (self, field, model, pipe=None):
-		""" Delete db index value of model.field. """
+	def _idx_match (self, field, model_cls, model_id, val, result):
+		""" Check _get_idx() result. """
 
-		if model._exists is False:
-			return
+		idx_type = self.idx_type(field, model_cls)
 
-		if isinstance(field, IndexField):
-			idx_val = model.get(
-				name=field.name,
-				origin=True,
-				lite=True,
-			)
+		if idx_type == 'lex':
+			return result is not None
 
-			if idx_val is not None:
-				idx_key = self.idx_key(model.getprefix(), field.name, idx_val)
-				pipe.srem(idx_key, model._id)
+		elif idx_type == 'hash':
+			return result is not None and result.decode('utf-8') == model_id
 
-		elif isinstance(field, RangeIndexField):
-			key = self.ridx_key(model.getprefix(), field.name)
-			pipe.zrem(key, model._id)
+		elif idx_type == 'set':
+			return bool(result)
+
+		return result is not None and result == float(field.to_db(val))
+
+	def _scan_idx_entries (self, field, model_cls, chunk=1000):
+		""" Yield lists of (model id, value) tuples of all index entries of
+		given field. Range index value is a score. """
+
+		idx_type = self.idx_type(field, model_cls)
+		prefix = model_cls.getprefix()
+		key = self.ridx_key(prefix, field.name)
+
+		if idx_type == 'set':
+			match = ':'.join((escape_glob(prefix), escape_glob(field.name), '*'))
+
+			def entries ():
+				for idx_key in self.handler.scan_iter(match=match, count=chunk):
+					idx_key = idx_key.decode('utf-8')
+					val = idx_key[len(key) + 1:]
+
+					for model_id in self.handler.sscan_iter(idx_key, count=chunk):
+						yield model_id.decode('utf-8'), val
+
+		elif idx_type == 'hash':
+			def entries ():
+				for bucket in range(model_cls.getbuckets()):
+					bucket_key = '%s:#%d' % (key, bucket)
+
+					for val, model_id in self.handler.hscan_iter(bucket_key, count=chunk):
+						yield model_id.decode('utf-8'), val.decode('utf-8')
+
+		elif idx_type == 'lex':
+			def entries ():
+				for member, score in self.handler.zscan_iter(key, count=chunk):
+					val, _, model_id = member.rpartition(b'\x00')
+					yield model_id.decode('utf-8'), val.decode('utf-8')
 
 		else:
-			raise Exception('Bad field type given')
+			def entries ():
+				for model_id, score in self.handler.zscan_iter(key, count=chunk):
+					yield model_id.decode('utf-8'), score
+
+		batch = list()
+
+		for entry in entries():
+			batch.append(entry)
+
+			if len(batch) >= chunk:
+				yield batch
+				batch = list()
+
+		if len(batch):
+			yield batch
+
+	def reindex_ids (self, model_cls, field, ids):
+		""" Write index entries of given field for given model ids.
+		Return processed models count. """
+
+		pipe = self.handler.pipeline(transaction=False)
+
+		for model_id, data in zip(ids, self.getmany(model_cls, ids, [field.name])):
+			if field.name in data:
+				self._add_idx(field, model_cls, model_id, data[field.name], pipe)
+
+		if len(pipe):
+			self._bump(model_cls, field.name, pipe)
+			pipe.execute()
+
+		return len(ids)
+
+	@classmethod
+	def decode (cls, data):
+		""" Decode raw hash data returned by redis. """
+
+		result = dict()
+
+		for k, v in data.items():
+			k = k.decode(encoding='UTF-8')
+			result[k] = cls.decode_val(v)
+
+		return result
+
+	@staticmethod
+	def decode_val (val):
+		""" Decode raw value. Binary (e.g. compressed) one is returned as is. """
+
+		if val is None:
+			return None
+
+		try:
+			return val.decode(encoding='UTF-8')
+
+		except UnicodeDecodeError:
+			return val
+
+	@staticmethod
+	def idx_key (prefix, field_name, val):
+		val = str(val) if PY3K else unicode(val)
+		return ':'.join((prefix, field_name, val))
+
+	@staticmethod
+	def ridx_key (prefix, field_name):
+		return ':'.join((prefix, field_name))
+
+	@classmethod
+	def hidx_key (cls, model_cls, field_name, val):
+		""" Return compact unique index hash key of given value. Values are
+		spread over model_cls.getbuckets() small hashes so Redis keeps them
+		in memory efficient (listpack) encoding. """
+
+		if not isinstance(val, bytes):
+			val = cls.lex_val(val)
+
+		bucket = (crc32(val) & 0xffffffff) % model_cls.getbuckets()
+		return '%s:#%d' % (cls.ridx_key(model_cls.getprefix(), field_name), bucket)
+
+	@staticmethod
+	def cidx_key (prefix, field_names, vals):
+		vals = [str(val) if PY3K else unicode(val) for val in vals]
+		return ':'.join([prefix, '+'.join(field_names)] + vals)
+
+	@staticmethod
+	def ttl_key (prefix):
+		return ':'.join((prefix, '__ttl__'))
+
+	@staticmethod
+	def reindex_key (prefix, field_name):
+		return ':'.join((prefix, '__reindex__', field_name))
+
+	@staticmethod
+	def ver_key (prefix):
+		return ':'.join((prefix, '__ver__'))
+
+	@staticmethod
+	def idx_type (field, model_cls):
+		""" Return index storage type of given field: 'set' (set per value),
+		'lex' (sorted set of 'value\\0id' members), 'hash' (value -> id
+		hashes, see hidx_key()) or 'range' (sorted set scored by value). """
+
+		if isinstance(field, RangeIndexField):
+			return 'range'
+
+		elif not isinstance(field, IndexField):
+			raise Exception('Bad field type given')
+
+		elif field.lex:
+			return 'lex'
+
+		elif model_cls.getlayout() == 'compact' and field.unique:
+			return 'hash'
+
+		return 'set'
+
+	@staticmethod
+	def lex_val (val):
+		""" Return lex index representation (bytes) of given value. """
+		return (str(val) if PY3K else unicode(val)).encode('utf-8')
+
+	@classmethod
+	def lex_member (cls, val, model_id):
+		""" Return lex index member of given value and model id. """
+		return b'\x00'.join((cls.lex_val(val), cls.lex_val(model_id)))
+
+	@staticmethod
+	def lex_id (member):
+		""" Return model id of lex index member. """
+		return member.rpartition(b'\x00')[2]
+
+	@classmethod
+	def lex_eq (cls, val):
+		""" Return (min, max) ZRANGEBYLEX arguments of exact db value. """
+
+		val = cls.lex_val(val)
+		return b'[' + val + b'\x00', b'(' + val + b'\x01'
+
+	@classmethod
+	def lex_range (cls, field, operator, val):
+		""" Return (min, max) ZRANGEBYLEX arguments. Exact values are
+		validated with field.to_db(), partial ones with field.to_lex(). """
+
+		if operator == BExpr.EQ:
+			return cls.lex_eq(field.to_db(val))
+
+		val = cls.lex_val(field.to_lex(val))
+
+		if operator == BExpr.SW:
+			# 0xff byte is never used in utf-8.
+			return b'[' + val, b'(' + val + b'\xff'
+
+		elif operator == BExpr.GT:
+			return b'[' + val + b'\x01', b'+'
+
+		elif operator == BExpr.GE:
+			return b'[' + val, b'+'
+
+		elif operator == BExpr.LT:
+			return b'-', b'(' + val
+
+		elif operator == BExpr.LE:
+			return b'-', b'(' + val + b'\x01'
+
+		raise Exception('Unsupported operator type given')
+
+	@staticmethod
+	def limits (expr):
+		""" Return (start, num) tuple of expression offset and limit. """
+
+		if expr.limit is None:
+			return (None, None) if not expr.offset else (expr.offset, -1)
+
+		return expr.offset, expr.limit
+
+	@staticmethod
+	def score_range (field, operator, val):
+		""" Return (min, max) ZRANGEBYSCORE arguments. """
+
+		val = field.to_db(val)
+
+		if operator == BExpr.EQ:
+			return val, val
+
+		elif operator == BExpr.GT:
+			return '(%d' % val, '+inf'
+
+		elif operator == BExpr.GE:
+			return val, '+inf'
+
+		elif operator == BExpr.LT:
+			return '-inf', '(%d' % val
+
+		elif operator == BExpr.LE:
+			return '-inf', val
+
+		raise Exception('Unsupported operator type given')
+
+	def find (self, expr):
+		assert isinstance(expr, Expr)
+		return self.find_many([expr])[0]
+
+	def gather (self, exprs):
+		""" Load results of given expressions using single pipe. """
+
+		for expr, models in zip(exprs, self.find_many(exprs)):
+			expr.models = models
+
+	def find_many (self, exprs):
+		""" Return list of results of given expressions using single pipe.
+		If query cache is enabled cached results are validated against index
+		versions first (using one more pipe). Missed results are requested
+		with index versions in transaction and put into cache. """
+
+		results = [None] * len(exprs)
+		todo = list(range(len(exprs)))
+
+		if self.cache is not None:
+			hits = list()
+			pipe = self.handler.pipeline(transaction=False)
+
+			for i in todo:
+				entry = self.cache.get(self.signature(exprs[i]))
+
+				if entry is not None:
+					pipe.hmget(self.ver_key(exprs[i].model_cls.getprefix()), \
+						self.idx_names(exprs[i]))
+					hits.append((i, entry))
+
+			if len(hits):
+				for (i, (versions, ids)), current in zip(hits, pipe.execute()):
+					if current == versions:
+						results[i] = [exprs[i].model_cls(model_id) for model_id in ids]
+
+			todo = [i for i in todo if results[i] is None]
+
+		if not len(todo):
+			return results
+
+		pipe = self.handler.pipeline(transaction=self.cache is not None)
+		parsers = list()
+
+		for i in todo:
+			if self.cache is not None:
+				pipe.hmget(self.ver_key(exprs[i].model_cls.getprefix()), \
+					self.idx_names(exprs[i]))
+
+			parsers.append(self.find_pipe(exprs[i], pipe))
+
+		replies = iter(pipe.execute())
+
+		for i, parse in zip(todo, parsers):
+			versions = next(replies) if self.cache is not None else None
+			results[i] = parse(replies)
+
+			if self.cache is not None:
+				self.cache.set(self.signature(exprs[i]), \
+					(versions, [model.getid() for model in results[i]]))
+
+		return results
+
+	@classmethod
+	def signature (cls, expr):
+		""" Return query cache key of given expression. """
+
+		if isinstance(expr, AndExpr):
+			query = tuple(cls.signature(sub) for sub in expr.exprs)
+
+		else:
+			query = (expr.field.name, expr.operator, cls.query_val(expr))
+
+		return expr.model_cls, query, expr.limit, expr.offset
+
+	@classmethod
+	def query_val (cls, expr):
+		""" Return db value of binary expression as it is used by query
+		(hashable, models are replaced by ids and equal values match). """
+
+		if expr.operator != BExpr.EQ and cls.idx_type(expr.field, expr.model_cls) == 'lex':
+			return expr.field.to_lex(expr.val)
+
+		return expr.field.to_db(expr.val)
+
+	@staticmethod
+	def idx_names (expr):
+		""" Return names of index fields used by given expression. """
+
+		if isinstance(expr, AndExpr):
+			return [sub.field.name for sub in expr.exprs]
+
+		return [expr.field.name]
+
+	def _bump (self, model_cls, field_name, pipe):
+		""" Put index version increment into pipe if query cache is enabled.
+		See find_many(). """
+
+		if self.cache is not None:
+			pipe.hincrby(self.ver_key(model_cls.getprefix()), field_name, 1)
+
+	def find_pipe (self, expr, pipe):
+		""" Put expression result requests into pipe. Return function which
+		takes iterator of pipe replies, consumes own ones and returns list of
+		result models. """
+
+		if isinstance(expr, AndExpr):
+			return self._find_and(expr, pipe)
+
+		idx_type = self.idx_type(expr.field, expr.model_cls)
+
+		if idx_type == 'lex':
+			key = self.ridx_key(expr.model_cls.getprefix(), expr.field.name)
+			minval, maxval = self.lex_range(expr.field, expr.operator, expr.val)
+			start, num = self.limits(expr)
+
+			pipe.zrangebylex(
+				key,
+				minval,
+				maxval,
+				start=start,
+				num=num,
+			)
+
+			return lambda replies: \
+				[expr.model_cls(self.lex_id(member)) for member in next(replies)]
+
+		elif idx_type == 'hash':
+			val = expr.field.to_db(expr.val)
+
+			# Hash supports EQ only. Ignore operator here.
+			pipe.hget(self.hidx_key(expr.model_cls, expr.field.name, val), val)
+
+			def parse (replies):
+				model_id = next(replies)
+				return [] if model_id is None else [expr.model_cls(model_id)]
+
+			return parse
+
+		elif idx_type == 'set':
+			val = expr.field.to_db(expr.val)
+			key = self.idx_key(expr.model_cls.getprefix(), expr.field.name, val)
+
+			# IndexField supports EQ only. Ignore operator here.
+			pipe.smembers(key)
+
+		else:
+			key = self.ridx_key(expr.model_cls.getprefix(), expr.field.name)
+			minval, maxval = self.score_range(expr.field, expr.operator, expr.val)
+			start, num = self.limits(expr)
+
+			pipe.zrangebyscore(
+				key,
+				minval,
+				maxval,
+				start=start,
+				num=num,
+			)
+
+		return lambda replies: \
+			[expr.model_cls(model_id) for model_id in next(replies)]
+
+	@staticmethod
+	def tighten (minval, maxval, othermin, othermax):
+		""" Return intersection of two ZRANGEBYSCORE (min, max) ranges. """
+
+		def parse (bound):
+			bound = bound.decode('utf-8') if type(bound) is bytes else str(bound)
+			return float(bound.lstrip('(')), bound.startswith('(')
+
+		def fmt (bound):
+			val, exclusive = bound
+
+			if val in (float('inf'), float('-inf')):
+				return '+inf' if val > 0 else '-inf'
+
+			return ('(%r' if exclusive else '%r') % val
+
+		lo = max(parse(minval), parse(othermin))
+		hi = min(parse(maxval), parse(othermax), key=lambda bound: (bound[0], not bound[1]))
+
+		return fmt(lo), fmt(hi)
+
+	@contextmanager
+	def zsource (self, field, model_cls, where=None):
+		""" Yield (key, min, max) of range index filtered by given expression.
+		Expression on the same field is converted into score range. Other
+		expressions result is intersected into temporary sorted set (which
+		is removed on exit). """
+
+		key = self.ridx_key(model_cls.getprefix(), field.name)
+
+		if where is None:
+			yield key, '-inf', '+inf'
+			return
+
+		if isinstance(where, BExpr) and where.field is field:
+			minval, maxval = self.score_range(field, where.operator, where.val)
+			yield key, minval, maxval
+			return
+
+		tmp = ':'.join((model_cls.getprefix(), '__tmp__', hexid()))
+		pipe = self.handler.pipeline(transaction=True)
+
+		if isinstance(where, BExpr) and self.idx_type(where.field, model_cls) == 'set':
+			val = where.field.to_db(where.val)
+			idx_key = self.idx_key(model_cls.getprefix(), where.field.name, val)
+			pipe.zinterstore(tmp, {key: 1, idx_key: 0})
+
+		else:
+			ids = [model.getid() for model in self.find(where)]
+			tmp_ids = tmp + ':ids'
+
+			for i in range(0, len(ids), 1000):
+				pipe.sadd(tmp_ids, *ids[i:i + 1000])
+
+			pipe.zinterstore(tmp, {key: 1, tmp_ids: 0})
+			pipe.delete(tmp_ids)
+
+		# Do not leak temporary key if process dies.
+		pipe.expire(tmp, 60)
+		pipe.execute()
+
+		try:
+			yield tmp, '-inf', '+inf'
+
+		finally:
+			self.handler.delete(tmp)
+
+	def zmin (self, field, model_cls, where=None):
+		""" Return minimal value of range index. """
+
+		with self.zsource(field, model_cls, where) as (key, minval, maxval):
+			found = self.handler.zrangebyscore(key, minval, maxval, \
+				start=0, num=1, withscores=True)
+
+		return field.from_db(found[0][1]) if len(found) else None
+
+	def zmax (self, field, model_cls, where=None):
+		""" Return maximal value of range index. """
+
+		with self.zsource(field, model_cls, where) as (key, minval, maxval):
+			found = self.handler.zrevrangebyscore(key, maxval, minval, \
+				start=0, num=1, withscores=True)
+
+		return field.from_db(found[0][1]) if len(found) else None
+
+	def zcount (self, field, model_cls, minval, maxval, where=None):
+		""" Return count of models which values are in given (inclusive) range. """
+
+		with self.zsource(field, model_cls, where) as (key, lo, hi):
+			lo, hi = self.tighten(field.to_db(minval), field.to_db(maxval), lo, hi)
+			return self.handler.zcount(key, lo, hi)
+
+	def zpercentile (self, field, model_cls, percent, where=None):
+		""" Return value of given percentile using nearest rank method: value
+		of ceil(percent / 100 * count)-th (at least the first) lowest one. """
+
+		assert 0 <= percent <= 100
+
+		with self.zsource(field, model_cls, where) as (key, minval, maxval):
+			count = self.handler.zcount(key, minval, maxval)
+
+			if not count:
+				return None
+
+			found = self.handler.zrangebyscore(key, minval, maxval, \
+				start=max(0, int(ceil(percent / 100.0 * count)) - 1), num=1, withscores=True)
+
+		return field.from_db(found[0][1]) if len(found) else None
+
+	def zhistogram (self, field, model_cls, buckets, where=None):
+		""" Return list of (lower bound, upper bound, count) tuples. Buckets
+		is either a count of equal width buckets between minimal and maximal
+		values or a sorted list of bounds. Bounds are database values (e.g.
+		timestamps). Upper bound is exclusive except of the last one. """
+
+		with self.zsource(field, model_cls, where) as (key, minval, maxval):
+			if isinstance(buckets, int):
+				pipe = self.handler.pipeline(transaction=False)
+				pipe.zrangebyscore(key, minval, maxval, start=0, num=1, withscores=True)
+				pipe.zrevrangebyscore(key, maxval, minval, start=0, num=1, withscores=True)
+				first, last = pipe.execute()
+
+				if not len(first):
+					return list()
+
+				lo, hi = first[0][1], last[0][1]
+				width = (hi - lo) / float(buckets)
+				bounds = [lo + width * i for i in range(buckets)] + [hi]
+
+			else:
+				bounds = [field.to_db(bound) for bound in buckets]
+
+			pipe = self.handler.pipeline(transaction=False)
+
+			for i in range(len(bounds) - 1):
+				upper = bounds[i + 1] if i == len(bounds) - 2 else '(%r' % bounds[i + 1]
+				pipe.zcount(key, *self.tighten(bounds[i], upper, minval, maxval))
+
+			counts = pipe.execute()
+
+		return [(bounds[i], bounds[i + 1], count) for i, count in enumerate(counts)]
+
+	def _find_and (self, expr, pipe):
+		""" Put AndExpr result requests into pipe using composite index if
+		model has matching one or subexpressions results (to intersect)
+		otherwise. See find_pipe(). """
+
+		prefix = expr.model_cls.getprefix()
+
+		for index in expr.model_cls.getindexes():
+			plan = index.match(expr)
+
+			if plan is None:
+				continue
+
+			vals, score = plan
+			fields = index.getfields(expr.model_cls)
+			key = self.cidx_key(prefix, [field.name for field in fields], vals)
+
+			if score is None:
+				minval, maxval = '-inf', '+inf'
+
+			else:
+				minval, maxval = self.score_range(score.field, score.operator, score.val)
+
+			start, num = self.limits(expr)
+
+			pipe.zrangebyscore(
+				key,
+				minval,
+				maxval,
+				start=start,
+				num=num,
+			)
+
+			return lambda replies: \
+				[expr.model_cls(model_id) for model_id in next(replies)]
+
+		# Keep order of the first ordered (range or lex) index result.
+		exprs = sorted(expr.exprs, key=lambda sub: \
+			self.idx_type(sub.field, expr.model_cls) not in ('lex', 'range'))
+
+		parsers = [self.find_pipe(copy(sub), pipe) for sub in exprs]
+
+		def parse (replies):
+			models = parsers[0](replies)
+
+			for sub in parsers[1:]:
+				found = set(sub(replies))
+				models = [model for model in models if model in found]
+
+			if expr.limit is None:
+				return models[expr.offset:]
+
+			return models[expr.offset:expr.offset + expr.limit]
+
+		return parse
+
+	def iter (self, expr, chunk=1000):
+		""" Iterate over expression result page by page. Exact index is
+		scanned with SSCAN (limit and offset are ignored like in find()). """
+
+		if isinstance(expr, AndExpr):
+			for model in self.find(expr):
+				yield model
+
+			return
+
+		if self.idx_type(expr.field, expr.model_cls) in ('set', 'hash'):
+			cursor = 0
+
+			while True:
+				cursor, models = self.scan_idx(
+					field=expr.field,
+					model_cls=expr.model_cls,
+					val=expr.val,
+					cursor=cursor,
+					count=chunk,
+				)
+
+				for model in models:
+					yield model
+
+				if not cursor:
+					return
+
+		offset = expr.offset
+		left = expr.limit
+
+		while left is None or left > 0:
+			page = copy(expr)
+			page.models = None
+			page.offset = offset
+			page.limit = chunk if left is None else min(chunk, left)
+
+			models = self.find(page)
+
+			for model in models:
+				yield model
+
+			if len(models) < page.limit:
+				return
+
+			offset += len(models)
+
+			if left is not None:
+				left -= len(models)
+
+	def count (self, field, model_cls, val):
+		""" Return count of models found by exact index. """
+
+		pipe = self.handler.pipeline(transaction=False)
+		self._count_idx(field, model_cls, val, pipe)
+
+		return int(pipe.execute()[0])
+
+	def count_many (self, field, model_cls, vals):
+		""" Return list of models counts found by exact index for each of
+		given values using single pipe. """
+
+		pipe = self.handler.pipeline(transaction=False)
+
+		for val in vals:
+			self._count_idx(field, model_cls, val, pipe)
+
+		return [int(count) for count in pipe.execute()]
+
+	def scan_idx (self, field, model_cls, val, cursor=0, count=100):
+		""" Return (next cursor, models) tuple of exact index scan step.
+		Lex index cursor is just an offset. """
+
+		idx_type = self.idx_type(field, model_cls)
+		val = field.to_db(val)
+
+		if idx_type == 'lex':
+			key = self.ridx_key(model_cls.getprefix(), field.name)
+			minval, maxval = self.lex_eq(val)
+
+			members = self.handler.zrangebylex(
+				key,
+				minval,
+				maxval,
+				start=cursor,
+				num=count,
+			)
+
+			cursor = cursor + len(members) if len(members) == count else 0
+			return cursor, [model_cls(self.lex_id(member)) for member in members]
+
+		elif idx_type == 'hash':
+			ids = self._idx_ids(field, model_cls, val)
+			return 0, [model_cls(model_id) for model_id in ids]
+
+		key = self.idx_key(model_cls.getprefix(), field.name, val)
+		cursor, ids = self.handler.sscan(key, cursor, count=count)
+
+		return int(cursor), [model_cls(model_id) for model_id in ids]
+
+	def choice (self, field, model_cls, val, count=1):
+		idx_type = self.idx_type(field, model_cls)
+
+		if idx_type == 'lex':
+			key = self.ridx_key(model_cls.getprefix(), field.name)
+			minval, maxval = self.lex_eq(field.to_db(val))
+			total = self.handler.zlexcount(key, minval, maxval)
+			pipe = self.handler.pipeline(transaction=False)
+
+			for offset in sample(range(total), min(count, total)):
+				pipe.zrangebylex(key, minval, maxval, start=offset, num=1)
+
+			ids = [self.lex_id(members[0]) for members in pipe.execute() if len(members)]
+
+		elif idx_type == 'hash':
+			ids = list(self._idx_ids(field, model_cls, field.to_db(val)))
+
+		else:
+			key = self.idx_key(model_cls.getprefix(), field.name, val)
+			ids = self.handler.srandmember(key, count)
+
+		return None if not len(ids) else \
+			[model_cls(model_id) for model_id in ids]
+
+	def sample_all (self, model_cls, count=1):
+		""" Return list of up to *count* distinct random models. """
+
+		ids = self.handler.srandmember(model_cls.getprefix(), count)
+		return [model_cls(model_id) for model_id in ids]
+
+	def sample (self, expr, count=1):
+		""" Return list of up to *count* distinct random models of expression
+		result. Sorted set indexes (range, lex and composite) are sampled by
+		random ranks within result bounds using ZRANGE (two pipes). """
+
+		model_cls = expr.model_cls
+		prefix = model_cls.getprefix()
+
+		if isinstance(expr, AndExpr):
+			for index in model_cls.getindexes():
+				plan = index.match(expr)
+
+				if plan is None:
+					continue
+
+				vals, score = plan
+				fields = index.getfields(model_cls)
+				key = self.cidx_key(prefix, [field.name for field in fields], vals)
+
+				if score is None:
+					minval, maxval = '-inf', '+inf'
+
+				else:
+					minval, maxval = self.score_range(score.field, score.operator, score.val)
+
+				return self._sample_ranks(expr, key, False, minval, maxval, count)
+
+			models = self.find(expr)
+			return sample(models, min(count, len(models)))
+
+		idx_type = self.idx_type(expr.field, model_cls)
+
+		if idx_type == 'lex':
+			key = self.ridx_key(prefix, expr.field.name)
+			minval, maxval = self.lex_range(expr.field, expr.operator, expr.val)
+
+			return self._sample_ranks(expr, key, True, minval, maxval, count)
+
+		elif idx_type == 'range':
+			key = self.ridx_key(prefix, expr.field.name)
+			minval, maxval = self.score_range(expr.field, expr.operator, expr.val)
+
+			return self._sample_ranks(expr, key, False, minval, maxval, count)
+
+		elif idx_type == 'hash':
+			ids = self._idx_ids(expr.field, model_cls, expr.field.to_db(expr.val))
+
+		else:
+			val = expr.field.to_db(expr.val)
+			key = self.idx_key(prefix, expr.field.name, val)
+			ids = self.handler.srandmember(key, count)
+
+		return [model_cls(model_id) for model_id in ids]
+
+	def _sample_ranks (self, expr, key, lex, minval, maxval, count):
+		""" Return random models of sorted set index range. Rank of range
+		start and range length are counted first, then random ranks (within
+		expression offset and limit) are requested by ZRANGE. """
+
+		pipe = self.handler.pipeline(transaction=False)
+		zcount = pipe.zlexcount if lex else pipe.zcount
+		below = self.below(minval, lex)
+
+		if below is not None:
+			zcount(key, '-' if lex else '-inf', below)
+
+		zcount(key, minval, maxval)
+		counts = [int(reply) for reply in pipe.execute()]
+
+		first = counts[0] if below is not None else 0
+		start = first + expr.offset
+		stop = first + counts[-1]
+
+		if expr.limit is not None:
+			stop = min(stop, start + expr.limit)
+
+		if stop <= start:
+			return []
+
+		for rank in sample(range(start, stop), min(count, stop - start)):
+			pipe.zrange(key, rank, rank)
+
+		ids = [members[0] for members in pipe.execute() if len(members)]
+
+		if lex:
+			ids = [self.lex_id(member) for member in ids]
+
+		return [expr.model_cls(model_id) for model_id in ids]
+
+	@staticmethod
+	def below (minval, lex=False):
+		""" Return max bound of range just below given ZRANGEBYSCORE (or
+		ZRANGEBYLEX if lex flag is set) min bound or None if it is open. """
+
+		if lex:
+			if minval == b'-':
+				return None
+
+			return (b'(' if minval[:1] == b'[' else b'[') + minval[1:]
+
+		minval = str(minval)
+
+		if minval == '-inf':
+			return None
+
+		return minval[1:] if minval.startswith('(') else '(' + minval
+
+	def _count_idx (self, field, model_cls, val, pipe):
+		""" Put exact index count request of given value into pipe. """
+
+		idx_type = self.idx_type(field, model_cls)
+		val = field.to_db(val)
+
+		if idx_type == 'lex':
+			key = self.ridx_key(model_cls.getprefix(), field.name)
+			pipe.zlexcount(key, *self.lex_eq(val))
+
+		elif idx_type == 'hash':
+			pipe.hexists(self.hidx_key(model_cls, field.name, val), val)
+
+		else:
+			pipe.scard(self.idx_key(model_cls.getprefix(), field.name, val))
+
+	def _save_idx (self, field, model, pipe=None, check=True):
+		""" Save given model.field index. """
+
+		val = model[field.name]
+
+		if isinstance(field, IndexField):
+			if field.unique and check:
+				ids = self._idx_ids(field, model.__class__, val)
+
+				if len(ids):
+					ids.discard(bytes(model._id, 'utf-8') if PY3K else model._id)
+
+					if len(ids):
+						raise Exception('Duplicate key error')
+
+			self._del_idx(field, model, pipe)
+
+		elif isinstance(field, RangeIndexField):
+			if field.unique and check:
+				models = field == val
+
+				if len(models) > 1 or len(models) == 1 and models[0] is not model:
+					raise Exception('Duplicate key error')
+
+		self._add_idx(field, model.__class__, model._id, val, pipe)
+
+	def _del_idx (self, field, model, pipe=None):
+		""" Delete db index value of model.field. """
+
+		if model._exists is False:
+			return
+
+		if isinstance(field, IndexField):
+			idx_val = model.get(
+				name=field.name,
+				origin=True,
+				lite=True,
+			)
+
+			if idx_val is not None:
+				self._rem_idx(field, model.__class__, model._id, idx_val, pipe)
+
+		else:
+			self._rem_idx(field, model.__class__, model._id, None, pipe)
+
+	def _idx_ids (self, field, model_cls, val):
+		""" Return set of model ids (bytes) found by exact index db value. """
+
+		pipe = self.handler.pipeline(transaction=False)
+		parse = self._idx_ids_pipe(field, model_cls, val, pipe)
+
+		return parse(pipe.execute()[0])
+
+	def _idx_ids_pipe (self, field, model_cls, val, pipe):
+		""" Put _idx_ids() request into pipe. Return function which takes
+		pipe reply and returns set of model ids. """
+
+		idx_type = self.idx_type(field, model_cls)
+		prefix = model_cls.getprefix()
+
+		if idx_type == 'lex':
+			key = self.ridx_key(prefix, field.name)
+			pipe.zrangebylex(key, *self.lex_eq(val))
+			return lambda members: set(self.lex_id(member) for member in members)
+
+		elif idx_type == 'hash':
+			pipe.hget(self.hidx_key(model_cls, field.name, val), val)
+			return lambda model_id: set() if model_id is None else set([model_id])
+
+		elif idx_type == 'range':
+			val = field.to_db(val)
+			pipe.zrangebyscore(self.ridx_key(prefix, field.name), val, val)
+
+		else:
+			pipe.smembers(self.idx_key(prefix, field.name, val))
+
+		return set
+
+	def _add_idx (self, field, model_cls, model_id, val, pipe):
+		""" Put index entry of given model id and field value into pipe. """
+
+		idx_type = self.idx_type(field, model_cls)
+		prefix = model_cls.getprefix()
+
+		if idx_type == 'lex':
+			key = self.ridx_key(prefix, field.name)
+			pipe.zadd(key, 0, self.lex_member(val, model_id))
+
+		elif idx_type == 'hash':
+			pipe.hset(self.hidx_key(model_cls, field.name, val), val, model_id)
+
+		elif idx_type == 'set':
+			pipe.sadd(self.idx_key(prefix, field.name, val), model_id)
+
+		else:
+			pipe.zadd(self.ridx_key(prefix, field.name), **{
+				model_id: field.to_db(val)
+			})
+
+	def _rem_idx (self, field, model_cls, model_id, val, pipe):
+		""" Put index entry removal of given model id and field value into
+		pipe. Value is not used by range index. """
+
+		idx_type = self.idx_type(field, model_cls)
+		prefix = model_cls.getprefix()
+
+		if idx_type == 'lex':
+			key = self.ridx_key(prefix, field.name)
+			pipe.zrem(key, self.lex_member(val, model_id))
+
+		elif idx_type == 'hash':
+			pipe.hdel(self.hidx_key(model_cls, field.name, val), val)
+
+		elif idx_type == 'set':
+			pipe.srem(self.idx_key(prefix, field.name, val), model_id)
+
+		else:
+			pipe.zrem(self.ridx_key(prefix, field.name), model_id)
+
+	def _origin (self, model, indexes, changed=False):
+		""" Return dict of stored values of given composite indexes fields
+		(only of indexes with local changes if changed flag is set). Loaded
+		data is used if possible, otherwise values are fetched by single
+		HMGET. """
+
+		if model._exists is False:
+			return dict()
+
+		names = set()
+
+		for index in indexes:
+			fields = index.getfields(model.__class__)
+
+			if not changed or self._cidx_changed(fields, model):
+				names.update(field.name for field in fields)
+
+		if model.loaded():
+			return dict((name, model._data[name]) for name in names \
+				if name in model._data)
+
+		if not len(names):
+			return dict()
+
+		names = list(names)
+		vals = self.handler.hmget(self.getkey(model), names)
+
+		return dict((name, self.decode_val(val)) for name, val in zip(names, vals) \
+			if val is not None)
+
+	@staticmethod
+	def _cidx_changed (fields, model):
+		""" Check if any of given fields is changed locally. """
+
+		for field in fields:
+			if field.name in model._diff or field.name in model._dels:
+				return True
+
+		return False
+
+	def _save_cidx (self, index, model, pipe, origin):
+		""" Put composite index update of changed model into pipe. Origin is
+		dict of stored values (see _origin()). """
+
+		fields = index.getfields(model.__class__)
+
+		if not self._cidx_changed(fields, model):
+			return
+
+		for field in fields:
+			if not field.index and not field.unique:
+				self._bump(model.__class__, field.name, pipe)
+
+		self._del_cidx(index, model, pipe, origin)
+
+		vals = list()
+
+		for field in fields:
+			if field.name in model._dels:
+				vals.append(None)
+
+			elif field.name in model._diff:
+				vals.append(model._diff[field.name])
+
+			else:
+				vals.append(origin.get(field.name))
+
+		if None in vals:
+			return
+
+		names = [field.name for field in fields]
+		key = self.cidx_key(model.getprefix(), names, vals[:-1])
+
+		pipe.zadd(key, **{
+			model._id: fields[-1].to_db(vals[-1]),
+		})
+
+	def _del_cidx (self, index, model, pipe, origin):
+		""" Put composite index entry removal of given model into pipe. """
+
+		if model._exists is False:
+			return
+
+		fields = index.getfields(model.__class__)[:-1]
+		vals = [origin.get(field.name) for field in fields]
+
+		if None in vals:
+			return
+
+		names = [field.name for field in index.getfields(model.__class__)]
+		pipe.zrem(self.cidx_key(model.getprefix(), names, vals), model._id)
+
+
+class Change (object):
+	""" Model change record read from changes stream. """
+
+	def __init__ (self, entry_id, model, op, fields):
+		self.id = entry_id
+		self.model = model
+		self.op = op
+		self.fields = fields
+
+
+class StreamConsumer (object):
+	""" Reads models changes stream (see conf *stream* option) as a member
+	of consumer group. Changes are read in batches and models of saved ones
+	are (re)loaded using single pipe per connector. """
+
+	def __init__ (self, stream, group, name, db=None):
+		self.stream = stream
+		self.group = group
+		self.name = name
+		self.db = conf.db if db is None else db
+
+	def create_group (self, start='$'):
+		""" Create consumer group (and stream) if not exists. Group reads
+		changes after *start* entry id ('$' means new ones only, '0' all). """
+
+		try:
+			self.db.handler.execute_command('XGROUP', 'CREATE', self.stream, \
+				self.group, start, 'MKSTREAM')
+
+		except ResponseError as e:
+			if 'BUSYGROUP' not in str(e):
+				raise
+
+	def read (self, count=100, block=None, pending=False, hydrate=True):
+		""" Return list of up to *count* Change objects. Wait up to *block*
+		milliseconds for new changes if given. Pending flag tells that
+		delivered but not acknowledged changes should be read instead of new
+		ones. Models of saved changes are reloaded if hydrate flag is set. """
+
+		args = ['XREADGROUP', 'GROUP', self.group, self.name, 'COUNT', count]
+
+		if block is not None:
+			args.extend(('BLOCK', block))
+
+		args.extend(('STREAMS', self.stream, '0' if pending else '>'))
+
+		reply = self.db.handler.execute_command(*args)
+		changes = list()
+
+		for stream, entries in reply or ():
+			for entry_id, data in entries:
+				if data is None: # Deleted (trimmed) pending entry.
+					continue
+
+				if not isinstance(data, dict):
+					data = dict(zip(data[::2], data[1::2]))
+
+				data = dict((k.decode('utf-8'), v.decode('utf-8')) \
+					for k, v in data.items())
+
+				changes.append(Change(
+					entry_id=entry_id.decode('utf-8'),
+					model=Model.getcls(data['cls'])(data['id']),
+					op=data['op'],
+					fields=[name for name in data['fields'].split(',') if name],
+				))
+
+		if hydrate:
+			models = [change.model for change in changes if change.op == 'save']
+
+			for model in models:
+				model.unload()
+
+			Model.load_many(models)
+
+		return changes
+
+	def ack (self, changes):
+		""" Acknowledge processed changes. """
+
+		if len(changes):
+			self.db.handler.execute_command('XACK', self.stream, self.group, \
+				*[change.id for change in changes])
+
+	def iter (self, count=100, block=1000, hydrate=True):
+		""" Yield batches (lists) of changes. Pending changes are read first.
+		Each batch is acknowledged when the next one is requested. Iteration
+		stops when there are no new changes (after *block* milliseconds
+		wait) unless block is 0 (wait forever). """
+
+		pending = True
+
+		while True:
+			changes = self.read(count, None if pending else block, pending, hydrate)
+
+			if not len(changes):
+				if pending:
+					pending = False
+					continue
+
+				return
+
+			yield changes
+			self.ack(changes)
+
+
+def fork_pool (workers):
+	""" Return pool of forked processes (models are inherited as is). """
+
+	try:
+		from multiprocessing import get_context
+
+	except ImportError:
+		from multiprocessing import Pool
+		return Pool(workers)
+
+	return get_context('fork').Pool(workers)
+
+
+def reindex_chunk (task):
+	""" Reindex worker. Return (processed count, cursor) tuple. """
+
+	cls_name, name, ids, delay, cursor = task
+
+	model_cls = Model.getcls(cls_name)
+	field = model_cls.getfields()[name]
+	count = model_cls.getdb().reindex_ids(model_cls, field, ids)
+
+	if delay:
+		sleep(delay)
+
+	return count, cursor
+
+
+def escape_glob (val):
+	""" Escape glob-style pattern special characters. """
+
+	for char in '\\*?[]':
+		val = val.replace(char, '\\' + char)
+
+	return val
+
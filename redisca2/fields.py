@@ -2,6 +2,10 @@
 
 import re
 
+from abc import (
+	abstractmethod,
+)
+
 from datetime import (
 	datetime,
 )
@@ -10,22 +14,42 @@ from hashlib import (
 	md5,
 )
 
+from json import (
+	dumps,
+	loads,
+)
+
+from time import (
+	mktime,
+)
+
 from .base import (
+	BExpr,
+	Collection,
 	Model,
 	Field,
 )
 
 from .utils import (
+	Abstract,
 	PY3K,
-)
-
-from inspect import (
-	isclass,
+	optional,
 )
 
 
 class IndexField (Field):
-	""" Base class for fields with exact indexing. """
+	""" Base class for fields with exact indexing. Use index='lex' to store
+	index in single sorted set which supports prefix and range queries. """
+
+	def startswith (self, val):
+		""" Return expression of models which values starts with given one. """
+
+		assert self.lex
+		return BExpr(operator=BExpr.SW, field=self, val=val)
+
+	def to_lex (self, val):
+		""" Return value (maybe partial) prepared for lex index query. """
+		return str(val) if PY3K else unicode(val)
 
 	def choice (self, val, count=1):
 		""" Return *count* random model(s) from find() result. """
@@ -41,8 +65,31 @@ class IndexField (Field):
 
 
 class RangeIndexField (Field):
-	""" Base class for fields with range indexing. """
-	pass
+	""" Base class for fields with range indexing. Aggregations are computed
+	by database using range index. Optional *where* expression filters
+	models to aggregate. """
+
+	def min (self, where=None):
+		""" Return minimal value. """
+		return self.owner.getdb().zmin(self, self.owner, where)
+
+	def max (self, where=None):
+		""" Return maximal value. """
+		return self.owner.getdb().zmax(self, self.owner, where)
+
+	def percentile (self, percent, where=None):
+		""" Return value of given percentile (0..100, nearest rank). """
+		return self.owner.getdb().zpercentile(self, self.owner, percent, where)
+
+	def histogram (self, buckets, where=None):
+		""" Return list of (lower bound, upper bound, count) tuples.
+		See connector's zhistogram() for details. """
+		return self.owner.getdb().zhistogram(self, self.owner, buckets, where)
+
+	def count_between (self, minval, maxval, where=None):
+		""" Return count of models which values are in given (inclusive)
+		range. """
+		return self.owner.getdb().zcount(self, self.owner, minval, maxval, where)
 
 
 class Bool (IndexField):
@@ -52,6 +99,29 @@ class Bool (IndexField):
 	def from_db (self, val):
 		return val == '1' or val == 1
 
+	def to_db_many (self, vals):
+		if self.overrides(Bool, 'to_db'):
+			return super(Bool, self).to_db_many(vals)
+
+		return [None if val is None else (1 if (val and val != '0') else 0) \
+			for val in vals]
+
+	def from_db_many (self, vals):
+		if self.overrides(Bool, 'from_db'):
+			return super(Bool, self).from_db_many(vals)
+
+		return [self.none if val is None else (val == '1' or val == 1) \
+			for val in vals]
+
+	def column (self, vals):
+		""" Return bool array (missing values are False). """
+
+		if self.overrides(Bool, 'from_db'):
+			return super(Bool, self).column(vals)
+
+		numpy = optional('numpy', 'to_columns()')
+		return numpy.array(vals, dtype=object) == '1'
+
 
 class String (IndexField):
 	def __init__ (self, minlen=None, maxlen=None, **kw):
@@ -74,6 +144,34 @@ class String (IndexField):
 
 		return val
 
+	def to_db_many (self, vals):
+		if self.overrides(String, 'to_db'):
+			return super(String, self).to_db_many(vals)
+
+		return self._text_many(vals)
+
+	def _text_many (self, vals):
+		""" Convert all values, then check the shortest and the longest. """
+
+		text = str if PY3K else unicode
+		vals = [None if val is None else text(val) for val in vals]
+
+		if self.minlen is None and self.maxlen is None:
+			return vals
+
+		lens = [len(val) for val in vals if val is not None]
+
+		if not len(lens):
+			return vals
+
+		if self.minlen is not None and min(lens) < self.minlen:
+			raise Exception('Minimal length check failed')
+
+		if self.maxlen is not None and max(lens) > self.maxlen:
+			raise Exception('Maximum length check failed')
+
+		return vals
+
 
 class Email (IndexField):
 	REGEXP = re.compile(r"^[a-z0-9]+[_a-z0-9-]*(\.[_a-z0-9-]+)*@[a-z0-9]+[\.a-z0-9-]*(\.[a-z]{2,4})$")
@@ -96,6 +194,9 @@ class Email (IndexField):
 
 		return super(Email, self).choice(val, count)
 
+	def to_lex (self, val):
+		return super(Email, self).to_lex(val).lower()
+
 	def to_db (self, val):
 		val = val.lower()
 
@@ -104,6 +205,19 @@ class Email (IndexField):
 
 		return val
 
+	def to_db_many (self, vals):
+		if self.overrides(Email, 'to_db'):
+			return super(Email, self).to_db_many(vals)
+
+		match = self.REGEXP.match
+		vals = [None if val is None else val.lower() for val in vals]
+
+		for val in vals:
+			if val is not None and match(val) is None:
+				raise Exception('Email validation failed')
+
+		return vals
+
 
 class Integer (RangeIndexField):
 	def __init__ (self, minval=None, maxval=None, **kw):
@@ -129,6 +243,60 @@ class Integer (RangeIndexField):
 	def from_db (self, val):
 		return int(val)
 
+	def to_db_many (self, vals):
+		""" Convert all values, then check the minimal and the maximal. """
+
+		if self.overrides(Integer, 'to_db'):
+			return super(Integer, self).to_db_many(vals)
+
+		vals = [None if val is None else int(val) for val in vals]
+
+		if self.minval is None and self.maxval is None:
+			return vals
+
+		present = [val for val in vals if val is not None]
+
+		if not len(present):
+			return vals
+
+		if self.minval is not None and min(present) < self.minval:
+			raise Exception('Minimal value check failed')
+
+		if self.maxval is not None and max(present) > self.maxval:
+			raise Exception('Maximum value check failed')
+
+		return vals
+
+	def from_db_many (self, vals):
+		if self.overrides(Integer, 'from_db'):
+			return super(Integer, self).from_db_many(vals)
+
+		return [self.none if val is None else int(val) for val in vals]
+
+	def column (self, vals):
+		""" Return int64 array or float64 one (NaN for missing values). """
+
+		if self.overrides(Integer, 'from_db'):
+			return super(Integer, self).column(vals)
+
+		numpy = optional('numpy', 'to_columns()')
+
+		if None in vals:
+			return numpy.array(['nan' if val is None else val for val in vals]) \
+				.astype(numpy.float64)
+
+		return numpy.array(vals).astype(numpy.int64)
+
+
+class Version (Integer):
+	""" Model version which is incremented by each save. Used by
+	Model.save(cas=True) to detect concurrent changes. """
+
+	version = True
+
+	def __init__ (self, **kw):
+		super(Version, self).__init__(minval=0, **kw)
+
 
 class DateTime (RangeIndexField):
 	def to_db (self, val):
@@ -137,12 +305,52 @@ class DateTime (RangeIndexField):
 	def from_db (self, val):
 		return datetime.fromtimestamp(int(val))
 
+	def to_db_many (self, vals):
+		""" Local timestamps are taken from time tuples (like strftime('%s')
+		does) without string formatting and parsing. """
+
+		if self.overrides(DateTime, 'to_db'):
+			return super(DateTime, self).to_db_many(vals)
+
+		return [None if val is None else \
+			int(mktime(val.timetuple()) if type(val) is datetime else val) \
+			for val in vals]
+
+	def from_db_many (self, vals):
+		if self.overrides(DateTime, 'from_db'):
+			return super(DateTime, self).from_db_many(vals)
+
+		fromtimestamp = datetime.fromtimestamp
+		return [self.none if val is None else fromtimestamp(int(val)) for val in vals]
+
+	def column (self, vals):
+		""" Return datetime64[s] array (UTC, NaT for missing values). """
+
+		if self.overrides(DateTime, 'from_db'):
+			return super(DateTime, self).column(vals)
+
+		numpy = optional('numpy', 'to_columns()')
+
+		missing = numpy.array([val is None for val in vals], dtype=bool)
+		column = numpy.array(['0' if val is None else val for val in vals]) \
+			.astype(numpy.int64).astype('datetime64[s]')
+
+		column[missing] = numpy.datetime64('NaT')
+		return column
+
 
 class MD5Pass (String):
 	def to_db (self, val):
 		val = super(MD5Pass, self).to_db(val)
 		return md5(val.encode('utf-8')).hexdigest()
 
+	def to_db_many (self, vals):
+		if self.overrides(MD5Pass, 'to_db'):
+			return Field.to_db_many(self, vals)
+
+		return [None if val is None else md5(val.encode('utf-8')).hexdigest() \
+			for val in self._text_many(vals)]
+
 
 class Reference (IndexField):
 	def __init__ (self, cls, **kw):
@@ -153,5 +361,479 @@ class Reference (IndexField):
 		return val._id if isinstance(val, Model) else val
 
 	def from_db (self, val):
-		cls = self._cls if isclass(self._cls) else Model.getcls(self._cls)
+		cls = self._cls if isinstance(self._cls, type) else Model.getcls(self._cls)
 		return cls(val)
+
+	def from_db_many (self, vals):
+		if self.overrides(Reference, 'from_db'):
+			return super(Reference, self).from_db_many(vals)
+
+		cls = self._cls if isinstance(self._cls, type) else Model.getcls(self._cls)
+		return [self.none if val is None else cls(val) for val in vals]
+
+
+class Json (Field):
+	""" Nested data (dicts, lists etc) serialized as JSON. Value is parsed
+	once per loaded data and its in-place changes are detected by save().
+	With flat=True top level keys of dict value are stored as separate hash
+	keys (name.key) so only changed ones are written. """
+
+	def __init__ (self, flat=False, **kw):
+		super(Json, self).__init__(**kw)
+
+		assert not self.index and not self.unique
+
+		if flat:
+			assert not self.deferred and self.compress is None
+
+		self.flat = flat
+
+	def __get__ (self, model, owner):
+		self.owner = owner
+
+		if model is None:
+			return self
+
+		raw = self.getraw(model)
+
+		if raw is None:
+			return self.none
+
+		if self.name in model._parsed and model._parsed[self.name][1] == raw:
+			return model._parsed[self.name][2]
+
+		if self.flat:
+			val = dict((key, self.from_db(sub)) for key, sub in raw.items())
+
+		else:
+			val = self.from_db(raw)
+
+		model._parsed[self.name] = (self, raw, val)
+		return val
+
+	def __set__ (self, model, value):
+		model._parsed.pop(self.name, None)
+
+		if not self.flat:
+			super(Json, self).__set__(model, value)
+
+		else:
+			assert value is None or type(value) is dict
+
+			raw = self.getraw(model) or dict()
+			value = value or dict()
+
+			for key in raw:
+				if key not in value:
+					del model[self.subkey(key)]
+
+			for key, val in value.items():
+				model[self.subkey(key)] = self.to_db(val)
+
+		raw = self.getraw(model)
+
+		if raw is not None:
+			model._parsed[self.name] = (self, raw, value)
+
+	def subkey (self, key):
+		""" Return hash key of flat value key. """
+		return '.'.join((self.name, key))
+
+	def getraw (self, model):
+		""" Return database value (dict of flat keys values if flat) or None. """
+
+		if not self.flat:
+			return self.norm(self.unpack(model[self.name])) if self.name in model else None
+
+		prefix = self.name + '.'
+		raw = dict()
+
+		for key, val in model.getall().items():
+			if key.startswith(prefix):
+				raw[key[len(prefix):]] = self.norm(val)
+
+		return raw if len(raw) else None
+
+	def sync (self, model):
+		""" Write in-place changes of parsed value into model. """
+
+		field, raw, val = model._parsed[self.name]
+
+		if not self.flat:
+			data = self.to_db(val)
+
+			if data != raw:
+				model[self.name] = self.pack(data)
+				model._parsed[self.name] = (self, data, val)
+
+			return
+
+		data = dict()
+
+		for key, sub in val.items():
+			data[key] = self.to_db(sub)
+
+			if raw.get(key) != data[key]:
+				model[self.subkey(key)] = data[key]
+
+		for key in raw:
+			if key not in val:
+				del model[self.subkey(key)]
+
+		model._parsed[self.name] = (self, data, val)
+
+	def norm (self, raw):
+		""" Return database value in form returned by to_db(). """
+		return raw
+
+	def to_db (self, val):
+		return dumps(val, sort_keys=True, separators=(',', ':'))
+
+	def from_db (self, val):
+		return loads(val)
+
+
+class MsgPack (Json):
+	""" Like Json but serialized with msgpack (requires *msgpack* package). """
+
+	def __init__ (self, **kw):
+		super(MsgPack, self).__init__(**kw)
+
+		optional('msgpack', 'MsgPack field')
+
+		# Compressed values are decompressed as text.
+		assert self.compress is None
+
+	def norm (self, raw):
+		# Value may be occasionally decoded as utf-8.
+		return raw.encode('utf-8') if type(raw) is not bytes else raw
+
+	def to_db (self, val):
+		return optional('msgpack', 'MsgPack field').packb(val, use_bin_type=True)
+
+	def from_db (self, val):
+		return optional('msgpack', 'MsgPack field').unpackb(self.norm(val), raw=False)
+
+
+class Backref (object):
+	""" Reverse accessor of indexed Reference field. Cls is referencing
+	model class (or its name), name is its reference field name. """
+
+	def __init__ (self, cls, name):
+		self._cls = cls
+		self._name = name
+
+	def __get__ (self, model, owner):
+		if model is None:
+			return self
+
+		return BoundBackref(self, model)
+
+	def getcls (self):
+		""" Return referencing model class. """
+		return self._cls if isinstance(self._cls, type) else Model.getcls(self._cls)
+
+	def getfield (self):
+		""" Return reference field of referencing model class. """
+
+		field = getattr(self.getcls(), self._name)
+
+		assert isinstance(field, Reference)
+		assert field.index or field.unique
+
+		return field
+
+	def count_for (self, models):
+		""" Return list of referencing models counts of given models
+		using single pipe. """
+
+		cls = self.getcls()
+
+		return cls.getdb().count_many(
+			field=self.getfield(),
+			model_cls=cls,
+			vals=[model.getid() for model in models],
+		)
+
+
+class BoundBackref (object):
+	""" Backref bound to referenced model. """
+
+	def __init__ (self, backref, model):
+		self.backref = backref
+		self.model = model
+
+	def __len__ (self):
+		return self.count()
+
+	def __iter__ (self):
+		return self.iter()
+
+	def count (self):
+		""" Return referencing models count. """
+
+		cls = self.backref.getcls()
+
+		return cls.getdb().count(
+			field=self.backref.getfield(),
+			model_cls=cls,
+			val=self.model.getid(),
+		)
+
+	def page (self, cursor=0, count=100):
+		""" Return (next cursor, models) tuple. About *count* referencing models
+		are returned per call (in no particular order). Next cursor is 0 when
+		iteration is complete. """
+
+		cls = self.backref.getcls()
+
+		return cls.getdb().scan_idx(
+			field=self.backref.getfield(),
+			model_cls=cls,
+			val=self.model.getid(),
+			cursor=cursor,
+			count=count,
+		)
+
+	def iter (self, count=100):
+		""" Iterate over all referencing models page by page. """
+
+		cursor = 0
+
+		while True:
+			cursor, models = self.page(cursor, count)
+
+			for model in models:
+				yield model
+
+			if not cursor:
+				return
+
+
+class BoundCollection (Abstract):
+	""" Collection bound to model. """
+
+	def __init__ (self, collection, model):
+		self.collection = collection
+		self.model = model
+
+	def __len__ (self):
+		return self.count()
+
+	def __iter__ (self):
+		return self.iter()
+
+	@abstractmethod
+	def count (self):
+		""" Return collection size. """
+
+	@abstractmethod
+	def iter (self, count=100):
+		""" Iterate over all items page by page (*count* per request). """
+
+	def replace (self, vals):
+		""" Replace collection contents with given items on save. """
+
+		self.push('delete')
+		self.extend(vals)
+
+	@abstractmethod
+	def extend (self, vals):
+		""" Add given items on save. Return self. """
+
+	def push (self, command, *args):
+		""" Add pending command (written by model save()). Return self. """
+
+		self.model._ops.append((self.collection.name, command, args))
+		return self
+
+	def read (self, command, *args):
+		""" Run read command on collection key. """
+
+		return self.model.getdb().collection(
+			self.model,
+			self.collection.name,
+			command,
+			*args
+		)
+
+	def to_db (self, val):
+		return self.collection.item.to_db(val)
+
+	def from_db (self, val):
+		if PY3K and type(val) is bytes:
+			val = val.decode('utf-8')
+
+		return self.collection.item.from_db(val)
+
+
+class ListField (Collection):
+	""" List stored in model_key:name key. """
+
+	def bind (self, model):
+		return BoundList(self, model)
+
+
+class BoundList (BoundCollection):
+	def __getitem__ (self, index):
+		val = self.read('lindex', index)
+		return None if val is None else self.from_db(val)
+
+	def count (self):
+		""" Return list length. """
+		return self.read('llen')
+
+	def page (self, start=0, count=100):
+		""" Return list of *count* items from *start* index. """
+		return [self.from_db(val) for val in self.read('lrange', start, start + count - 1)]
+
+	def iter (self, count=100):
+		""" Iterate over all items page by page. """
+
+		start = 0
+
+		while True:
+			vals = self.page(start, count)
+
+			for val in vals:
+				yield val
+
+			if len(vals) < count:
+				return
+
+			start += count
+
+	def append (self, *vals):
+		return self.push('rpush', *[self.to_db(val) for val in vals])
+
+	def prepend (self, *vals):
+		return self.push('lpush', *[self.to_db(val) for val in vals])
+
+	def extend (self, vals):
+		vals = list(vals)
+		return self.append(*vals) if len(vals) else self
+
+	def remove (self, val, count=0):
+		""" Remove *count* (all by default) occurrences of given item. """
+		return self.push('lrem', count, self.to_db(val))
+
+	def trim (self, start, stop):
+		""" Keep items from *start* to *stop* (inclusive) indexes only. """
+		return self.push('ltrim', start, stop)
+
+
+class SetField (Collection):
+	""" Set stored in model_key:name key. """
+
+	def bind (self, model):
+		return BoundSet(self, model)
+
+
+class BoundSet (BoundCollection):
+	def __contains__ (self, val):
+		return bool(self.read('sismember', self.to_db(val)))
+
+	def count (self):
+		""" Return set size. """
+		return self.read('scard')
+
+	def page (self, cursor=0, count=100):
+		""" Return (next cursor, items) tuple. See BoundBackref.page(). """
+
+		cursor, vals = self.read('sscan', cursor, None, count)
+		return int(cursor), [self.from_db(val) for val in vals]
+
+	def iter (self, count=100):
+		""" Iterate over all items page by page. """
+
+		cursor = 0
+
+		while True:
+			cursor, vals = self.page(cursor, count)
+
+			for val in vals:
+				yield val
+
+			if not cursor:
+				return
+
+	def add (self, *vals):
+		return self.push('sadd', *[self.to_db(val) for val in vals])
+
+	def extend (self, vals):
+		vals = list(vals)
+		return self.add(*vals) if len(vals) else self
+
+	def remove (self, *vals):
+		return self.push('srem', *[self.to_db(val) for val in vals])
+
+
+class ZSetField (Collection):
+	""" Sorted set (item -> score) stored in model_key:name key. """
+
+	def bind (self, model):
+		return BoundZSet(self, model)
+
+
+class BoundZSet (BoundCollection):
+	def __contains__ (self, val):
+		return self.score(val) is not None
+
+	def count (self):
+		""" Return sorted set size. """
+		return self.read('zcard')
+
+	def score (self, val):
+		""" Return score of given item or None. """
+		return self.read('zscore', self.to_db(val))
+
+	def rank (self, val, reverse=False):
+		""" Return rank (0-based) of given item or None. """
+		return self.read('zrevrank' if reverse else 'zrank', self.to_db(val))
+
+	def page (self, start=0, count=100, reverse=False):
+		""" Return list of (item, score) tuples ordered by score. """
+
+		found = self.read('zrange', start, start + count - 1, reverse, True)
+		return [(self.from_db(val), score) for val, score in found]
+
+	def range (self, minscore='-inf', maxscore='+inf', start=None, num=None):
+		""" Return list of (item, score) tuples within given scores range. """
+
+		found = self.read('zrangebyscore', minscore, maxscore, start, num, True)
+		return [(self.from_db(val), score) for val, score in found]
+
+	def iter (self, count=100, reverse=False):
+		""" Iterate over all (item, score) tuples page by page. """
+
+		start = 0
+
+		while True:
+			items = self.page(start, count, reverse)
+
+			for item in items:
+				yield item
+
+			if len(items) < count:
+				return
+
+			start += count
+
+	def add (self, val, score):
+		return self.push('zadd', score, self.to_db(val))
+
+	def incr (self, val, amount=1):
+		return self.push('zincrby', self.to_db(val), amount)
+
+	def extend (self, items):
+		""" Add items from dict or list of (item, score) tuples. """
+
+		items = items.items() if isinstance(items, dict) else items
+
+		for val, score in items:
+			self.add(val, score)
+
+		return self
+
+	def remove (self, *vals):
+		return self.push('zrem', *[self.to_db(val) for val in vals])
@@ -2,6 +2,7 @@
 
 from unittest import (
 	TestCase,
+	skipIf,
 )
 
 from datetime import (
@@ -12,9 +13,43 @@ from time import (
 	time,
 )
 
+from json import (
+	loads,
+)
+
+from subprocess import (
+	check_output,
+)
+
+from sys import (
+	executable,
+)
+
+from threading import (
+	Thread,
+)
+
+from redisca2.cli import (
+	main,
+)
+
+from redisca2.base import (
+	Collection,
+)
+
+from redisca2.fields import (
+	BoundCollection,
+)
+
+from redisca2.utils import (
+	generator,
+)
+
 from redisca2 import (
 	PY3K,
+	FlaskRedisca,
 	RedisConnector,
+	StreamConsumer,
 	Model,
 	Field,
 	Bool,
@@ -24,9 +59,21 @@ from redisca2 import (
 	MD5Pass,
 	DateTime,
 	Reference,
+	Backref,
+	ListField,
+	SetField,
+	ZSetField,
+	Version,
+	Index,
+	Json,
+	MsgPack,
+	batch,
+	scope,
 	hexid,
 	intid,
+	IdGenerator,
 	conf,
+	gather,
 )
 
 
@@ -34,6 +81,25 @@ NOW_TS = int(time())
 NOW = datetime.fromtimestamp(NOW_TS)
 
 
+try:
+	import msgpack
+
+except ImportError:
+	msgpack = None
+
+try:
+	import numpy
+
+except ImportError:
+	numpy = None
+
+try:
+	import pandas
+
+except ImportError:
+	pandas = None
+
+
 redis0 = RedisConnector(db=0)
 redis1 = RedisConnector(db=1)
 
@@ -115,14 +181,189 @@ SubLang.flag = String(
 SubLang.foobar = 'foobar'
 
 
+class Post (Model):
+	author = Reference(
+		User,
+		name='author',
+		index=True,
+	)
+
+	title = String(
+		name='title',
+	)
+
+
+User.posts = Backref(
+	'Post',
+	'author',
+)
+
+
+@conf(prefix='c')
+class Contact (Model):
+	email = Email(
+		name='eml',
+		index='lex',
+		unique=True,
+	)
+
+	name = String(
+		name='name',
+		index='lex',
+	)
+
+
+@conf(prefix='cc', layout='compact', buckets=4)
+class CompactContact (Model):
+	email = Email(
+		name='eml',
+		unique=True,
+	)
+
+	city = String(
+		name='city',
+		index=True,
+	)
+
+
+@conf(prefix='acc')
+class Account (Model):
+	status = String(
+		name='status',
+		index=True,
+	)
+
+	name = String(
+		name='name',
+		index=True,
+	)
+
+	created = DateTime(
+		name='created',
+		index=True,
+	)
+
+	indexes = [
+		Index('status', 'created'),
+	]
+
+
+@conf(prefix='sess', ttl=60)
+class Session (Model):
+	user = Reference(
+		User,
+		name='user',
+		index=True,
+	)
+
+	hits = Integer(
+		name='hits',
+		index=True,
+	)
+
+
+@conf(prefix='cu', db=RedisConnector(db=0, cache=100))
+class CachedUser (Model):
+	name = String(
+		name='name',
+		index=True,
+	)
+
+	age = Integer(
+		name='age',
+		index=True,
+	)
+
+
+@conf(prefix='prof')
+class Profile (Model):
+	name = String(
+		name='name',
+	)
+
+	log = ListField(
+		name='log',
+	)
+
+	tags = SetField(
+		name='tags',
+	)
+
+	scores = ZSetField(
+		name='scores',
+		item=Integer(name='score'),
+	)
+
+
+@conf(prefix='art')
+class Article (Model):
+	title = String(
+		name='title',
+	)
+
+	summary = String(
+		name='summary',
+		compress=100,
+	)
+
+	body = String(
+		name='body',
+		deferred=True,
+		compress=100,
+	)
+
+	author = Reference(
+		User,
+		name='author',
+	)
+
+
+@conf(prefix='cfg')
+class Settings (Model):
+	data = Json(
+		name='data',
+	)
+
+	flags = Json(
+		name='flags',
+		flat=True,
+	)
+
+
+@conf(prefix='cnt')
+class Counter (Model):
+	hits = Integer(
+		name='hits',
+	)
+
+	ver = Version(
+		name='ver',
+	)
+
+
+@conf(prefix='ev', stream='ev:changes', stream_maxlen=1000)
+class Event (Model):
+	title = String(
+		name='title',
+	)
+
+	kind = String(
+		name='kind',
+		index=True,
+	)
+
+	tags = SetField(
+		name='tags',
+	)
+
+
 class ModelTestCase (TestCase):
 	def setUp (self):
 		redis0.handler.flushdb()
 		redis1.handler.flushdb()
 
 	def tearDown (self):
-		User.free_all()
-		Language.free_all()
+		Model.free_all()
 
 	def test_prefix (self):
 		self.assertEqual(User.getprefix(), 'u')
@@ -238,6 +479,71 @@ class ModelTestCase (TestCase):
 		self.assertEqual(user.name, None)
 		self.assertEqual(user.created, NOW)
 
+	def test_new_optimistic (self):
+		user = User.new(1, optimistic=True)
+
+		self.assertFalse(user.exists())
+		self.assertEqual(user.created, NOW)
+
+		user.name = 'John Smith'
+		user.save()
+
+		self.assertTrue(user.exists())
+		self.assertEqual(redis0.handler.hget('u:1', 'name'), b'John Smith')
+		self.assertEqual(redis0.handler.smembers('u:name:John Smith'), set([b'1']))
+		self.assertEqual(redis0.handler.smembers('u'), set([b'1']))
+
+		# Regular saves after creation.
+		user.name = 'Steve Gobs'
+		user.save()
+
+		self.assertEqual(redis0.handler.hget('u:1', 'name'), b'Steve Gobs')
+		self.assertFalse(redis0.handler.exists('u:name:John Smith'))
+
+		user.free()
+		user = User.new(1, optimistic=True)
+		user.name = 'Bill Gates'
+
+		with self.assertRaises(Exception):
+			user.save()
+
+		self.assertEqual(user.getdiff()['name'], 'Bill Gates')
+		self.assertEqual(redis0.handler.hget('u:1', 'name'), b'Steve Gobs')
+		self.assertFalse(redis0.handler.exists('u:name:Bill Gates'))
+
+		# Conflict would be known after pipe execution only.
+		pipe = redis0.getpipe()
+
+		with self.assertRaises(Exception):
+			user.save(pipe)
+
+		self.assertEqual(pipe.execute(), [])
+
+		# The same for save_all(): nothing is written outside given pipe.
+		other = User.new(2, optimistic=True)
+		other.name = 'Jane Doe'
+
+		with self.assertRaises(Exception):
+			User.save_all(pipe)
+
+		self.assertEqual(len(pipe), 0)
+		self.assertFalse(redis0.handler.exists('u:2'))
+		other.free()
+
+		self.assertEqual(user.getdiff()['name'], 'Bill Gates')
+		self.assertFalse(user._exists)
+		self.assertEqual(user.name, 'Bill Gates')
+		self.assertEqual(redis0.handler.hget('u:1', 'name'), b'Steve Gobs')
+
+		# Batch reports conflict after execution keeping local state.
+		with self.assertRaises(Exception):
+			with batch():
+				user.save()
+
+		self.assertEqual(user.getdiff()['name'], 'Bill Gates')
+		self.assertFalse(user._exists)
+		self.assertEqual(redis0.handler.hget('u:1', 'name'), b'Steve Gobs')
+
 	def test_save_delete (self):
 		user = User(1)
 		user.name = 'John Smith'
@@ -505,6 +811,74 @@ class ModelTestCase (TestCase):
 	def test_intid (self):
 		self.assertEqual(type(intid()), int)
 
+		ids = [intid() for _ in range(10000)]
+		self.assertEqual(len(set(ids)), len(ids))
+		self.assertEqual(ids, sorted(ids))
+
+	def test_idgen (self):
+		gen = IdGenerator(worker=5)
+		self.assertEqual(gen.getworker(), 5)
+
+		ids = gen.reserve(5000)
+		self.assertEqual(len(set(ids)), 5000)
+		self.assertEqual(ids, sorted(ids))
+
+		for model_id in ids:
+			self.assertEqual((model_id >> gen.SEQUENCE_BITS) & gen.MAX_WORKER, 5)
+
+		self.assertTrue(gen.next() > ids[-1])
+
+		# Clock moved backwards.
+		gen._last += 1000
+		last = gen.next()
+		self.assertTrue(last > ids[-1])
+		self.assertTrue(gen.next() > last)
+
+		with self.assertRaises(AssertionError):
+			IdGenerator(worker=IdGenerator.MAX_WORKER + 1)
+
+	def test_new_generated (self):
+		user = User.new()
+
+		self.assertFalse(user.exists())
+		self.assertTrue(user.loaded())
+		self.assertEqual(user.created, NOW)
+
+		user.name = 'John Smith'
+		user.save()
+
+		self.assertTrue(user.exists())
+		self.assertEqual(redis0.handler.hget('u:%s' % user.getid(), 'name'), b'John Smith')
+		self.assertEqual(redis0.handler.smembers('u'), set([user.getid().encode('utf-8')]))
+
+		with self.assertRaises(Exception):
+			User.new(user.getid())
+
+	def test_new_generated_worker (self):
+		# Generated ids are not checked by default.
+		user = User.new()
+		self.assertFalse(user._create)
+
+		pipe = redis0.handler.pipeline()
+		user.save(pipe)
+		pipe.execute()
+		self.assertTrue(user.exists())
+
+		# Unless optimistic flag is set.
+		user = User.new(optimistic=True)
+		self.assertTrue(user._create)
+
+		user.save()
+		self.assertTrue(user.exists())
+
+		try:
+			generator.setworker(3)
+			self.assertEqual(generator.getworker(), 3)
+			self.assertEqual((intid() >> generator.SEQUENCE_BITS) & generator.MAX_WORKER, 3)
+
+		finally:
+			generator._worker = None
+
 	def test_range_idx (self):
 		for i in range(1, 10):
 			user = User(i)
@@ -799,3 +1173,1755 @@ class ModelTestCase (TestCase):
 
 		users = User.all()
 		self.assertEqual(len(users), 0)
+
+	def test_ttl (self):
+		self.assertEqual(Session.getttl(), 60)
+		self.assertEqual(User.getttl(), None)
+
+		session = Session(1)
+		session.user = User(1)
+		session.save()
+
+		score = redis0.handler.zscore('sess:__ttl__', '1')
+		self.assertTrue(NOW_TS + 60 <= score <= int(time()) + 60)
+
+		session = Session(2)
+		session.hits = 1
+		session.save(ttl=3600)
+
+		score = redis0.handler.zscore('sess:__ttl__', '2')
+		self.assertTrue(NOW_TS + 3600 <= score <= int(time()) + 3600)
+
+		user = User(1)
+		user.name = 'John Smith'
+		user.save()
+
+		self.assertFalse(redis0.handler.exists('u:__ttl__'))
+
+		# Expiration is refreshed even if there are no changes.
+		user.save(ttl=10)
+		score = redis0.handler.zscore('u:__ttl__', '1')
+		self.assertTrue(NOW_TS + 10 <= score <= int(time()) + 10)
+
+		user.name = 'Steve Gobs'
+		user.save(ttl=100)
+		score = redis0.handler.zscore('u:__ttl__', '1')
+		self.assertTrue(NOW_TS + 100 <= score <= int(time()) + 100)
+
+		user.persist()
+		self.assertFalse(redis0.handler.exists('u:__ttl__'))
+
+		# Refresh within batch is written (or discarded) with the batch.
+		with self.assertRaises(ValueError):
+			with batch():
+				user.save(ttl=10)
+				raise ValueError()
+
+		self.assertFalse(redis0.handler.exists('u:__ttl__'))
+
+		with batch():
+			user.save(ttl=10)
+			self.assertFalse(redis0.handler.exists('u:__ttl__'))
+
+		score = redis0.handler.zscore('u:__ttl__', '1')
+		self.assertTrue(NOW_TS + 10 <= score <= int(time()) + 10)
+
+		user.persist()
+
+		user.expire(10)
+		self.assertTrue(redis0.handler.zscore('u:__ttl__', '1') is not None)
+
+		user.delete()
+		self.assertFalse(redis0.handler.exists('u:__ttl__'))
+
+		# Expired model is deleted on read, before sweep().
+		user = User(2)
+		user.name = 'John Doe'
+		user.save()
+
+		redis0.handler.zadd('u:__ttl__', **{'2': 0})
+		Model.free_all()
+
+		self.assertFalse(User(2).exists())
+		self.assertEqual(User(2).name, None)
+		self.assertFalse(redis0.handler.exists('u:2'))
+		self.assertFalse(redis0.handler.exists('u:name:John Doe'))
+		self.assertFalse(redis0.handler.exists('u:__ttl__'))
+		self.assertEqual(User.count_all(), 0)
+
+	def test_sweep (self):
+		for i in range(1, 6):
+			session = Session(i)
+			session.user = User(i)
+			session.hits = i
+			session.save()
+
+		# Expire first 3 sessions.
+		redis0.handler.zadd('sess:__ttl__', **{'1': 0, '2': 0, '3': 0})
+		Model.free_all()
+
+		self.assertEqual(Session.sweep(batch=2), 3)
+		self.assertEqual(Session.sweep(), 0)
+
+		self.assertEqual(Session.count_all(), 2)
+		self.assertEqual(redis0.handler.zcard('sess:__ttl__'), 2)
+		self.assertEqual(redis0.handler.zcard('sess:hits'), 2)
+
+		for i in range(1, 4):
+			self.assertFalse(redis0.handler.exists('sess:%d' % i))
+			self.assertFalse(redis0.handler.exists('sess:user:%d' % i))
+			self.assertFalse(Session(i).exists())
+
+		for i in range(4, 6):
+			self.assertTrue(redis0.handler.exists('sess:%d' % i))
+			self.assertTrue(redis0.handler.exists('sess:user:%d' % i))
+			self.assertEqual(len(Session.user == User(i)), 1)
+
+		# Expired models are deleted by load_many() too.
+		redis0.handler.zadd('sess:__ttl__', **{'4': 0})
+		Model.free_all()
+
+		Session.load_many([Session(4), Session(5)])
+		self.assertFalse(Session(4).exists())
+		self.assertTrue(Session(5).exists())
+		self.assertFalse(redis0.handler.exists('sess:user:4'))
+		self.assertEqual(Session.count_all(), 1)
+
+	def test_bulk_load (self):
+		progress = list()
+
+		rows = [{
+			'id': i,
+			'name': 'user%d' % i,
+			'age': i,
+			'password': 'secret',
+		} for i in range(1, 11)]
+
+		rows.append({'name': 'John Smith'})
+
+		count = User.bulk_load(
+			rows,
+			chunk=4,
+			callback=lambda count, seconds: progress.append(count),
+		)
+
+		self.assertEqual(count, 11)
+		self.assertEqual(progress, [4, 8, 11])
+		self.assertEqual(len(User._objects), 0)
+		self.assertEqual(User.count_all(), 11)
+
+		self.assertEqual(redis0.handler.hgetall('u:5'), {
+			b'name': b'user5',
+			b'age': b'5',
+			b'pass': b'5ebe2294ecd0e0f08eab7690d2a6ee69',
+			b'created': str(NOW_TS).encode('utf-8'),
+		})
+
+		self.assertEqual((User.age == 5)[0], User(5))
+		self.assertEqual((User.name == 'user5')[0], User(5))
+		self.assertEqual((User.name == 'John Smith')[0].name, 'John Smith')
+
+		with self.assertRaises(Exception):
+			User.bulk_load([{'id': 12, 'age': 101}])
+
+		with self.assertRaises(Exception):
+			User.bulk_load([{'id': 12, 'unknown': 1}])
+
+		self.assertFalse(redis0.handler.exists('u:12'))
+
+		# Existing models are updated: old index entries are removed and
+		# stored values are not overwritten with field.new ones.
+		redis0.handler.hset('u:5', 'created', NOW_TS - 10)
+
+		User.bulk_load([{'id': 5, 'name': 'John Doe'}])
+
+		self.assertEqual(redis0.handler.hgetall('u:5'), {
+			b'name': b'John Doe',
+			b'age': b'5',
+			b'pass': b'5ebe2294ecd0e0f08eab7690d2a6ee69',
+			b'created': str(NOW_TS - 10).encode('utf-8'),
+		})
+
+		self.assertFalse(redis0.handler.exists('u:name:user5'))
+		self.assertEqual((User.name == 'John Doe')[0], User(5))
+		self.assertEqual(User.count_all(), 11)
+
+	def test_dump (self):
+		for i in range(1, 6):
+			user = User(i)
+			user.name = 'user%d' % i
+			user.age = i
+
+		User.save_all()
+		Model.free_all()
+
+		rows = [loads(line) for line in User.dump(fields=['age'], chunk=2)]
+		rows.sort(key=lambda row: int(row['id']))
+
+		self.assertEqual(rows, [{'id': str(i), 'age': str(i)} for i in range(1, 6)])
+		self.assertEqual(len(User._objects), 0)
+
+		lines = list(User.dump())
+		self.assertTrue(all(line.endswith('\n') for line in lines))
+
+		redis0.handler.flushdb()
+
+		User.bulk_load((loads(line) for line in lines), validate=False)
+
+		for i in range(1, 6):
+			self.assertEqual(User(i).export(), {'name': 'user%d' % i, 'age': i})
+
+		# Deferred and flat Json values are dumped too.
+		article = Article(1)
+		article.title = 'Title'
+		article.body = 'Body'
+		article.save()
+
+		settings = Settings(1)
+		settings.flags = {'a': 1, 'b': [2]}
+		settings.save()
+
+		Model.free_all()
+
+		self.assertEqual(loads(next(Article.dump(fields=['title', 'body']))),
+			{'id': '1', 'title': 'Title', 'body': 'Body'})
+
+		lines = list(Settings.dump())
+		self.assertEqual(loads(lines[0]), {'id': '1', 'flags': {'a': '1', 'b': '[2]'}})
+
+		redis0.handler.flushdb()
+		Model.free_all()
+
+		Settings.bulk_load((loads(line) for line in lines), validate=False)
+		self.assertEqual(Settings(1).flags, {'a': 1, 'b': [2]})
+
+		# Compressed values (above threshold) are dumped as text and packed
+		# again on load.
+		article = Article(2)
+		article.summary = 'Summary ' * 20
+		article.body = 'Body ' * 40
+		article.save()
+
+		self.assertEqual(redis0.handler.hget('art:2', 'summary')[:2], b'\x00z')
+		self.assertEqual(redis0.handler.get('art:2:body')[:2], b'\x00z')
+
+		Model.free_all()
+
+		lines = list(Article.dump(fields=['summary', 'body']))
+		self.assertEqual(loads(lines[0]), {
+			'id': '2',
+			'summary': 'Summary ' * 20,
+			'body': 'Body ' * 40,
+		})
+
+		redis0.handler.flushdb()
+		Article.bulk_load((loads(line) for line in lines), validate=False)
+
+		self.assertEqual(redis0.handler.hget('art:2', 'summary')[:2], b'\x00z')
+		self.assertEqual(Article(2).summary, 'Summary ' * 20)
+		self.assertEqual(Article(2).body, 'Body ' * 40)
+
+	def test_lazy_backends (self):
+		code = 'import sys, redisca2; print(\'redis\' in sys.modules)'
+		self.assertEqual(check_output([executable, '-c', code]).strip(), b'False')
+
+		code = 'import sys, redisca2; redisca2.RedisConnector; print(\'redis\' in sys.modules)'
+		self.assertEqual(check_output([executable, '-c', code]).strip(), b'True')
+
+		# Optional dependencies are imported on first use too.
+		code = 'import sys, redisca2; print(len(set(sys.modules) & ' \
+			'set([\'numpy\', \'pandas\', \'msgpack\', \'lz4\'])))'
+		self.assertEqual(check_output([executable, '-c', code]).strip(), b'0')
+
+		# Star import exports backends.
+		code = 'from redisca2 import *; print(RedisConnector.__name__, ' \
+			'StreamConsumer.__name__, FlaskRedisca.__name__, Model.__name__)'
+		self.assertEqual(check_output([executable, '-c', code]).split(),
+			[b'RedisConnector', b'StreamConsumer', b'FlaskRedisca', b'Model'])
+
+		# Module level imports are not exported.
+		code = 'from redisca2 import *; print(\'time\' in dir() or \'loads\' in dir())'
+		self.assertEqual(check_output([executable, '-c', code]).strip(), b'False')
+
+		import redisca2
+		import redisca2.contrib
+		from redisca2.contrib.redis import RedisConnector as Connector
+
+		self.assertTrue(redisca2.BACKENDS is redisca2.contrib.BACKENDS)
+
+		self.assertTrue(redisca2.RedisConnector is Connector)
+		self.assertTrue(RedisConnector is Connector)
+
+		with self.assertRaises(AttributeError):
+			redisca2.UnknownBackend
+
+	def test_prefetch (self):
+		Language(1).name = 'English'
+		Language(1).save()
+
+		for i in range(1, 4):
+			user = User(i)
+			user.name = 'user%d' % i
+			user.lang = Language(1)
+			user.save()
+
+			for j in range(2):
+				post = Post('%d.%d' % (i, j))
+				post.author = user
+				post.title = 'post%d' % j
+				post.save()
+
+		# Post without author.
+		Post(0).title = 'post0'
+		Post(0).save()
+
+		Model.free_all()
+
+		posts = [Post('%d.%d' % (i, j)) for i in range(1, 4) for j in range(2)]
+		posts.append(Post(0))
+
+		self.assertTrue(Model.prefetch(posts, 'author.lang') is posts)
+
+		for post in posts:
+			self.assertTrue(post.loaded())
+
+		for i in range(1, 4):
+			self.assertTrue(User(i).loaded())
+			self.assertEqual(User(i).name, 'user%d' % i)
+
+		self.assertTrue(Language(1).loaded())
+		self.assertEqual(Post('1.0').author.lang.name, 'English')
+
+		with self.assertRaises(Exception):
+			Model.prefetch(posts, 'title')
+
+		with self.assertRaises(Exception):
+			Model.prefetch(posts, 'author.unknown')
+
+		Model.free_all()
+
+		posts = (Post.author == User(2)).prefetch('author', 'author.lang')
+		self.assertEqual(len(posts), 2)
+
+		for post in posts:
+			self.assertTrue(post.loaded())
+
+		self.assertTrue(User(2).loaded())
+		self.assertFalse(User(1).loaded())
+		self.assertTrue(Language(1).loaded())
+
+		# Duplicate models and references are requested once.
+		calls = list()
+		handler = redis0.handler
+		pipeline = handler.pipeline
+
+		def counted (*args, **kwargs):
+			pipe = pipeline(*args, **kwargs)
+			hgetall = pipe.hgetall
+			pipe.hgetall = lambda key: calls.append(key) or hgetall(key)
+			return pipe
+
+		handler.pipeline = counted
+
+		try:
+			Model.free_all()
+			posts = [Post('%d.%d' % (i, j)) for i in range(1, 4) for j in range(2)]
+			Model.prefetch(posts + posts, 'author.lang')
+
+		finally:
+			del handler.pipeline
+
+		# 6 posts and 3 users (languages are stored by another connector).
+		self.assertEqual(sorted(calls), sorted(set(calls)))
+		self.assertEqual(len(calls), 9)
+
+	def test_backref (self):
+		users = [User(i) for i in range(1, 4)]
+
+		for i, user in enumerate(users):
+			for j in range(i * 10):
+				post = Post('%d.%d' % (i, j))
+				post.author = user
+				post.save()
+
+		self.assertTrue(User.posts is User.__dict__['posts'])
+		self.assertEqual(User.posts.count_for(users), [0, 10, 20])
+		self.assertEqual(User.posts.count_for([]), [])
+
+		self.assertEqual(users[0].posts.count(), 0)
+		self.assertEqual(len(users[1].posts), 10)
+		self.assertEqual(users[2].posts.count(), 20)
+
+		posts = list(users[2].posts.iter(count=3))
+		self.assertEqual(len(posts), 20)
+		self.assertEqual(set(posts), set(Post('2.%d' % j) for j in range(20)))
+
+		cursor, posts = users[1].posts.page(count=100)
+		self.assertEqual(cursor, 0)
+		self.assertEqual(len(posts), 10)
+
+		self.assertEqual(list(users[0].posts), [])
+
+		Post('2.0').delete()
+		self.assertEqual(users[2].posts.count(), 19)
+
+	def test_lex_idx (self):
+		names = ['ann', 'anna', 'annie', 'bob', 'anna', 'Борис']
+
+		for i, name in enumerate(names):
+			contact = Contact(i)
+			contact.name = name
+			contact.email = '%s%d@Example.com' % (name if i < 5 else 'boris', i)
+			contact.save()
+
+		self.assertFalse(redis0.handler.exists('c:name:ann'))
+		self.assertEqual(redis0.handler.zcard('c:name'), 6)
+		self.assertEqual(redis0.handler.zcard('c:eml'), 6)
+
+		def ids (expr):
+			return sorted(int(contact.getid()) for contact in expr)
+
+		self.assertEqual(ids(Contact.name == 'anna'), [1, 4])
+		self.assertEqual(ids(Contact.name == 'an'), [])
+		self.assertEqual(ids(Contact.name.startswith('ann')), [0, 1, 2, 4])
+		self.assertEqual(ids(Contact.name.startswith('anna')), [1, 4])
+		self.assertEqual(ids(Contact.name.startswith('Бор')), [5])
+		self.assertEqual(ids(Contact.name > 'anna'), [2, 3, 5])
+		self.assertEqual(ids(Contact.name >= 'anna'), [1, 2, 3, 4, 5])
+		self.assertEqual(ids(Contact.name < 'anna'), [0])
+		self.assertEqual(ids(Contact.name <= 'anna'), [0, 1, 4])
+		self.assertEqual(ids(Contact.email.startswith('ANNA')), [1, 4])
+		self.assertEqual(ids(Contact.email == 'BOB3@example.com'), [3])
+
+		# Sorted by value.
+		contacts = Contact.name.startswith('ann')
+		contacts.offset = 1
+		contacts.limit = 2
+		self.assertEqual([contact.name for contact in contacts], ['anna', 'anna'])
+
+		contacts = Contact.name >= 'anna'
+		contacts.offset = 3
+		self.assertEqual([contact.name for contact in contacts], ['bob', 'Борис'])
+
+		contacts = Contact.name.startswith('a')
+		self.assertEqual([contact.name for contact in contacts.iter(chunk=2)], \
+			['ann', 'anna', 'anna', 'annie'])
+		self.assertFalse(contacts.loaded())
+
+		contacts.limit = 3
+		self.assertEqual(len(list(contacts.iter(chunk=2))), 3)
+
+		self.assertEqual(len(Contact.name.choice('anna', 5)), 2)
+		self.assertEqual(Contact.name.choice('none'), None)
+
+		with self.assertRaises(Exception):
+			contact = Contact(6)
+			contact.email = 'ann0@example.com'
+			contact.save()
+
+		contact = Contact(0)
+		contact.name = 'zed'
+		contact.save()
+
+		self.assertEqual(ids(Contact.name == 'ann'), [])
+		self.assertEqual(ids(Contact.name == 'zed'), [0])
+
+		contact.delete()
+
+		self.assertEqual(ids(Contact.name == 'zed'), [])
+		self.assertEqual(ids(Contact.email.startswith('ann0')), [])
+		self.assertEqual(redis0.handler.zcard('c:name'), 5)
+
+		with self.assertRaises(AssertionError):
+			User.name.startswith('J')
+
+	def test_idx_iter (self):
+		for i in range(1, 10):
+			user = User(i)
+			user.name = 'John Smith'
+			user.age = i
+
+		User.save_all()
+
+		users = list((User.name == 'John Smith').iter(chunk=2))
+		self.assertEqual(len(users), 9)
+		self.assertEqual(set(users), set(User(i) for i in range(1, 10)))
+
+		users = User.age >= 3
+		users.limit = 5
+		self.assertEqual(list(users.iter(chunk=2)), [User(i) for i in range(3, 8)])
+
+		users = User.age >= 3
+		users.offset = 5
+		self.assertEqual(list(users.iter(chunk=3)), [User(i) for i in range(8, 10)])
+		self.assertEqual(list(users), [User(i) for i in range(8, 10)])
+
+	def test_composite_idx (self):
+		for i in range(1, 11):
+			account = Account(i)
+			account.status = 'active' if i % 2 else 'blocked'
+			account.name = 'account%d' % (i % 3)
+			account.created = NOW_TS - i
+			account.save()
+
+		self.assertEqual(redis0.handler.zcard('acc:status+created:active'), 5)
+		self.assertEqual(redis0.handler.zcard('acc:status+created:blocked'), 5)
+
+		accounts = Account.status == 'active'
+		accounts &= Account.created >= NOW_TS - 7
+
+		self.assertEqual(list(accounts), [Account(7), Account(5), Account(3), Account(1)])
+
+		accounts = (Account.created < NOW_TS - 2) & (Account.status == 'blocked')
+		accounts.offset = 1
+		accounts.limit = 2
+
+		self.assertEqual(list(accounts), [Account(8), Account(6)])
+
+		accounts = (Account.status == 'blocked') & (Account.created >= 0)
+		self.assertEqual(list(accounts.iter(chunk=2)), [Account(i) for i in range(10, 0, -2)])
+
+		# No matching composite index. Intersection is used instead.
+		accounts = (Account.status == 'active') & (Account.name == 'account1') & \
+			(Account.created <= NOW_TS)
+
+		self.assertEqual(list(accounts), [Account(7), Account(1)])
+
+		accounts = (Account.name == 'account0') & (Account.status == 'blocked')
+		self.assertEqual(set(accounts), set([Account(6)]))
+
+		# Index update.
+		account = Account(1)
+		account.status = 'blocked'
+		account.save()
+
+		self.assertEqual(redis0.handler.zscore('acc:status+created:blocked', '1'), NOW_TS - 1)
+		self.assertEqual(redis0.handler.zscore('acc:status+created:active', '1'), None)
+
+		account.created = NOW_TS
+		account.save()
+
+		self.assertEqual(redis0.handler.zscore('acc:status+created:blocked', '1'), NOW_TS)
+
+		del account['created']
+		account.save()
+
+		self.assertEqual(redis0.handler.zscore('acc:status+created:blocked', '1'), None)
+
+		Account(2).delete()
+		self.assertEqual(redis0.handler.zscore('acc:status+created:blocked', '2'), None)
+		self.assertEqual(redis0.handler.zcard('acc:status+created:blocked'), 4)
+
+		# Stored values of not loaded model are fetched by single HMGET.
+		calls = list()
+		handler = redis0.handler
+		hget, hmget = handler.hget, handler.hmget
+		handler.hget = lambda *args: calls.append('hget') or hget(*args)
+		handler.hmget = lambda *args: calls.append('hmget') or hmget(*args)
+
+		try:
+			Model.free_all()
+			account = Account(4)
+			account.created = NOW_TS
+			account.save()
+
+		finally:
+			del handler.hget, handler.hmget
+
+		self.assertEqual(calls, ['hmget'])
+		self.assertEqual(redis0.handler.zscore('acc:status+created:blocked', '4'), NOW_TS)
+
+	def test_compact_layout (self):
+		self.assertEqual(User.getlayout(), 'sets')
+		self.assertEqual(CompactContact.getlayout(), 'compact')
+		self.assertEqual(CompactContact.getbuckets(), 4)
+
+		def bucket (email):
+			return redis0.hidx_key(CompactContact, 'eml', email)
+
+		for i in range(1, 6):
+			contact = CompactContact(i)
+			contact.email = 'user%d@example.com' % i
+			contact.city = 'London' if i % 2 else 'Paris'
+			contact.save()
+
+		buckets = set(bucket('user%d@example.com' % i) for i in range(1, 6))
+
+		# Hashes, prefix set, email buckets and city sets.
+		self.assertEqual(redis0.handler.dbsize(), 5 + 1 + len(buckets) + 2)
+		self.assertTrue(all(key.startswith('cc:eml:#') for key in buckets))
+
+		self.assertEqual(redis0.handler.hget(bucket('user1@example.com'), 'user1@example.com'), b'1')
+		self.assertEqual(redis0.handler.smembers('cc:city:London'), set([b'1', b'3', b'5']))
+
+		self.assertEqual(list(CompactContact.email == 'USER2@example.com'), [CompactContact(2)])
+		self.assertEqual(list(CompactContact.email == 'none@example.com'), [])
+		self.assertEqual(set(CompactContact.city == 'London'), \
+			set([CompactContact(1), CompactContact(3), CompactContact(5)]))
+
+		self.assertEqual(CompactContact.email.choice('user3@example.com'), [CompactContact(3)])
+		self.assertEqual(len(CompactContact.city.choice('Paris', 5)), 2)
+
+		with self.assertRaises(Exception):
+			contact = CompactContact(6)
+			contact.email = 'user1@example.com'
+			contact.save()
+
+		contact = CompactContact(1)
+		contact.email = 'john@example.com'
+		contact.city = 'Paris'
+		contact.save()
+
+		self.assertEqual(redis0.handler.hget(bucket('user1@example.com'), 'user1@example.com'), None)
+		self.assertEqual(redis0.handler.hget(bucket('john@example.com'), 'john@example.com'), b'1')
+		self.assertEqual(len(CompactContact.city == 'London'), 2)
+		self.assertEqual(len(CompactContact.city == 'Paris'), 3)
+
+		contact.delete()
+
+		self.assertEqual(sum(redis0.handler.hlen(key) for key in \
+			redis0.handler.keys('cc:eml:#*')), 4)
+		self.assertEqual(redis0.handler.scard('cc:city:Paris'), 2)
+		self.assertEqual(list(CompactContact.email == 'john@example.com'), [])
+
+		# Index check scans all buckets.
+		report = CompactContact.check_indexes()
+		self.assertEqual(report['eml'], {'missing': 0, 'orphans': 0})
+
+	def test_reindex (self):
+		# Models saved before indexes were enabled.
+		for i in range(1, 101):
+			redis0.handler.hmset('u:%d' % i, {'age': i % 10, 'name': 'user%d' % (i % 2)})
+			redis0.handler.sadd('u', i)
+
+		redis0.handler.hmset('u:101', {'eml': 'foo@bar.com'})
+		redis0.handler.sadd('u', 101)
+
+		self.assertEqual(len(User.age == 5), 0)
+
+		progress = list()
+		count = User.reindex('age', chunk=10, callback=lambda count, cursor: progress.append(count))
+
+		self.assertEqual(count, 101)
+		self.assertEqual(progress[-1], 101)
+		self.assertEqual(redis0.handler.zcard('u:age'), 100)
+		self.assertEqual(len(User.age == 5), 10)
+		self.assertFalse(redis0.handler.exists('u:__reindex__:age'))
+
+		self.assertEqual(User.reindex('name', workers=2, chunk=10, delay=0.01), 101)
+		self.assertEqual(len(User.name == 'user0'), 50)
+		self.assertEqual(len(User.name == 'user1'), 50)
+
+		self.assertEqual(main(['reindex', '--quiet', 'redisca2.tests:User', 'email']), 0)
+		self.assertEqual((User.email == 'foo@bar.com')[0], User(101))
+
+	def test_check_indexes (self):
+		for i in range(1, 21):
+			user = User(i)
+			user.name = 'user%d' % (i % 2)
+			user.age = i
+
+			contact = CompactContact(i)
+			contact.email = 'user%d@example.com' % i
+			contact.city = 'city%d' % (i % 3)
+
+		Model.save_all()
+
+		empty = {'missing': 0, 'orphans': 0}
+
+		self.assertEqual(User.check_indexes(chunk=5), {
+			'eml': empty,
+			'name': empty,
+			'age': empty,
+			'lang': empty,
+		})
+
+		# Changed without index update.
+		redis0.handler.hset('u:1', 'name', 'John Smith')
+		redis0.handler.hset('u:2', 'age', 50)
+
+		# Lost entries.
+		redis0.handler.srem('u:name:user1', 3)
+		redis0.handler.zrem('u:age', 4)
+		redis0.handler.hdel(redis0.hidx_key(CompactContact, 'eml', 'user5@example.com'), \
+			'user5@example.com')
+		redis0.handler.srem('cc:city:city0', 6)
+
+		# Ghosts.
+		redis0.handler.sadd('u:name:user0', 100)
+		redis0.handler.zadd('u:age', **{'100': 10})
+		redis0.handler.hset(redis0.hidx_key(CompactContact, 'eml', 'ghost@example.com'), \
+			'ghost@example.com', 100)
+		redis0.handler.sadd('cc:city:city1', 100)
+
+		problems = list()
+		callback = lambda field, kind, model_id, val: problems.append((field.name, kind, model_id))
+
+		self.assertEqual(User.check_indexes(chunk=5, callback=callback), {
+			'eml': empty,
+			'name': {'missing': 2, 'orphans': 2},
+			'age': {'missing': 2, 'orphans': 2},
+			'lang': empty,
+		})
+
+		self.assertEqual(sorted(problems), sorted([
+			('name', 'missing', '1'),
+			('name', 'missing', '3'),
+			('name', 'orphan', '1'),
+			('name', 'orphan', '100'),
+			('age', 'missing', '2'),
+			('age', 'missing', '4'),
+			('age', 'orphan', '2'),
+			('age', 'orphan', '100'),
+		]))
+
+		self.assertEqual(CompactContact.check_indexes(), {
+			'eml': {'missing': 1, 'orphans': 1},
+			'city': {'missing': 1, 'orphans': 1},
+		})
+
+		User.check_indexes(repair=True)
+		CompactContact.check_indexes(repair=True)
+
+		self.assertEqual(User.check_indexes(chunk=5)['name'], empty)
+		self.assertEqual(User.check_indexes(chunk=5)['age'], empty)
+		self.assertEqual(CompactContact.check_indexes()['eml'], empty)
+		self.assertEqual(CompactContact.check_indexes()['city'], empty)
+
+		self.assertEqual(list(User.name == 'John Smith'), [User(1)])
+		self.assertFalse(User(1) in (User.name == 'user1'))
+		self.assertTrue(User(3) in (User.name == 'user1'))
+		self.assertFalse(User(100) in (User.name == 'user0'))
+		self.assertEqual(list(User.age == 50), [User(2)])
+		self.assertEqual(list(User.age == 10), [User(10)])
+		self.assertEqual(list(CompactContact.email == 'user5@example.com'), [CompactContact(5)])
+		self.assertEqual(list(CompactContact.email == 'ghost@example.com'), [])
+		self.assertEqual(len(CompactContact.city == 'city0'), 6)
+
+	def test_aggregate (self):
+		self.assertEqual(User.age.min(), None)
+		self.assertEqual(User.age.percentile(50), None)
+		self.assertEqual(User.age.histogram(2), [])
+
+		for i in range(1, 11):
+			user = User(i)
+			user.name = 'user%d' % (i % 2)
+			user.age = i * 10
+
+		User.save_all()
+
+		self.assertEqual(User.age.min(), 10)
+		self.assertEqual(User.age.max(), 100)
+		self.assertEqual(User.age.percentile(0), 10)
+		self.assertEqual(User.age.percentile(50), 50)
+		self.assertEqual(User.age.percentile(51), 60)
+		self.assertEqual(User.age.percentile(95), 100)
+		self.assertEqual(User.age.percentile(100), 100)
+		self.assertEqual(User.age.count_between(20, 40), 3)
+
+		self.assertEqual([count for _, _, count in User.age.histogram(3)], [3, 3, 4])
+		self.assertEqual(User.age.histogram([0, 50, 100]), [(0, 50, 4), (50, 100, 6)])
+
+		# Filtered by the same field.
+		self.assertEqual(User.age.max(where=User.age < 70), 60)
+		self.assertEqual(User.age.min(where=User.age > 70), 80)
+		self.assertEqual(User.age.count_between(20, 90, where=User.age >= 50), 5)
+
+		# Filtered by another index.
+		self.assertEqual(User.age.max(where=User.name == 'user1'), 90)
+		self.assertEqual(User.age.min(where=User.name == 'user0'), 20)
+		self.assertEqual(User.age.count_between(0, 50, where=User.name == 'user0'), 2)
+		self.assertEqual(User.age.percentile(50, where=User.name == 'user1'), 50)
+		self.assertEqual(User.age.min(where=User.name == 'nobody'), None)
+
+		# Temporary keys are removed.
+		self.assertEqual(redis0.handler.keys('u:__tmp__:*'), [])
+
+	def test_gather (self):
+		for i in range(1, 11):
+			user = User(i)
+			user.name = 'user%d' % (i % 2)
+			user.age = i
+
+			contact = Contact(i)
+			contact.email = 'user%d@example.com' % i
+
+			account = Account(i)
+			account.status = 'active' if i % 2 else 'blocked'
+			account.name = 'acc%d' % (i % 3)
+			account.created = NOW_TS + i
+
+		Model.save_all()
+		Model.free_all()
+
+		page = User.age >= 5
+		page.limit = 3
+
+		exprs = gather(
+			User.name == 'user1',
+			page,
+			Contact.email.startswith('user1'),
+			CompactContact.email == 'nobody@example.com',
+			(Account.status == 'active') & (Account.created > NOW_TS + 3),
+			(Account.status == 'active') & (Account.name == 'acc1'),
+		)
+
+		for expr in exprs:
+			self.assertTrue(expr.loaded())
+
+		self.assertEqual(set(exprs[0].models), set(User(i) for i in (1, 3, 5, 7, 9)))
+		self.assertEqual(exprs[1].models, [User(5), User(6), User(7)])
+		self.assertEqual(exprs[2].models, [Contact(10), Contact(1)])
+		self.assertEqual(exprs[3].models, [])
+		self.assertEqual(exprs[4].models, [Account(5), Account(7), Account(9)])
+		self.assertEqual(set(exprs[5].models), set([Account(1), Account(7)]))
+		self.assertFalse(User(1).loaded())
+
+		Model.free_all()
+
+		users, contacts = gather(
+			User.name == 'user0',
+			Contact.email == 'user2@example.com',
+			hydrate=True,
+		)
+
+		self.assertEqual(len(users), 5)
+		self.assertTrue(all(user.loaded() for user in users))
+		self.assertEqual(contacts[0].email, 'user2@example.com')
+
+	def test_query_cache (self):
+		cache = CachedUser.getdb().cache
+		cache.clear()
+
+		for i in range(1, 11):
+			user = CachedUser(i)
+			user.name = 'user%d' % (i % 2)
+			user.age = i
+
+		Model.save_all()
+
+		self.assertEqual(len(CachedUser.age >= 5), 6)
+		self.assertEqual(len(CachedUser.name == 'user1'), 5)
+		self.assertEqual(len(cache), 2)
+
+		# Not versioned changes are not visible.
+		redis0.handler.zadd('cu:age', **{'100': 100})
+		redis0.handler.sadd('cu:name:user1', 100)
+
+		self.assertEqual(len(CachedUser.age >= 5), 6)
+		self.assertEqual(len(CachedUser.name == 'user1'), 5)
+
+		# Signature is built of db values so equal ones share cache entry.
+		self.assertEqual(len(CachedUser.age >= '5'), 6)
+		self.assertEqual(len(cache), 2)
+		self.assertEqual(
+			RedisConnector.signature(Post.author == User(1)),
+			RedisConnector.signature(Post.author == '1'),
+		)
+
+		users = CachedUser.age >= 5
+		users.limit = 2
+		self.assertEqual(list(users), [CachedUser(5), CachedUser(6)])
+		self.assertEqual(len(cache), 3)
+
+		# Index version is bumped on save.
+		user = CachedUser(11)
+		user.age = 50
+		user.save()
+
+		self.assertEqual(len(CachedUser.age >= 5), 8)
+		self.assertEqual(len(CachedUser.name == 'user1'), 5)
+
+		# And on delete.
+		CachedUser(1).delete()
+
+		self.assertEqual(len(CachedUser.name == 'user1'), 5)
+		self.assertEqual(CachedUser(1) in (CachedUser.name == 'user1'), False)
+
+		users, = gather(CachedUser.age >= 5)
+		self.assertEqual(len(users), 8)
+
+		# Each save and delete bumps versions of touched indexes.
+		self.assertEqual(redis0.handler.hget('cu:__ver__', 'age'), b'12')
+		self.assertEqual(redis0.handler.hget('cu:__ver__', 'name'), b'11')
+
+		# Versions are not maintained without cache.
+		user = User(1)
+		user.name = 'John'
+		user.save()
+		user.delete()
+
+		self.assertFalse(redis0.handler.exists('u:__ver__'))
+
+	def test_collections (self):
+		self.assertEqual(sorted(Profile.getcollections()), ['log', 'scores', 'tags'])
+		self.assertEqual(sorted(Profile.getfields()), ['name'])
+
+		# Custom collections must implement abstract methods.
+		class Incomplete (BoundCollection):
+			def count (self):
+				return 0
+
+		with self.assertRaises(TypeError):
+			Incomplete(Profile.log, Profile(1))
+
+		with self.assertRaises(TypeError):
+			Collection('incomplete')
+
+		profile = Profile(1)
+		profile.name = 'John'
+		profile.log.append('a', 'b')
+		profile.log.prepend('0')
+		profile.tags.add('red', 'green')
+		profile.scores.add(10, 1.5)
+		profile.scores.add(20, 0.5)
+
+		# Changes are pending until save.
+		self.assertEqual(len(profile.log), 0)
+		self.assertFalse(redis0.handler.exists('prof:1:log'))
+
+		profile.save()
+
+		self.assertEqual(len(profile.log), 3)
+		self.assertEqual(profile.log.page(), ['0', 'a', 'b'])
+		self.assertEqual(profile.log.page(1, 1), ['a'])
+		self.assertEqual(profile.log[-1], 'b')
+		self.assertEqual(len(profile.tags), 2)
+		self.assertTrue('red' in profile.tags)
+		self.assertFalse('blue' in profile.tags)
+		self.assertEqual(profile.scores.page(), [(20, 0.5), (10, 1.5)])
+		self.assertEqual(profile.scores.rank(10), 1)
+		self.assertEqual(profile.scores.range(1, 2), [(10, 1.5)])
+		self.assertEqual(redis0.handler.hgetall('prof:1'), {b'name': b'John'})
+
+		# Collections only changes are saved too.
+		for i in range(250):
+			profile.log.append('x%d' % i)
+
+		profile.tags.remove('red')
+		profile.scores.incr(20, 5)
+		profile.save()
+
+		self.assertEqual(len(profile.log), 253)
+		self.assertEqual(len(list(profile.log.iter(count=100))), 253)
+		self.assertEqual(sorted(profile.tags.iter(count=1)), ['green'])
+		self.assertEqual(list(profile.scores), [(10, 1.5), (20, 5.5)])
+
+		profile.log.trim(0, 1)
+		profile.log.remove('0')
+		profile.tags = ['a', 'b', 'c']
+		profile.save()
+
+		self.assertEqual(list(profile.log), ['a'])
+		self.assertEqual(sorted(profile.tags), ['a', 'b', 'c'])
+
+		# Pending changes are reverted.
+		profile.tags.add('d')
+		profile.revert()
+		profile.save()
+
+		self.assertEqual(len(profile.tags), 3)
+
+		profile.delete()
+
+		for name in ('log', 'tags', 'scores'):
+			self.assertFalse(redis0.handler.exists('prof:1:' + name))
+
+	def test_deferred (self):
+		text = u'Привет, мир! ' * 100
+
+		for i in range(1, 6):
+			article = Article(i)
+			article.title = 'title%d' % i
+			article.summary = 'summary%d' % i
+			article.body = text + str(i)
+
+		Model.save_all()
+
+		self.assertEqual(sorted(redis0.handler.hgetall('art:1')), [b'summary', b'title'])
+		self.assertTrue(redis0.handler.get('art:1:body').startswith(b'\x00z'))
+		self.assertTrue(len(redis0.handler.get('art:1:body')) < len(text))
+		self.assertEqual(redis0.handler.hget('art:1', 'summary'), b'summary1')
+
+		Model.free_all()
+
+		article = Article(1)
+		self.assertEqual(article.title, 'title1')
+		self.assertEqual(article._lazy, {})
+		self.assertEqual(article.body, text + '1')
+		self.assertTrue('body' in article)
+
+		# Compressed hash value.
+		article.summary = text
+		article.save()
+
+		self.assertTrue(redis0.handler.hget('art:1', 'summary').startswith(b'\x00z'))
+
+		Model.free_all()
+
+		self.assertEqual(Article(1).summary, text)
+		self.assertEqual(Article(1).get('summary'), Article(1)['summary'])
+
+		# Deferred values are batched by prefetch.
+		Model.free_all()
+
+		articles = [Article(i) for i in range(1, 6)]
+		Model.prefetch(articles, 'body')
+
+		for i, article in enumerate(articles):
+			self.assertTrue(article.loaded())
+			self.assertEqual(article._lazy['body'], article['body'])
+			self.assertEqual(article.body, text + str(i + 1))
+
+		Model.free_all()
+
+		articles = [Article(i) for i in range(1, 6)]
+		Article.load_deferred(articles, 'body')
+
+		self.assertFalse(articles[0].loaded())
+		self.assertEqual(articles[4].body, text + '5')
+
+		# Removal.
+		article = Article(2)
+		article.body = None
+		article.save()
+
+		self.assertFalse(redis0.handler.exists('art:2:body'))
+		self.assertEqual(Article(2).body, None)
+		self.assertFalse('body' in Article(2))
+
+		Article(3).delete()
+		self.assertFalse(redis0.handler.exists('art:3:body'))
+		self.assertFalse(redis0.handler.exists('art:3'))
+
+	def test_json (self):
+		settings = Settings(1)
+		settings.data = {'theme': 'dark', 'tabs': [1, 2]}
+		settings.flags = {'beta': True, 'limits': {'rps': 10}}
+		settings.save()
+
+		self.assertEqual(redis0.handler.hgetall('cfg:1'), {
+			b'data': b'{"tabs":[1,2],"theme":"dark"}',
+			b'flags.beta': b'true',
+			b'flags.limits': b'{"rps":10}',
+		})
+
+		Model.free_all()
+
+		settings = Settings(1)
+		data = settings.data
+
+		# Parsed once per loaded data.
+		self.assertTrue(settings.data is data)
+		self.assertEqual(data, {'theme': 'dark', 'tabs': [1, 2]})
+		self.assertEqual(settings.flags, {'beta': True, 'limits': {'rps': 10}})
+
+		# In-place changes are detected.
+		data['tabs'].append(3)
+		settings.flags['limits']['rps'] = 20
+		del settings.flags['beta']
+		settings.flags['new'] = 1
+
+		settings.save()
+		self.assertTrue(settings.data is data)
+
+		self.assertEqual(redis0.handler.hgetall('cfg:1'), {
+			b'data': b'{"tabs":[1,2,3],"theme":"dark"}',
+			b'flags.limits': b'{"rps":20}',
+			b'flags.new': b'1',
+		})
+
+		# Unchanged values are not written.
+		settings.data
+		settings.flags
+		settings.save()
+
+		self.assertEqual(settings.getdiff(), {})
+
+		Model.free_all()
+
+		self.assertEqual(Settings(1).data['tabs'], [1, 2, 3])
+		self.assertEqual(Settings(1).flags, {'limits': {'rps': 20}, 'new': 1})
+
+		Settings(1).flags = None
+		Settings(1).data = None
+		Settings(1).save()
+
+		self.assertEqual(redis0.handler.exists('cfg:1'), 0)
+		self.assertEqual(Settings(1).flags, None)
+
+	@skipIf(msgpack is None, 'msgpack is not installed')
+	def test_msgpack (self):
+		@conf(prefix='mp')
+		class Packed (Model):
+			data = MsgPack(
+				name='data',
+			)
+
+		packed = Packed(1)
+		packed.data = {'a': [1, 2], 'b': u'Привет'}
+		packed.save()
+
+		self.assertEqual(msgpack.unpackb(redis0.handler.hget('mp:1', 'data'), raw=False), \
+			{'a': [1, 2], 'b': u'Привет'})
+
+		Model.free_all()
+
+		packed = Packed(1)
+		packed.data['a'].append(3)
+		packed.save()
+
+		Model.free_all()
+
+		self.assertEqual(Packed(1).data, {'a': [1, 2, 3], 'b': u'Привет'})
+
+		# Binary values are dumped base64 encoded.
+		lines = list(Packed.dump())
+		self.assertTrue('$bytes' in loads(lines[0])['data'])
+
+		redis0.handler.flushdb()
+		Model.free_all()
+
+		Packed.bulk_load((loads(line) for line in lines), validate=False)
+		self.assertEqual(Packed(1).data, {'a': [1, 2, 3], 'b': u'Привет'})
+
+	def test_batch (self):
+		with batch(chunk=2) as b:
+			for i in range(1, 6):
+				user = User(i)
+				user.email = 'user%d@example.com' % i
+				user.age = i
+				user.save()
+
+			contact = Contact(1)
+			contact.email = 'contact@example.com'
+			contact.save()
+
+			# Captured only.
+			self.assertEqual(len(b), 6)
+			self.assertFalse(redis0.handler.exists('u:1'))
+			self.assertEqual(User(1).getdiff(), {'eml': 'user1@example.com', 'age': 1})
+
+		self.assertEqual(len(b), 0)
+		self.assertEqual(User(1).getdiff(), {})
+		self.assertTrue(User(1)._exists)
+		self.assertEqual(redis0.handler.hget('u:3', 'eml'), b'user3@example.com')
+		self.assertEqual(redis0.handler.hget('c:1', 'eml'), b'contact@example.com')
+		self.assertEqual(len(User.age >= 1), 5)
+
+		# Save and delete of the same model: the last one wins.
+		with batch(transaction=True):
+			User(1).age = 10
+			User(1).save()
+			User(1).delete()
+
+		self.assertFalse(redis0.handler.exists('u:1'))
+		self.assertFalse(User(1)._exists)
+
+		# Save after delete replaces model (old fields are removed).
+		with batch(transaction=True):
+			User(2).delete()
+			User(2).age = 20
+			User(2).save()
+
+		self.assertEqual(redis0.handler.hgetall('u:2'), {b'age': b'20'})
+		self.assertEqual(list(User.email == 'user2@example.com'), [])
+		self.assertEqual(list(User.age == 2), [])
+		self.assertEqual(list(User.age == 20), [User(2)])
+		self.assertTrue(User(2)._exists)
+		self.assertEqual(User(2).getdiff(), {})
+		self.assertEqual(User(2).email, None)
+		self.assertEqual(User(2).age, 20)
+
+		# Unique constraints are checked before writing.
+		User(3).age = 30
+		User(4).email = 'user5@example.com'
+
+		with self.assertRaises(Exception):
+			with batch():
+				User(3).save()
+				User(4).save()
+
+		self.assertEqual(redis0.handler.hget('u:3', 'age'), b'3')
+		self.assertEqual(User(4).getdiff(), {'eml': 'user5@example.com'})
+
+		User(4).revert()
+		User(6).email = 'new@example.com'
+		User(7).email = 'new@example.com'
+
+		with self.assertRaises(Exception):
+			with batch():
+				User(6).save()
+				User(7).save()
+
+		self.assertFalse(redis0.handler.exists('u:6'))
+
+		# Nothing is written on exception.
+		with self.assertRaises(ValueError):
+			with batch():
+				User(6).save()
+				raise ValueError()
+
+		self.assertFalse(redis0.handler.exists('u:6'))
+		self.assertEqual(batch.current(), None)
+
+		# save_all() is captured too.
+		User(6).revert()
+		User(7).revert()
+		User(5).age = 50
+
+		with batch():
+			Model.save_all()
+
+		self.assertEqual(redis0.handler.hget('u:5', 'age'), b'50')
+
+	def test_flask (self):
+		class App (object):
+			""" Fake Flask application: registered hooks are called by
+			request(). """
+
+			config = {'REDISCA': {'db': 0}}
+
+			def before_request (self, func):
+				self.before = func
+
+			def teardown_request (self, func):
+				self.teardown = func
+
+			def request (self, func):
+				self.before()
+
+				try:
+					func()
+
+				except ValueError as exc:
+					self.teardown(exc)
+
+				else:
+					self.teardown(None)
+
+		user = User(1)
+		app = App()
+		found = list()
+		writes = list()
+
+		try:
+			FlaskRedisca(app, autosave=True)
+
+			db = conf.db
+			write_batch = db.write_batch
+			db.write_batch = lambda ops, *args: writes.append(len(ops)) or \
+				write_batch(ops, *args)
+
+			def change ():
+				self.assertTrue(scope.current() is not scope.default)
+				found.append(User(1))
+				User(1).name = 'John'
+				User(2).name = 'Jane'
+				self.assertEqual(redis0.handler.keys('u:*'), [])
+
+			app.request(change)
+
+			# Autosave is done by single batch.
+			self.assertEqual(writes, [2])
+			self.assertEqual(redis0.handler.hget('u:1', 'name'), b'John')
+			self.assertEqual(redis0.handler.hget('u:2', 'name'), b'Jane')
+			self.assertTrue(scope.current() is scope.default)
+
+			# Models of previous request are not seen by the next one.
+			def fail ():
+				found.append(User(1))
+				User(1).name = 'Steve'
+				raise ValueError()
+
+			app.request(fail)
+
+			self.assertTrue(found[1] is not found[0])
+			self.assertTrue(user not in found)
+			self.assertEqual(found[1].getdiff()['name'], 'Steve')
+			self.assertEqual(redis0.handler.hget('u:1', 'name'), b'John')
+			self.assertEqual(writes, [2])
+			self.assertTrue(scope.current() is scope.default)
+			self.assertTrue(User(1) is user)
+
+		finally:
+			conf.db = redis0
+
+	def test_scope (self):
+		user = User(1)
+
+		with scope() as current:
+			self.assertTrue(scope.current() is current)
+			self.assertTrue(User(1) is not user)
+			self.assertTrue(User(1) is User(1))
+			self.assertEqual(list(User._objects), ['1'])
+
+			# Cleanup of current scope only.
+			User.free_all()
+
+		self.assertTrue(scope.current() is scope.default)
+		self.assertTrue(User(1) is user)
+
+		# Shared layer.
+		Language('en').name = 'English'
+		Language('en').save()
+
+		with scope.shared_layer:
+			lang = Language('en')
+			lang.load()
+
+		with scope(shared=True):
+			# Copied into scope with loaded data.
+			copy = Language('en')
+			self.assertTrue(copy is not lang)
+			self.assertTrue(Language('en') is copy)
+			self.assertTrue(copy.loaded())
+			self.assertEqual(copy.name, 'English')
+
+			# Changes are local to scope.
+			copy.name = 'British English'
+			self.assertEqual(lang.name, 'English')
+
+			copy.free()
+			copy.free()
+			self.assertEqual(Language('en').name, 'English')
+
+			with scope():
+				self.assertTrue(Language('en') is not lang)
+				self.assertFalse(Language('en').loaded())
+
+		self.assertTrue(Language('en') is not lang)
+		self.assertEqual(len(scope.shared_layer.registry(Language)), 1)
+
+		# Concurrent scopes.
+		found = list()
+
+		def worker ():
+			with scope():
+				found.append(User(1))
+				found.append(User(1))
+
+		threads = [Thread(target=worker) for _ in range(4)]
+
+		for thread in threads:
+			thread.start()
+
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(len(set(id(model) for model in found)), 4)
+		self.assertTrue(user not in found)
+
+		scope.shared_layer.registries.clear()
+
+	def test_cas (self):
+		counter = Counter(1)
+		counter.hits = 1
+		counter.save(cas=True)
+
+		self.assertEqual(redis0.handler.hgetall('cnt:1'), {b'hits': b'1', b'ver': b'1'})
+		self.assertEqual(counter.ver, 1)
+
+		merges = list()
+
+		def merge (model, changes):
+			merges.append(changes)
+			model.hits += 1
+
+		with scope():
+			first = Counter(1)
+			self.assertEqual(first.hits, 1)
+
+			# Concurrent writer.
+			with scope():
+				second = Counter(1)
+				second.hits += 1
+				second.save(cas=True)
+
+				self.assertEqual(second.ver, 2)
+
+			first.hits += 1
+
+			with self.assertRaises(Exception):
+				first.save(cas=True)
+
+			# Changes are reverted and fresh data is loaded.
+			self.assertEqual(first.getdiff(), {})
+			self.assertEqual(first.hits, 2)
+
+			with scope():
+				third = Counter(1)
+				third.hits += 1
+				third.save(cas=True)
+
+			first.hits += 1
+			first.save(cas=True, merge=merge)
+
+			self.assertEqual(merges, [{'hits': 3}])
+			self.assertEqual(first.hits, 4)
+			self.assertEqual(first.ver, 4)
+
+		self.assertEqual(redis0.handler.hgetall('cnt:1'), {b'hits': b'4', b'ver': b'4'})
+
+		# Plain save increments version too.
+		with scope():
+			counter = Counter(1)
+			counter.hits = 10
+			counter.save()
+
+			self.assertEqual(redis0.handler.hget('cnt:1', 'ver'), b'5')
+			self.assertEqual(counter.ver, 5)
+
+			counter.hits = 11
+			counter.save(cas=True)
+
+		self.assertEqual(redis0.handler.hgetall('cnt:1'), {b'hits': b'11', b'ver': b'6'})
+
+		# Retries limit.
+		def conflict (model, changes):
+			merges.append(model.hits)
+
+			with scope():
+				other = Counter(1)
+				other.hits += 1
+				other.save()
+
+			model.hits = 100
+
+		del merges[:]
+
+		with scope():
+			counter = Counter(1)
+			counter.load()
+
+			conflict(counter, {})
+
+			with self.assertRaises(Exception):
+				counter.save(cas=True, merge=conflict, retries=2)
+
+		self.assertEqual(merges, [11, 12, 13])
+		self.assertEqual(redis0.handler.hget('cnt:1', 'hits'), b'14')
+
+		# Stale data loaded before plain save is not saved by CAS.
+		with scope():
+			counter = Counter(1)
+			counter.load()
+			counter.hits = 0
+			counter.save()
+
+			self.assertEqual(counter.ver, 10)
+
+			with scope():
+				other = Counter(1)
+				other.hits = 100
+				other.save()
+
+			counter.hits = counter.hits + 1
+
+			with self.assertRaises(Exception):
+				counter.save(cas=True)
+
+		self.assertEqual(redis0.handler.hgetall('cnt:1'), {b'hits': b'100', b'ver': b'11'})
+
+		# Version field is required.
+		User(1).age = 1
+
+		with self.assertRaises(Exception):
+			User(1).save(cas=True)
+
+	def test_stream (self):
+		consumer = StreamConsumer('ev:changes', 'indexer', 'worker1', db=redis0)
+		consumer.create_group()
+		consumer.create_group() # Exists already.
+
+		self.assertEqual(Event.getstream(), ('ev:changes', 1000))
+		self.assertEqual(User.getstream(), None)
+
+		for i in range(1, 4):
+			event = Event(i)
+			event.title = 'event%d' % i
+			event.save()
+
+		event = Event(1)
+		event.kind = 'meetup'
+		event.tags.add('a')
+		event.save()
+
+		Event(2).delete()
+
+		self.assertEqual(redis0.handler.execute_command('XLEN', 'ev:changes'), 5)
+
+		Model.free_all()
+
+		changes = consumer.read(count=10)
+
+		self.assertEqual([(change.model, change.op, change.fields) for change in changes], [
+			(Event(1), 'save', ['title']),
+			(Event(2), 'save', ['title']),
+			(Event(3), 'save', ['title']),
+			(Event(1), 'save', ['kind', 'tags']),
+			(Event(2), 'delete', []),
+		])
+
+		# Hydrated.
+		self.assertTrue(Event(1).loaded())
+		self.assertEqual(Event(1).kind, 'meetup')
+
+		# Not acknowledged changes are pending.
+		self.assertEqual(consumer.read(), [])
+		self.assertEqual(len(consumer.read(pending=True)), 5)
+
+		consumer.ack(changes[:3])
+		self.assertEqual(len(consumer.read(pending=True)), 2)
+
+		consumer.ack(changes[3:])
+
+		for i in range(4, 9):
+			event = Event(i)
+			event.title = 'event%d' % i
+			event.save()
+
+		batches = [[change.model for change in changes] \
+			for changes in consumer.iter(count=2, block=10)]
+
+		self.assertEqual(batches, [
+			[Event(4), Event(5)],
+			[Event(6), Event(7)],
+			[Event(8)],
+		])
+
+		self.assertEqual(consumer.read(pending=True), [])
+
+	def test_sample (self):
+		self.assertEqual(User.sample(5), [])
+		self.assertEqual((User.age >= 0).sample(5), [])
+
+		for i in range(1, 21):
+			user = User(i)
+			user.name = 'John Smith' if i % 2 else 'Jane Doe'
+			user.age = i
+			user.save()
+
+		Model.free_all()
+
+		users = User.sample(5)
+		self.assertEqual(len(users), 5)
+		self.assertEqual(len(set(users)), 5)
+		self.assertFalse(any(user.loaded() for user in users))
+
+		users = User.sample(50, hydrate=True)
+		self.assertEqual(set(users), set(User(i) for i in range(1, 21)))
+		self.assertTrue(all(user.loaded() for user in users))
+
+		# Exact index.
+		users = (User.name == 'John Smith').sample(3)
+		self.assertEqual(len(set(users)), 3)
+		self.assertTrue(all(int(user.getid()) % 2 for user in users))
+
+		# Range index.
+		for _ in range(10):
+			users = (User.age > 15).sample(3)
+			self.assertEqual(len(set(users)), 3)
+			self.assertTrue(all(16 <= int(user.getid()) <= 20 for user in users))
+
+		users = (User.age <= 3).sample(10)
+		self.assertEqual(set(users), set([User(1), User(2), User(3)]))
+
+		users = User.age >= 5
+		users.offset = 2
+		users.limit = 3
+		self.assertEqual(set(users.sample(10)), set([User(7), User(8), User(9)]))
+
+		self.assertEqual((User.age > 20).sample(), [])
+
+		# Lex index.
+		for i, name in enumerate(['ann', 'anna', 'annie', 'bob', 'anna']):
+			contact = Contact(i)
+			contact.name = name
+			contact.email = '%s%d@example.com' % (name, i)
+			contact.save()
+
+		contacts = Contact.name.startswith('ann').sample(10, hydrate=True)
+		self.assertEqual(set(contact.name for contact in contacts), \
+			set(['ann', 'anna', 'annie']))
+		self.assertEqual(len(contacts), 4)
+
+		self.assertEqual(set((Contact.name > 'anna').sample(10)), \
+			set([Contact(2), Contact(3)]))
+
+		# Composite index.
+		for i in range(1, 11):
+			account = Account(i)
+			account.status = 'active' if i % 2 else 'blocked'
+			account.name = 'account%d' % (i % 3)
+			account.created = NOW_TS - i
+			account.save()
+
+		accounts = (Account.status == 'active') & (Account.created >= NOW_TS - 7)
+		self.assertEqual(set(accounts.sample(10)), \
+			set([Account(7), Account(5), Account(3), Account(1)]))
+
+		# Intersection.
+		accounts = (Account.name == 'account0') & (Account.status == 'blocked')
+		self.assertEqual(accounts.sample(2), [Account(6)])
+
+	@skipIf(numpy is None, 'numpy is not installed')
+	def test_to_columns (self):
+		@conf(prefix='rep')
+		class Report (Model):
+			title = String(
+				name='title',
+			)
+
+			views = Integer(
+				name='views',
+				index=True,
+			)
+
+			published = DateTime(
+				name='pub',
+			)
+
+			public = Bool(
+				name='pub_flag',
+			)
+
+		for i in range(1, 6):
+			report = Report(i)
+			report.title = 'report%d' % i
+			report.views = i * 10
+			report.public = i % 2
+			report.published = NOW_TS + i if i != 3 else None
+			report.save()
+
+		Model.free_all()
+
+		columns = Report.to_columns(['1', 2, '3'], fields=['views', 'published', 'public', 'title'])
+
+		self.assertEqual(columns['id'].tolist(), ['1', '2', '3'])
+		self.assertEqual(columns['views'].dtype, numpy.int64)
+		self.assertEqual(columns['views'].tolist(), [10, 20, 30])
+		self.assertEqual(columns['public'].dtype, numpy.bool_)
+		self.assertEqual(columns['public'].tolist(), [True, False, True])
+		self.assertEqual(columns['title'].tolist(), ['report1', 'report2', 'report3'])
+		self.assertEqual(str(columns['published'].dtype), 'datetime64[s]')
+		self.assertEqual(columns['published'][0], numpy.datetime64(NOW_TS + 1, 's'))
+		self.assertTrue(numpy.isnat(columns['published'][2]))
+
+		# Models are not put into registry.
+		self.assertEqual(len(Report._objects), 0)
+
+		# Missing integers.
+		Report(4)['views'] = None
+		Report(4).save()
+
+		columns = Report.to_columns(Report.views >= 30, fields=['views'], chunk=2)
+		self.assertEqual(columns['id'].tolist(), ['3', '5'])
+		self.assertEqual(columns['views'].tolist(), [30, 50])
+
+		columns = Report.to_columns(fields=['views'])
+		self.assertEqual(columns['views'].dtype, numpy.float64)
+		self.assertEqual(numpy.isnan(columns['views']).sum(), 1)
+		self.assertEqual(numpy.nansum(columns['views']), 110)
+
+		with self.assertRaises(Exception):
+			Report.to_columns(fields=['none'])
+
+		if pandas is None:
+			return
+
+		frame = Report.to_columns(range(1, 6), dataframe=True)
+		self.assertEqual(list(frame.columns), ['public', 'published', 'title', 'views'])
+		self.assertEqual(frame.loc['5', 'title'], 'report5')
+		self.assertEqual(frame['public'].sum(), 3)
+
+	def test_to_db_many (self):
+		email = User.getfields()['email']
+		password = User.getfields()['password']
+		name = User.getfields()['name']
+		age = User.getfields()['age']
+		created = User.getfields()['created']
+		flag = Bool(name='flag')
+
+		cases = [
+			(email, ['Foo@Bar.com', None, 'a.b@c.org']),
+			(password, ['secret', None]),
+			(name, ['John', 'John Smith', None]),
+			(age, [0, '42', 100, None]),
+			(created, [NOW, NOW_TS, None]),
+			(flag, [True, False, '0', '1', 0, None]),
+		]
+
+		for field, vals in cases:
+			self.assertEqual(field.to_db_many(vals), \
+				[None if val is None else field.to_db(val) for val in vals])
+
+			raw = [None if val is None else str(val) for val in field.to_db_many(vals)]
+
+			self.assertEqual(field.from_db_many(raw), \
+				[field.none if val is None else field.from_db(val) for val in raw])
+
+		self.assertEqual(created.from_db_many([str(NOW_TS)]), [NOW])
+
+		for field, vals in [
+			(email, ['foo@bar.com', 'foo']),
+			(name, ['John', 'Jo']),
+			(name, ['John', 'John Smith Jr']),
+			(age, [1, -1]),
+			(age, [1, 101]),
+			(age, ['x']),
+		]:
+			with self.assertRaises(Exception):
+				field.to_db_many(vals)
+
+		self.assertEqual(age.to_db_many([]), [])
+		self.assertEqual(name.to_db_many([None]), [None])
+
+		# Fast paths are not used if conversions are overridden.
+		class Upper (String):
+			def to_db (self, val):
+				return super(Upper, self).to_db(val).upper()
+
+		class Salted (MD5Pass):
+			def to_db (self, val):
+				return super(Salted, self).to_db('salt' + val)
+
+		class Cents (Integer):
+			def to_db (self, val):
+				return super(Cents, self).to_db(float(val) * 100)
+
+			def from_db (self, val):
+				return int(val) / 100.0
+
+		class Flag (Bool):
+			def from_db (self, val):
+				return 'yes' if val == '1' else 'no'
+
+		self.assertEqual(Upper(name='u').to_db_many(['ab', None]), ['AB', None])
+		self.assertEqual(Salted(name='s').to_db_many(['x']), [Salted(name='s').to_db('x')])
+		self.assertEqual(Cents(name='c').to_db_many(['1.5']), [150])
+		self.assertEqual(Cents(name='c').from_db_many(['150', None]), [1.5, None])
+		self.assertEqual(Flag(name='f').from_db_many(['1', '0']), ['yes', 'no'])
+		self.assertEqual(password.to_db_many(['secret']), [password.to_db('secret')])
+
+		# Bulk load converts values column by column.
+		User.bulk_load([
+			{'id': 1, 'email': 'A@b.com', 'age': '7', 'created': NOW},
+			{'id': 2, 'name': 'Jane Doe', 'age': None},
+		])
+
+		self.assertEqual(redis0.handler.hgetall('u:1'), {
+			b'eml': b'a@b.com',
+			b'age': b'7',
+			b'created': str(NOW_TS).encode('utf-8'),
+		})
+
+		self.assertEqual(redis0.handler.hgetall('u:2'), {
+			b'name': b'Jane Doe',
+			b'created': str(NOW_TS).encode('utf-8'),
+		})
+
+		with self.assertRaises(Exception):
+			User.bulk_load([{'id': 3, 'age': 1000}])
+
+		self.assertFalse(redis0.handler.exists('u:3'))
@@ -1,27 +1,310 @@
 # -*- coding: utf-8 -
 
-from time import (
-	time,
+from abc import (
+	ABCMeta,
+)
+
+from base64 import (
+	b64decode,
+	b64encode,
 )
 
-from random import (
-	randint,
+from collections import (
+	OrderedDict,
+)
+
+from importlib import (
+	import_module,
+)
+
+from os import (
+	getpid,
+)
+
+from threading import (
+	Lock,
+	local,
+)
+
+from time import (
+	time,
 )
 
 from sys import (
 	version_info,
 )
 
+from zlib import (
+	compress as zlib_compress,
+	decompress as zlib_decompress,
+)
+
+try:
+	from contextvars import (
+		ContextVar,
+	)
+
+except ImportError:
+	ContextVar = None
+
 
 # If running on Python 3.x
 PY3K = version_info[0] == 3
 
+# Base class of abstract classes (metaclass syntax differs in 2.x and 3.x).
+Abstract = ABCMeta('Abstract', (object,), dict())
+
+# Compressed values markers.
+CODECS = {
+	'zlib': b'\x00z',
+	'lz4': b'\x00l',
+}
+
+
+class IdGenerator (object):
+	""" Snowflake-like unique id generator. Each id is combined from
+	milliseconds since EPOCH (41 bits), worker id (10 bits) and sequence
+	number (12 bits). Worker id defaults to 10 lower bits of process id
+	which may collide (e.g. pids 5 and 1029 on the same host, or processes
+	of different hosts), see setworker(). """
+
+	EPOCH = 1374000000000 # Milliseconds.
+	WORKER_BITS = 10
+	SEQUENCE_BITS = 12
+
+	MAX_WORKER = (1 << WORKER_BITS) - 1
+	MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+	def __init__ (self, worker=None):
+		if worker is not None:
+			assert 0 <= worker <= self.MAX_WORKER
+
+		self._lock = Lock()
+		self._worker = worker
+		self._pid = None
+		self._last = -1
+		self._seq = 0
+
+	def getworker (self):
+		""" Return worker id of current process. """
+
+		if self._worker is not None:
+			return self._worker
+
+		return getpid() & self.MAX_WORKER
+
+	def setworker (self, worker):
+		""" Pin worker id (should be unique per process across all hosts). """
+
+		assert 0 <= worker <= self.MAX_WORKER
+
+		with self._lock:
+			self._worker = worker
+
+	def next (self):
+		""" Return unique integer id. """
+
+		with self._lock:
+			return self._next()
+
+	def reserve (self, count):
+		""" Return list of *count* unique integer ids. """
+
+		with self._lock:
+			return [self._next() for _ in range(count)]
+
+	def _next (self):
+		pid = getpid()
+
+		# Forked process must not continue parent's sequence.
+		if pid != self._pid:
+			self._pid = pid
+			self._last = -1
+			self._seq = 0
+
+		now = int(time() * 1000) - self.EPOCH
+
+		if now > self._last:
+			self._last = now
+			self._seq = 0
+
+		else:
+			# Same millisecond or clock moved backwards. Stay on the last
+			# used timestamp and borrow next one on sequence overflow.
+			self._seq = (self._seq + 1) & self.MAX_SEQUENCE
+
+			if self._seq == 0:
+				self._last += 1
+
+		return (self._last << (self.WORKER_BITS + self.SEQUENCE_BITS)) | \
+			(self.getworker() << self.SEQUENCE_BITS) | self._seq
+
+
+generator = IdGenerator()
+
+
+class ContextStack (object):
+	""" Stack which is local to current context (contextvars, so it works
+	with threads, greenlets and asyncio tasks) or current thread if
+	contextvars are not available. """
+
+	def __init__ (self, name):
+		if ContextVar is not None:
+			self._var = ContextVar(name, default=())
+
+		else:
+			self._local = local()
+
+	def push (self, item):
+		""" Push item. Return token to pass to pop(). """
+
+		if ContextVar is not None:
+			return self._var.set(self._var.get() + (item,))
+
+		if not hasattr(self._local, 'stack'):
+			self._local.stack = list()
+
+		self._local.stack.append(item)
+
+	def pop (self, token=None):
+		""" Remove the last pushed item. """
+
+		if ContextVar is not None:
+			self._var.reset(token)
+
+		else:
+			self._local.stack.pop()
+
+	def top (self):
+		""" Return the last pushed item or None. """
+
+		if ContextVar is not None:
+			stack = self._var.get()
+
+		else:
+			stack = getattr(self._local, 'stack', None)
+
+		return stack[-1] if stack else None
+
+
+class LRUCache (object):
+	""" Thread safe mapping of limited size. Least recently used items are
+	dropped on overflow. """
+
+	def __init__ (self, size):
+		assert size > 0
+
+		self._lock = Lock()
+		self._size = size
+		self._items = OrderedDict()
+
+	def __len__ (self):
+		return len(self._items)
+
+	def __contains__ (self, key):
+		return key in self._items
+
+	def get (self, key, default=None):
+		with self._lock:
+			if key not in self._items:
+				return default
+
+			val = self._items.pop(key)
+			self._items[key] = val
+
+			return val
+
+	def set (self, key, val):
+		with self._lock:
+			self._items.pop(key, None)
+			self._items[key] = val
+
+			while len(self._items) > self._size:
+				self._items.popitem(last=False)
+
+	def delete (self, key):
+		with self._lock:
+			self._items.pop(key, None)
+
+	def clear (self):
+		with self._lock:
+			self._items.clear()
+
 
 def intid ():
-	""" Return pseudo-unique decimal id. """
-	return int((time() - 1374000000) * 100000) * 100 + randint(0, 99)
+	""" Return unique decimal id. """
+	return generator.next()
 
 
 def hexid ():
-	""" Return pseudo-unique hexadecimal id. """
+	""" Return unique hexadecimal id. """
 	return '%x' % intid()
+
+
+def encode_raw (val):
+	""" Return JSON compatible representation of raw database value.
+	Binary (not utf-8) one is base64 encoded into {'$bytes': ...} object. """
+
+	if type(val) is not bytes:
+		return val
+
+	try:
+		return val.decode('utf-8')
+
+	except UnicodeDecodeError:
+		return {'$bytes': b64encode(val).decode('ascii')}
+
+
+def decode_raw (val):
+	""" Return raw database value of encode_raw() result. """
+
+	if type(val) is dict and list(val) == ['$bytes']:
+		return b64decode(val['$bytes'])
+
+	return val
+
+
+def optional (name, feature):
+	""" Return optional dependency module. It is imported on first use so
+	import of redisca2 does not pay for it. Exception raised if it is not
+	installed. """
+
+	try:
+		return import_module(name)
+
+	except ImportError:
+		raise Exception('%s package is required by %s' % (name.partition('.')[0], feature))
+
+
+def compress (data, codec='zlib'):
+	""" Return compressed bytes prefixed with codec marker. """
+
+	if codec == 'zlib':
+		return CODECS[codec] + zlib_compress(data)
+
+	elif codec == 'lz4':
+		return CODECS[codec] + optional('lz4.frame', 'lz4 codec').compress(data)
+
+	raise Exception('Unknown codec %s' % codec)
+
+
+def decompress (val):
+	""" Return text of value returned by compress(). Other values are
+	returned as is. Compressed value is accepted as text too (if it was
+	occasionally decoded as utf-8). """
+
+	data = val.encode('utf-8') if PY3K and type(val) is str else val
+
+	if type(data) is not bytes or data[:1] != b'\x00':
+		return val
+
+	if data[:2] == CODECS['zlib']:
+		data = zlib_decompress(data[2:])
+
+	elif data[:2] == CODECS['lz4']:
+		data = optional('lz4.frame', 'lz4 codec').decompress(data[2:])
+
+	else:
+		return val
+
+	return data.decode('utf-8')
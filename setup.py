@@ -40,5 +40,11 @@ setup(
 
 	install_requires = [
 		'redis >= 2.7'
-	]
+	],
+
+	entry_points = {
+		'console_scripts': [
+			'redisca2 = redisca2.cli:main',
+		],
+	},
 )